@@ -0,0 +1,283 @@
+import math
+import os
+import threading
+import time
+import zlib
+from flask import request, jsonify, g
+import metrics
+import shared_state
+
+# Token bucket rate limits in requests per second, 0 disables a limit. Reads and writes have their own
+# global bucket, so a write storm does not use up the quota of the reads. A burst of up to *_BURST requests
+# passes at once. The buckets are shared by the processes of the server
+CLIENT_RATE_LIMIT = float(os.environ.get("CLIENT_RATE_LIMIT", 0))
+CLIENT_BURST = float(os.environ.get("CLIENT_BURST", 50))
+READ_RATE_LIMIT = float(os.environ.get("READ_RATE_LIMIT", 0))
+READ_BURST = float(os.environ.get("READ_BURST", 500))
+WRITE_RATE_LIMIT = float(os.environ.get("WRITE_RATE_LIMIT", 0))
+WRITE_BURST = float(os.environ.get("WRITE_BURST", 100))
+# Clients are hashed into this many buckets, clients sharing a bucket share their limit
+CLIENT_BUCKET_SLOTS = int(os.environ.get("CLIENT_BUCKET_SLOTS", 4096))
+
+# Requests served at once per process. Fewer writes than serving threads keep threads free for the reads
+MAX_CONCURRENT_READS = int(os.environ.get("MAX_CONCURRENT_READS", 16))
+MAX_CONCURRENT_WRITES = int(os.environ.get("MAX_CONCURRENT_WRITES", 8))
+# Seconds a request waits for a free slot before it is shed, and requests waiting at most per process and class
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 0.05))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 64))
+# Retry-After of the shed requests in seconds
+SHED_RETRY_AFTER = int(os.environ.get("SHED_RETRY_AFTER", 1))
+
+# Tokens are counted in millionths
+MICRO = 1000000
+
+
+class TokenBuckets:
+    """
+    Token buckets in shared counters, two per bucket: the tokens and the time of the last refill
+    Args:
+        name: Name of the counter file
+        size: Number of buckets
+        rate: Tokens added per second
+        burst: Capacity of a bucket, a new bucket starts full
+    """
+    def __init__(self, name, size, rate, burst):
+        self.size = size
+        self.rate = rate
+        self.capacity = int(max(burst, 1) * MICRO)
+        self._counters = shared_state.SharedCounters(name, size * 2)
+
+    def _refill(self, tokens, last_refill, now):
+        if last_refill == 0:
+            return self.capacity
+        return min(self.capacity, tokens + int((now - last_refill) * self.rate * MICRO / 1e9))
+
+    def take(self, index, amount):
+        """
+        Function to take tokens from a bucket if it holds enough
+        Args:
+            index: Bucket
+            amount: Number of tokens, more than the capacity empties a full bucket
+        Returns:
+            0 if the tokens were taken, otherwise the seconds until the bucket holds enough
+        """
+        needed = min(int(amount * MICRO), self.capacity)
+        wait = 0.0
+
+        def take_tokens(values):
+            nonlocal wait
+            now = time.monotonic_ns()
+            tokens = self._refill(*values, now)
+            if tokens >= needed:
+                tokens -= needed
+            else:
+                wait = (needed - tokens) / (self.rate * MICRO)
+            return tokens, now
+
+        self._counters.update(index * 2, 2, take_tokens)
+        return wait
+
+    def give(self, index, amount):
+        """
+        Function to return tokens taken for a request that was rejected afterwards
+        """
+        def give_tokens(values):
+            now = time.monotonic_ns()
+            return min(self.capacity, self._refill(*values, now) + min(int(amount * MICRO), self.capacity)), now
+
+        self._counters.update(index * 2, 2, give_tokens)
+
+
+class ConcurrencyLimit:
+    """
+    Thread-safe limit of the requests a process serves at once. A request waits a short time for a free slot,
+    with too many waiting it is shed at once
+    Args:
+        limit: Requests served at once
+        queue_timeout: Seconds to wait for a free slot
+        queue_size: Requests waiting at most
+    """
+    def __init__(self, limit, queue_timeout=ADMISSION_QUEUE_TIMEOUT, queue_size=ADMISSION_QUEUE_SIZE):
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.queue_size = queue_size
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.queued = 0
+
+    def acquire(self):
+        """
+        Returns:
+            Seconds waited for the slot, None if the request is shed
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.queued >= self.queue_size:
+                    return None
+                self.queued += 1
+            start_time = time.perf_counter()
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.queued -= 1
+            if not acquired:
+                return None
+            waited = time.perf_counter() - start_time
+        else:
+            waited = 0.0
+        with self._lock:
+            self.in_flight += 1
+        return waited
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+
+client_buckets = (TokenBuckets("admission_clients", CLIENT_BUCKET_SLOTS, CLIENT_RATE_LIMIT, CLIENT_BURST)
+                  if CLIENT_RATE_LIMIT > 0 else None)
+class_buckets = {query_class: TokenBuckets(f"admission_{query_class}", 1, rate, burst)
+                 for query_class, rate, burst in (("read", READ_RATE_LIMIT, READ_BURST),
+                                                  ("write", WRITE_RATE_LIMIT, WRITE_BURST)) if rate > 0}
+concurrency_limits = {"read": ConcurrencyLimit(MAX_CONCURRENT_READS), "write": ConcurrencyLimit(MAX_CONCURRENT_WRITES)}
+
+ADMISSION_REJECTIONS = metrics.REGISTRY.counter("admission_rejections", "Requests rejected per reason and query class",
+                                                ("reason", "query_class"))
+ADMISSION_ADMITTED = metrics.REGISTRY.counter("admission_admitted",
+                                              "Requests admitted per query class, queued ones waited for a slot",
+                                              ("query_class", "queued"))
+ADMISSION_QUEUE_LATENCY = metrics.REGISTRY.histogram("admission_queue_duration_seconds",
+                                                     "Time queued requests waited for a slot", ("query_class",))
+metrics.REGISTRY.gauge("admission", "Requests in flight and waiting for a slot per query class",
+                       ("query_class", "state"),
+                       callback=lambda: {(query_class, state): float(getattr(limit, state))
+                                         for query_class, limit in concurrency_limits.items()
+                                         for state in ("in_flight", "queued")},
+                       multiprocess_mode="sum")
+
+
+def get_cost(data, batch):
+    """
+    Function to count the reads and writes of a request
+    Args:
+        data: Request body
+        batch: Whether the body holds a batch of queries
+    Returns:
+        Dictionary of the number of queries per query class
+    """
+    queries = data.get("queries") if batch else [data.get("query")]
+    cost = {"read": 0, "write": 0}
+    for query in queries if isinstance(queries, list) else []:
+        is_write = isinstance(query, str) and query.strip().lower().startswith(("insert", "delete", "update"))
+        cost["write" if is_write else "read"] += 1
+    return cost
+
+
+def get_buckets(client, cost):
+    """
+    Function to find the buckets a request takes its tokens from: the one of the client and the ones of its
+    query classes
+    Args:
+        client: Client address
+        cost: Number of queries per query class
+    Returns:
+        List of (limit name, TokenBuckets, bucket index, tokens)
+    """
+    buckets = []
+    if client_buckets is not None:
+        buckets.append(("client_rate", client_buckets, zlib.crc32(client.encode()) % client_buckets.size,
+                        sum(cost.values())))
+    buckets += [(f"{query_class}_rate", class_buckets[query_class], 0, amount)
+                for query_class, amount in cost.items() if amount and query_class in class_buckets]
+    return buckets
+
+
+def take_tokens(buckets):
+    """
+    Function to take the tokens of a request, nothing is taken if one of the buckets holds too few
+    Args:
+        buckets: See get_buckets
+    Returns:
+        None, or the exhausted limit and the seconds until it admits the request
+    """
+    for i, (reason, token_buckets, index, amount) in enumerate(buckets):
+        wait = token_buckets.take(index, amount)
+        if wait:
+            give_tokens(buckets[:i])
+            return reason, wait
+    return None
+
+
+def give_tokens(buckets):
+    for _, token_buckets, index, amount in buckets:
+        token_buckets.give(index, amount)
+
+
+def get_stats():
+    return {"limits": {"client_rate": CLIENT_RATE_LIMIT, "read_rate": READ_RATE_LIMIT,
+                       "write_rate": WRITE_RATE_LIMIT, "max_concurrent_reads": MAX_CONCURRENT_READS,
+                       "max_concurrent_writes": MAX_CONCURRENT_WRITES, "queue_timeout": ADMISSION_QUEUE_TIMEOUT,
+                       "queue_size": ADMISSION_QUEUE_SIZE},
+            "in_flight": {query_class: limit.in_flight for query_class, limit in concurrency_limits.items()},
+            "queued": {query_class: limit.queued for query_class, limit in concurrency_limits.items()}}
+
+
+def install(app, rules):
+    """
+    Function to rate limit and bound the concurrency of the query routes of a Flask app. Requests over a rate
+    limit get 429, requests finding no free slot in time get 503, both with Retry-After.
+    The slot is held until the response was sent, a streamed one until its last row
+    Args:
+        app: Flask app
+        rules: URL rules of the query routes, the ones ending with /batch take a batch of queries
+    """
+    @app.before_request
+    def admit_request():
+        if request.url_rule is None or request.url_rule.rule not in rules:
+            return None
+        data = request.get_json(silent=True)
+        cost = get_cost(data if isinstance(data, dict) else {}, request.url_rule.rule.endswith("/batch"))
+        query_class = "write" if cost["write"] else "read"
+
+        buckets = get_buckets(request.remote_addr or "", cost)
+        exhausted = take_tokens(buckets)
+        if exhausted is not None:
+            reason, wait = exhausted
+            ADMISSION_REJECTIONS.labels(reason, query_class).inc()
+            return (jsonify({"error": f"Rate limit exceeded ({reason.replace('_', ' ')})"}), 429,
+                    {"Retry-After": str(max(math.ceil(wait), 1))})
+
+        waited = concurrency_limits[query_class].acquire()
+        if waited is None:
+            # The request was not served, its tokens stay available
+            give_tokens(buckets)
+            ADMISSION_REJECTIONS.labels("concurrency", query_class).inc()
+            return (jsonify({"error": "Server busy, too many concurrent requests"}), 503,
+                    {"Retry-After": str(SHED_RETRY_AFTER)})
+        ADMISSION_ADMITTED.labels(query_class, "true" if waited > 0 else "false").inc()
+        if waited > 0:
+            ADMISSION_QUEUE_LATENCY.labels(query_class).observe(waited)
+        g.admission_slot = concurrency_limits[query_class]
+
+    @app.after_request
+    def release_after_response(response):
+        slot = g.pop("admission_slot", None)
+        if slot is not None:
+            response.call_on_close(slot.release)
+        return response
+
+    @app.teardown_request
+    def release_on_exception(exception):
+        # after_request already took the slot unless it did not run: the exception propagated
+        # (PROPAGATE_EXCEPTIONS, e.g. testing or debug mode) or an after_request hook failed first
+        slot = g.pop("admission_slot", None)
+        if slot is not None:
+            slot.release()
+
+    @app.route('/admission', methods=['GET'])
+    def admission_stats():
+        # Limits and the requests in flight and waiting in this process
+        return jsonify(get_stats()), 200
@@ -2,8 +2,15 @@ import sys
 import requests
 import time
 import random
+import contextlib
+import io
+import argparse
+import json
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
 
-strategies = ["", "direct", "random", "customized"]
+strategies = ["", "direct", "random", "customized", "least-outstanding", "weighted"]
 
 # Generate 1000 write (INSERT) queries
 write_queries = [{"query": f"INSERT INTO actor (first_name, last_name) VALUES (\"User{i}\", \"Test{i}\")"} for i in range(1000)]
@@ -27,6 +34,383 @@ def send_request(request_num, orchestrator_url, query, strategy = ""):
         print(f"Request {request_num}: Failed - {str(e)}")
         return None, str(e)
 
+class LatencyHistogram:
+    """
+    HDR-style latency histogram with log-linear buckets, about 1% precision from 1 us to hours
+    """
+    SUB_BUCKET_BITS = 7
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, latency_s):
+        value = max(int(latency_s * 1e6), 1)
+        shift = max(value.bit_length() - self.SUB_BUCKET_BITS, 0)
+        bucket = (shift, value >> shift)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """
+        Returns:
+            Latency in milliseconds below which the given percentage of the samples fall
+        """
+        if not self.total:
+            return None
+        rank = max(int(self.total * percent / 100 + 0.5), 1)
+        seen = 0
+        for shift, sub_bucket in sorted(self.counts, key=lambda b: b[1] << b[0]):
+            seen += self.counts[(shift, sub_bucket)]
+            if seen >= rank:
+                # Upper edge of the bucket
+                return min(((sub_bucket + 1) << shift) - 1, self.max) / 1000
+        return self.max / 1000
+
+    def summary(self):
+        return {"count": self.total, "mean_ms": self.sum / self.total / 1000 if self.total else None,
+                "p50_ms": self.percentile(50), "p95_ms": self.percentile(95),
+                "p99_ms": self.percentile(99), "max_ms": self.max / 1000 if self.total else None}
+
+
+# Tiers in the order of the Server-Timing breakdown, each one's duration includes the next one.
+# The pipeline replaces gatekeeper, trusted host and proxy in the combined topology
+TIERS = ["gatekeeper", "pipeline", "trusted_host", "proxy", "worker"]
+
+
+def parse_server_timing(header):
+    """
+    Function to parse a Server-Timing header
+    Args:
+        header: Header value, e.g. "gatekeeper;dur=4.2, trusted_host;dur=3.1, validate;dur=0.02"
+    Returns:
+        Dictionary of step name to milliseconds. For each tier, "hop:<tier>" is the time it spent itself
+        including the network round trip to the next tier
+    """
+    timings = {}
+    for entry in header.split(","):
+        name, _, parameters = entry.strip().partition(";")
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.strip().partition("=")
+            if key == "dur" and name:
+                timings[name] = timings.get(name, 0.0) + float(value)
+    present = [tier for tier in TIERS if tier in timings]
+    for tier, upstream in zip(present, present[1:]):
+        timings[f"hop:{tier}"] = timings[tier] - timings[upstream]
+    return timings
+
+
+def run_load(url, strategy, concurrency, rate, duration, write_ratio, parameterized=False):
+    """
+    Function to send a read/write mix from concurrent clients for a fixed duration.
+    With a target rate the requests follow a fixed schedule and latency is measured from the scheduled
+    start, so a stalled server is not hidden by clients that stop sending (coordinated omission)
+    Args:
+        url: Gatekeeper /start URL
+        strategy: Routing strategy for the reads, empty for the default
+        concurrency: Number of concurrent clients
+        rate: Target requests per second over all clients, 0 for as fast as possible
+        duration: Duration of the run in seconds
+        write_ratio: Fraction of the requests that are INSERTs
+        parameterized: Send statement templates with parameter lists instead of interpolated SQL
+    Returns:
+        Dictionary of results
+    """
+    lock = threading.Lock()
+    schedule = {"next": 0}
+    start_time = time.perf_counter()
+    deadline = start_time + duration
+
+    def client():
+        session = requests.Session()
+        # Failed requests, e.g. shed with 429 or 503, are kept apart so they do not lower the service latency
+        histograms = {"read": LatencyHistogram(), "write": LatencyHistogram()}
+        failure_histograms = {"read": LatencyHistogram(), "write": LatencyHistogram()}
+        failures = {"read": {}, "write": {}}
+        steps = {"read": {}, "write": {}}
+        while True:
+            with lock:
+                number = schedule["next"]
+                schedule["next"] += 1
+            if rate:
+                scheduled = start_time + number / rate
+                if scheduled >= deadline:
+                    break
+                time.sleep(max(scheduled - time.perf_counter(), 0))
+            else:
+                scheduled = time.perf_counter()
+                if scheduled >= deadline:
+                    break
+
+            kind = "write" if random.random() < write_ratio else "read"
+            if kind == "write" and parameterized:
+                data = {"query": "INSERT INTO actor (first_name, last_name) VALUES (%s, %s)",
+                        "params": [f"Load{number}", f"Test{number}"]}
+            elif kind == "write":
+                data = {"query": f"INSERT INTO actor (first_name, last_name) VALUES (\"Load{number}\", \"Test{number}\")"}
+            elif parameterized:
+                data = {"query": "SELECT * FROM actor WHERE first_name = %s", "params": [f"User{random.randrange(1000)}"]}
+            else:
+                data = dict(random.choice(read_queries))
+            if kind == "read":
+                if strategy:
+                    data["strategy"] = strategy
+            try:
+                response = session.post(url, json=data)
+                failure = None if response.status_code == 200 else str(response.status_code)
+            except requests.exceptions.RequestException:
+                failure = "connection"
+            if failure is None:
+                for name, ms in parse_server_timing(response.headers.get("Server-Timing", "")).items():
+                    steps[kind].setdefault(name, LatencyHistogram()).record(ms / 1000)
+                histograms[kind].record(time.perf_counter() - scheduled)
+            else:
+                failures[kind][failure] = failures[kind].get(failure, 0) + 1
+                failure_histograms[kind].record(time.perf_counter() - scheduled)
+        return histograms, failure_histograms, failures, steps
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [future.result() for future in [executor.submit(client) for _ in range(concurrency)]]
+    elapsed = time.perf_counter() - start_time
+
+    summary = {}
+    for kind in ["read", "write"]:
+        histogram = LatencyHistogram()
+        failure_histogram = LatencyHistogram()
+        failures = {}
+        breakdown = {}
+        for histograms, failure_histograms, client_failures, steps in results:
+            histogram.merge(histograms[kind])
+            failure_histogram.merge(failure_histograms[kind])
+            for reason, count in client_failures[kind].items():
+                failures[reason] = failures.get(reason, 0) + count
+            for name, step_histogram in steps[kind].items():
+                breakdown.setdefault(name, LatencyHistogram()).merge(step_histogram)
+        # Latency percentiles and throughput count the successful requests only
+        summary[kind] = dict(histogram.summary(), errors=failure_histogram.total, failures=failures,
+                             failure_latency=failure_histogram.summary(), throughput_rps=histogram.total / elapsed,
+                             server_timing={name: step.summary() for name, step in breakdown.items()})
+    return summary
+
+
+def benchmark_load(args):
+    """
+    Function to run the load generator for each strategy and export the results as JSON
+    Args:
+        args: Parsed command line arguments
+    """
+    with open('gatekeeper_ip.txt', 'r') as file:
+        gate_ip = file.read().strip()
+    url = f"http://{gate_ip}:5000/start"
+
+    results = {"started_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "concurrency": args.concurrency,
+               "rate": args.rate, "duration": args.duration, "write_ratio": args.write_ratio,
+               "parameterized": args.parameterized, "strategies": {}}
+    for strategy in args.strategies:
+        name = strategy or "round-robin"
+        print(f"Running {name} for {args.duration} s...")
+        results["strategies"][name] = run_load(url, strategy, args.concurrency, args.rate,
+                                               args.duration, args.write_ratio, args.parameterized)
+        print_load(results["strategies"][name])
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def print_load(results):
+    """
+    Function to print the latency, throughput and Server-Timing breakdown of a load run
+    Args:
+        results: Dictionary returned by run_load
+    """
+    for kind, summary in results.items():
+        if summary["errors"]:
+            failure_latency = summary["failure_latency"]
+            reasons = ", ".join(f"{reason}: {count}" for reason, count in sorted(summary["failures"].items()))
+            print(f"  {kind} failed: {summary['errors']} requests ({reasons}), "
+                  f"p50 {failure_latency['p50_ms']:.2f} ms, p99 {failure_latency['p99_ms']:.2f} ms")
+        if summary["count"]:
+            print(f"  {kind}: {summary['count']} successful requests, {summary['throughput_rps']:.1f} req/s, "
+                  f"p50 {summary['p50_ms']:.2f} ms, p95 {summary['p95_ms']:.2f} ms, "
+                  f"p99 {summary['p99_ms']:.2f} ms, max {summary['max_ms']:.2f} ms")
+            for step, step_summary in summary["server_timing"].items():
+                print(f"    {step}: mean {step_summary['mean_ms']:.3f} ms, p50 {step_summary['p50_ms']:.3f} ms, "
+                      f"p99 {step_summary['p99_ms']:.3f} ms")
+
+
+def benchmark_topology(args):
+    """
+    Function to run the same load against the split tiers and the combined pipeline and compare them.
+    Both run on the gatekeeper instance and read from the same databases, see PIPELINE_ENABLED in main.py.
+    The runs alternate so a drift of the databases affects both topologies alike
+    Args:
+        args: Parsed command line arguments
+    """
+    with open('gatekeeper_ip.txt', 'r') as file:
+        gate_ip = file.read().strip()
+    urls = {"split": f"http://{gate_ip}:5000/start", "combined": f"http://{gate_ip}:5001/start"}
+
+    runs = {name: [] for name in urls}
+    for round_number in range(args.rounds):
+        for name, url in urls.items():
+            print(f"Running {name} round {round_number + 1} for {args.duration} s...")
+            runs[name].append(run_load(url, args.strategy, args.concurrency, args.rate, args.duration,
+                                       args.write_ratio, args.parameterized))
+            print_load(runs[name][-1])
+
+    results = {"started_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "concurrency": args.concurrency,
+               "rate": args.rate, "duration": args.duration, "write_ratio": args.write_ratio,
+               "strategy": args.strategy or "round-robin", "rounds": runs}
+    print("Median over the rounds, combined against split:")
+    for kind in ["read", "write"]:
+        medians = {name: {metric: statistics.median(run[kind][metric] for run in runs[name])
+                          for metric in ("p50_ms", "p99_ms", "throughput_rps")}
+                   for name in urls if all(run[kind]["count"] for run in runs[name])}
+        if len(medians) < len(urls):
+            continue
+        split, combined = medians["split"], medians["combined"]
+        print(f"  {kind}: p50 {split['p50_ms']:.2f} -> {combined['p50_ms']:.2f} ms, "
+              f"p99 {split['p99_ms']:.2f} -> {combined['p99_ms']:.2f} ms, "
+              f"{split['throughput_rps']:.1f} -> {combined['throughput_rps']:.1f} req/s")
+        results[kind] = medians
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
+
+def benchmark_pool(num_queries=1000):
+    """
+    Function to compare per-query latency of a fresh MySQL connection against the connection pool.
+    Has to run on the manager or a worker instance next to worker_manager_app.py
+    Args:
+        num_queries: Number of queries to send per mode
+    """
+    import mysql.connector
+    import worker_manager_app as db
+
+    query = "SELECT * FROM actor WHERE actor_id = 1;"
+
+    def fresh_connection():
+        conn = mysql.connector.connect(host=db.DB_HOST, user=db.DB_USER,
+                                       password=db.DB_PASSWORD, database=db.DB_NAME)
+        cursor = conn.cursor()
+        cursor.execute(query)
+        cursor.fetchall()
+        cursor.close()
+        conn.close()
+
+    for mode, run in [("fresh connection", fresh_connection), ("pooled", lambda: db.run_query(query))]:
+        latencies = []
+        for _ in range(num_queries):
+            start_time = time.perf_counter()
+            run()
+            latencies.append((time.perf_counter() - start_time) * 1000)
+        latencies.sort()
+        print(f"{mode}: mean {sum(latencies) / num_queries:.3f} ms, "
+              f"p50 {latencies[num_queries // 2]:.3f} ms, p99 {latencies[int(num_queries * 0.99)]:.3f} ms")
+    print(f"Pool statistics: {db.pool.get_stats()}")
+
+def benchmark_validator(repeat=1000):
+    """
+    Function to measure the trusted host validator on typical and adversarial queries,
+    with an empty verdict cache and with a warm one
+    Args:
+        repeat: Number of validations per query
+    """
+    import trusted_host
+
+    queries = {
+        "select": read_queries[0]["query"],
+        "insert": write_queries[0]["query"],
+        "delete": "DELETE FROM actor WHERE first_name = \"User1\";",
+        "tautology": "SELECT * FROM actor WHERE 1=1",
+        "many FROM, no WHERE": "SELECT " + "FROM " * 2000,
+        "trailing whitespace": "SELECT * FROM actor WHERE" + " " * 20000,
+        "many quotes": "SELECT * FROM actor WHERE a = '" + "\\'" * 5000,
+        "long literal": "SELECT * FROM actor WHERE a = '" + "x" * 900 + "'",
+        "many literals": "SELECT * FROM actor WHERE a IN (" + "'x'," * 230 + "'x')",
+        "oversized, many literals": "SELECT * FROM actor WHERE a IN (" + "'x'," * 320000 + "'x')",
+    }
+
+    for name, query in queries.items():
+        for mode in ["cold", "warm"]:
+            start_time = time.perf_counter()
+            # Rejections are printed by the validator, keep them out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(repeat):
+                    if mode == "cold":
+                        trusted_host.cached_check_fingerprint.cache_clear()
+                    trusted_host.validate(query, True)
+            elapsed = (time.perf_counter() - start_time) / repeat * 1e6
+            print(f"{name} ({mode} cache): {elapsed:.1f} us per query")
+    print(f"Verdict cache: {trusted_host.cached_check_fingerprint.cache_info()}")
+
+def benchmark_encoding(num_rows=16044, repeat=5):
+    """
+    Function to compare bytes on the wire and CPU time per hop of a SELECT result encoded as JSON,
+    decoded and re-encoded by every tier, against the columnar MessagePack encoding forwarded as bytes.
+    Uses synthetic rows shaped like the Sakila rental table
+    Args:
+        num_rows: Number of rows in the result
+        repeat: Number of runs, the CPU time is averaged
+    """
+    import datetime
+    import flask
+    import codec
+
+    if not codec.available:
+        print("msgpack is not installed")
+        return
+
+    json_provider = flask.Flask("benchmark").json
+    columns = ["rental_id", "rental_date", "inventory_id", "customer_id", "return_date", "staff_id", "last_update"]
+    day = datetime.datetime(2005, 5, 24, 22, 53, 30)
+    rows = [(i, day + datetime.timedelta(minutes=i), i % 4581 + 1, i % 599 + 1,
+             day + datetime.timedelta(days=3, minutes=i), i % 2 + 1, day) for i in range(num_rows)]
+
+    def timed(function):
+        start_time = time.process_time()
+        for _ in range(repeat):
+            result = function()
+        return result, (time.process_time() - start_time) / repeat * 1000
+
+    # JSON: every tier decodes the body and encodes it again with the source added
+    report = {"json": [], "msgpack (JSON client)": [], "msgpack (msgpack client)": []}
+    body, cpu = timed(lambda: json_provider.dumps({"result": [dict(zip(columns, row)) for row in rows]}))
+    report["json"].append(("worker", cpu, len(body)))
+    for tier in ["proxy", "trusted_host", "gatekeeper"]:
+        body, cpu = timed(lambda: json_provider.dumps(dict(json_provider.loads(body), source="worker")))
+        report["json"].append((tier, cpu, len(body)))
+
+    # Columnar MessagePack: encoded once, forwarded as bytes, converted to JSON at the gatekeeper if asked for
+    packed, cpu = timed(lambda: codec.encode_columnar(columns, rows, json_provider.default))
+    for name in ["msgpack (JSON client)", "msgpack (msgpack client)"]:
+        report[name].append(("worker", cpu, len(packed)))
+        report[name] += [("proxy", 0.0, len(packed)), ("trusted_host", 0.0, len(packed))]
+    body, cpu = timed(lambda: json_provider.dumps(dict(codec.decode_columnar(packed), source="worker")))
+    report["msgpack (JSON client)"].append(("gatekeeper", cpu, len(body)))
+    report["msgpack (msgpack client)"].append(("gatekeeper", 0.0, len(packed)))
+
+    print(f"{num_rows} rows, CPU time and bytes sent per hop:")
+    for name, hops in report.items():
+        print(f"{name}:")
+        for tier, cpu, size in hops:
+            print(f"  {tier}: {cpu:.1f} ms CPU, {size} bytes sent")
+        print(f"  total: {sum(cpu for _, cpu, _ in hops):.1f} ms CPU, "
+              f"{sum(size for _, _, size in hops)} bytes on the wire")
+
 def main():
     try:
         with open('gatekeeper_ip.txt', 'r') as file:
@@ -59,4 +443,40 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Benchmark the cloud database architecture")
+    subparsers = parser.add_subparsers(dest="mode")
+    subparsers.add_parser("serial", help="1000 INSERTs then 1000 SELECTs per strategy, one at a time (default)")
+    load_parser = subparsers.add_parser("load", help="Concurrent load with latency percentiles")
+    load_parser.add_argument("--concurrency", type=int, default=16)
+    load_parser.add_argument("--rate", type=float, default=0, help="Target requests per second, 0 for unlimited")
+    load_parser.add_argument("--duration", type=float, default=30, help="Seconds per strategy")
+    load_parser.add_argument("--write-ratio", type=float, default=0.1)
+    load_parser.add_argument("--strategies", nargs="+", default=strategies)
+    load_parser.add_argument("--parameterized", action="store_true", help="Send statement templates with parameters")
+    load_parser.add_argument("--output", default="load_results.json")
+    subparsers.add_parser("pool", help="MySQL connection pool latency, run on a database instance")
+    subparsers.add_parser("validator", help="Trusted host validator micro-benchmark")
+    subparsers.add_parser("encoding", help="JSON against columnar MessagePack, bytes and CPU per hop")
+    topology_parser = subparsers.add_parser("topology", help="Split tiers against the combined pipeline")
+    topology_parser.add_argument("--concurrency", type=int, default=16)
+    topology_parser.add_argument("--rate", type=float, default=0, help="Target requests per second, 0 for unlimited")
+    topology_parser.add_argument("--duration", type=float, default=30, help="Seconds per run")
+    topology_parser.add_argument("--rounds", type=int, default=3, help="Runs per topology, alternating")
+    topology_parser.add_argument("--write-ratio", type=float, default=0.1)
+    topology_parser.add_argument("--strategy", default="", help="Routing strategy of the reads")
+    topology_parser.add_argument("--parameterized", action="store_true", help="Send statement templates with parameters")
+    topology_parser.add_argument("--output", default="topology_results.json")
+    args = parser.parse_args()
+
+    if args.mode == "load":
+        benchmark_load(args)
+    elif args.mode == "pool":
+        benchmark_pool()
+    elif args.mode == "validator":
+        benchmark_validator()
+    elif args.mode == "encoding":
+        benchmark_encoding()
+    elif args.mode == "topology":
+        benchmark_topology(args)
+    else:
+        main()
@@ -0,0 +1,271 @@
+import gzip
+import os
+import time
+import zlib
+import metrics
+
+try:
+    import msgpack
+except ImportError:
+    # Without msgpack the tiers keep exchanging JSON
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    # Without zstandard only gzip is negotiated
+    zstandard = None
+
+# Columnar SELECT results: {"columns": [...], "rows": [[...], ...]} serialized with MessagePack
+MSGPACK_MIMETYPE = "application/x-msgpack"
+
+available = msgpack is not None
+
+# Compression configuration, bodies below the threshold are sent as they are
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", 2048))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 5))
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", 3))
+
+# Encodings this tier can produce and read, in order of preference
+ENCODINGS = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+COMPRESSION_RATIO = metrics.REGISTRY.histogram("compression_ratio", "Compressed size divided by the original size",
+                                               ("encoding",), buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.7, 0.9, 1))
+COMPRESSION_CPU = metrics.REGISTRY.histogram("compression_cpu_seconds", "CPU time to compress or decompress a body",
+                                             ("encoding", "operation"),
+                                             buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+COMPRESSION_BYTES = metrics.REGISTRY.counter("compression_bytes", "Bytes before and after compression",
+                                             ("encoding", "stage"))
+
+
+def accepts_msgpack(accept):
+    """
+    Function to check whether a client negotiated the compact encoding
+    Args:
+        accept: Accept header of the request, None if missing
+    Returns:
+        True if MessagePack is available and accepted
+    """
+    return available and accept is not None and MSGPACK_MIMETYPE in accept
+
+
+def encode_columnar(columns, rows, default):
+    """
+    Function to serialize a result with the column names once and the rows as arrays
+    Args:
+        columns: Column names
+        rows: List of row tuples
+        default: Function converting values MessagePack cannot serialize, e.g. datetime and Decimal
+    Returns:
+        MessagePack bytes
+    """
+    return msgpack.packb({"columns": list(columns), "rows": rows}, default=default, use_bin_type=True)
+
+
+def decode_columnar(body):
+    """
+    Function to convert a columnar result back into the JSON layout of one dictionary per row
+    Args:
+        body: MessagePack bytes
+    Returns:
+        Response dictionary
+    """
+    data = msgpack.unpackb(body, raw=False)
+    columns = data["columns"]
+    rows = [[value.decode("utf-8", "replace") if isinstance(value, bytes) else value for value in row]
+            for row in data["rows"]]
+    return {"result": [dict(zip(columns, row)) for row in rows]}
+
+
+def accept_encoding_header():
+    """
+    Returns:
+        Accept-Encoding value listing the encodings this tier can read
+    """
+    return ", ".join(ENCODINGS)
+
+
+def accepted_encodings(accept_encoding):
+    """
+    Function to parse an Accept-Encoding header
+    Args:
+        accept_encoding: Accept-Encoding header of the request, None if missing
+    Returns:
+        Set of accepted encodings, the ones with q=0 are left out
+    """
+    accepted = set()
+    for entry in (accept_encoding or "").split(","):
+        name, _, parameters = entry.strip().partition(";")
+        if parameters.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def choose_encoding(accept_encoding):
+    """
+    Function to pick the preferred encoding both sides support
+    Args:
+        accept_encoding: Accept-Encoding header of the request, None if missing
+    Returns:
+        Encoding name, None to send the body as it is
+    """
+    accepted = accepted_encodings(accept_encoding)
+    return next((encoding for encoding in ENCODINGS if encoding in accepted), None)
+
+
+def compress(body, encoding):
+    """
+    Function to compress a body and record ratio and CPU time in the metrics
+    Args:
+        body: Bytes to compress
+        encoding: zstd or gzip
+    Returns:
+        Compressed bytes
+    """
+    start_time = time.thread_time()
+    if encoding == "zstd":
+        compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    else:
+        compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    COMPRESSION_CPU.labels(encoding, "compress").observe(time.thread_time() - start_time)
+    COMPRESSION_RATIO.labels(encoding).observe(len(compressed) / len(body) if body else 1)
+    COMPRESSION_BYTES.labels(encoding, "original").inc(len(body))
+    COMPRESSION_BYTES.labels(encoding, "compressed").inc(len(compressed))
+    return compressed
+
+
+def decompress(body, encoding):
+    """
+    Function to restore a compressed body
+    Args:
+        body: Compressed bytes
+        encoding: Content-Encoding of the body, None if it is not compressed
+    Returns:
+        Original bytes
+    """
+    if not encoding or encoding == "identity":
+        return body
+    start_time = time.thread_time()
+    if encoding == "zstd":
+        # The frame may not carry the content size, read it as a stream
+        with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+            original = reader.read()
+    elif encoding == "gzip":
+        original = gzip.decompress(body)
+    else:
+        raise ValueError(f"Unsupported Content-Encoding {encoding}")
+    COMPRESSION_CPU.labels(encoding, "decompress").observe(time.thread_time() - start_time)
+    return original
+
+
+def compress_stream(chunks, encoding):
+    """
+    Function to compress a streamed body. Every chunk is flushed, so the rows reach the client as they come
+    Args:
+        chunks: Iterable of text or bytes chunks
+        encoding: zstd or gzip
+    Returns:
+        Generator of compressed chunks
+    """
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    else:
+        # wbits 31 writes the gzip header and trailer
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        flush_mode = zlib.Z_SYNC_FLUSH
+    original = compressed = 0
+    cpu_time = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if not chunk:
+                continue
+            start_time = time.thread_time()
+            data = compressor.compress(chunk) + compressor.flush(flush_mode)
+            cpu_time += time.thread_time() - start_time
+            original += len(chunk)
+            compressed += len(data)
+            yield data
+        data = compressor.flush()
+        compressed += len(data)
+        yield data
+    finally:
+        # Closing the stream early closes the upstream one too, e.g. to release its database connection
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+        COMPRESSION_CPU.labels(encoding, "compress").observe(cpu_time)
+        COMPRESSION_RATIO.labels(encoding).observe(compressed / original if original else 1)
+        COMPRESSION_BYTES.labels(encoding, "original").inc(original)
+        COMPRESSION_BYTES.labels(encoding, "compressed").inc(compressed)
+
+
+def decompress_stream(chunks, encoding):
+    """
+    Function to restore a compressed streamed body chunk by chunk
+    Args:
+        chunks: Iterable of compressed chunks
+        encoding: Content-Encoding of the body
+    Returns:
+        Generator of original chunks
+    """
+    if encoding == "zstd":
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    elif encoding == "gzip":
+        decompressor = zlib.decompressobj(31)
+    else:
+        raise ValueError(f"Unsupported Content-Encoding {encoding}")
+    try:
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def recode_stream(chunks, encoding, accept_encoding):
+    """
+    Function to pass a streamed body on in an encoding the client reads
+    Args:
+        chunks: Iterable of body chunks
+        encoding: Content-Encoding of the chunks, None if they are not compressed
+        accept_encoding: Accept-Encoding header of the client
+    Returns:
+        Iterable of chunks and their Content-Encoding, None if they are not compressed
+    """
+    if encoding == "identity":
+        encoding = None
+    if encoding is not None and encoding in accepted_encodings(accept_encoding):
+        return chunks, encoding
+    target = choose_encoding(accept_encoding)
+    if encoding is None and target is None:
+        return chunks, None
+    if encoding is not None:
+        chunks = decompress_stream(chunks, encoding)
+    return (chunks, None) if target is None else (compress_stream(chunks, target), target)
+
+
+def compress_response(response, accept_encoding):
+    """
+    Function to compress a Flask response in place if the client accepts an encoding and the body
+    is above the threshold. Streamed and already encoded responses are left alone, see compress_stream
+    Args:
+        response: Flask Response
+        accept_encoding: Accept-Encoding header of the request
+    Returns:
+        The response
+    """
+    if response.is_streamed or response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None or response.content_length is None or response.content_length < COMPRESSION_MIN_BYTES:
+        return response
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -1,7 +1,14 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import requests
+import http_client
+import metrics
+import codec
+import admission
 
 app = Flask(__name__)
+metrics.instrument(app, "gatekeeper")
+# Rate limits and bounded concurrency, requests over them are rejected before anything is forwarded
+admission.install(app, ("/start", "/batch"))
 
 # Get the IP of trusted host
 try:
@@ -10,26 +17,119 @@ try:
 except FileNotFoundError:
     print("No files found.")
 
-@app.route('/start', methods=['POST'])
-def execute_query():
-    # Get the query
-    data = request.get_json()
+# Keep-alive session to the trusted host
+session = http_client.create_session()
+
+# Maximum number of queries in one batch
+MAX_BATCH_SIZE = 100
+
+@app.after_request
+def compress_client_response(response):
+    # Large responses are compressed for clients sending Accept-Encoding, passed through ones already are
+    return codec.compress_response(response, request.headers.get("Accept-Encoding"))
+
+def check_query(data):
+    """
+    Function to check a client request and build the request for the trusted host
+    Args:
+        data: Request body with query, params, strategy and stream, paginated SELECTs with page_size and cursor
+    Returns:
+        Payload for the trusted host and None, or None and the error message
+    """
     query = data.get("query")
-    routing_strategy = data.get("strategy", "round-robin")
-    modified_data = {"Authorization": True, "query": query, "strategy": routing_strategy}
 
     # If query is empty, return
     if not query:
-        return jsonify({"error": "No query provided"}), 400
+        return None, "No query provided"
+    return {"Authorization": True, "query": query, "params": data.get("params"),
+            "strategy": data.get("strategy", "round-robin"), "stream": bool(data.get("stream", False)),
+            "page_size": data.get("page_size"), "cursor": data.get("cursor")}, None
+
+
+def check_batch(queries):
+    """
+    Function to check the queries of a client batch
+    Args:
+        queries: Value of queries in the request body
+    Returns:
+        List with the error result of every empty query and None for the ones to forward,
+        or None and the error message if the whole batch is rejected
+    """
+    if not isinstance(queries, list) or not queries:
+        return None, "No queries provided"
+    if len(queries) > MAX_BATCH_SIZE:
+        return None, f"Batch larger than {MAX_BATCH_SIZE} queries"
+
+    # Empty queries fail on their own, the rest is forwarded in one request
+    return [None if query and isinstance(query, str) else {"status": 400, "error": "No query provided"}
+            for query in queries], None
+
+
+@app.route('/start', methods=['POST'])
+def execute_query():
+    # Get the query
+    data = request.get_json()
+    modified_data, error = check_query(data)
+    if modified_data is None:
+        return jsonify({"error": error}), 400
+    stream = modified_data["stream"]
 
     try:
-        # Forward query
-        response = requests.post(f"http://{trusted_host_ip}:5000/validate", json=modified_data)
+        # Forward query, the internal tiers exchange SELECT results in the compact encoding when available
+        headers = metrics.trace_headers()
+        headers["Accept-Encoding"] = codec.accept_encoding_header()
+        if codec.available:
+            headers["Accept"] = f"{codec.MSGPACK_MIMETYPE}, application/json"
+        response = session.post(f"http://{trusted_host_ip}:5000/validate", json=modified_data, stream=True,
+                                headers=headers)
+        metrics.forward_timing(response)
+        if stream:
+            # Pass the NDJSON rows through without decoding them, recompressed only if the client cannot read them
+            headers = http_client.forward_headers(response)
+            chunks, encoding = codec.recode_stream(http_client.iter_stream(response),
+                                                   headers.pop("Content-Encoding", None),
+                                                   request.headers.get("Accept-Encoding"))
+            if encoding is not None:
+                headers["Content-Encoding"] = encoding
+            return Response(chunks, status=response.status_code, headers=headers)
+        if http_client.is_opaque(response):
+            body = http_client.read_body(response)
+            encoding = response.headers.get("Content-Encoding")
+            if codec.accepts_msgpack(request.headers.get("Accept")):
+                headers = http_client.forward_headers(response)
+                if encoding and encoding not in codec.accepted_encodings(request.headers.get("Accept-Encoding")):
+                    # The client cannot read the encoding, compress_client_response picks another one
+                    body = codec.decompress(body, headers.pop("Content-Encoding"))
+                return Response(body, status=response.status_code, headers=headers)
+            # Convert to JSON only here at the edge
+            response_data = codec.decode_columnar(codec.decompress(body, encoding))
+            return jsonify(dict(response_data, source=response.headers.get("X-Source"))), response.status_code
         return jsonify(response.json()), response.status_code
 
     except requests.exceptions.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/batch', methods=['POST'])
+def execute_batch():
+    # Get the queries
+    data = request.get_json()
+    queries = data.get("queries")
+    results, error = check_batch(queries)
+    if results is None:
+        return jsonify({"error": error}), 400
+
+    results = http_client.forward_batch(session, f"http://{trusted_host_ip}:5000/validate/batch",
+                                        {"Authorization": True, "strategy": data.get("strategy", "round-robin")},
+                                        queries, results)
+    return jsonify({"results": results}), 200
+
+
+@app.route('/connections', methods=['GET'])
+def connection_stats():
+    # Connection reuse statistics of the upstream session
+    return jsonify(http_client.get_stats(session)), 200
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
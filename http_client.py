@@ -0,0 +1,212 @@
+import requests
+import urllib3
+import os
+import time
+import metrics
+from flask import has_request_context, request
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Keep-alive connection pool configuration
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 20))
+# Upstream hosts whose pools are kept, beyond it the least recently used pool and its connections are dropped.
+# The proxy talks to every manager and replica of every group
+HTTP_POOL_HOSTS = int(os.environ.get("HTTP_POOL_HOSTS", 64))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 2))
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", 0.05))
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """
+    HTTPAdapter recording count, status and latency of every request per upstream into the metrics
+    """
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        start_time = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.observe_upstream(url.netloc, url.path, None, time.perf_counter() - start_time)
+            raise
+        metrics.observe_upstream(url.netloc, url.path, response.status_code, time.perf_counter() - start_time)
+        return response
+
+
+def create_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=HTTP_RETRY_BACKOFF,
+                   pool_hosts=HTTP_POOL_HOSTS):
+    """
+    Function to create a shared keep-alive HTTP session
+    Args:
+        pool_size: Number of kept-alive connections per upstream host
+        retries: Number of retries when the connection to the upstream cannot be established
+        backoff: Backoff factor between retries in seconds
+        pool_hosts: Number of upstream hosts whose connection pools are kept
+    Returns:
+        requests Session
+    """
+    # Only connection errors are retried, the request was not sent yet so POST is safe to repeat
+    retry = Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=backoff,
+                  raise_on_status=False)
+    adapter = InstrumentedAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_stats(session):
+    """
+    Function to collect connection reuse statistics of a session
+    Args:
+        session: requests Session created by create_session
+    Returns:
+        Dictionary of statistics per upstream
+    """
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                # Pool was evicted in the meantime
+                continue
+            stats[f"{pool.host}:{pool.port}"] = {
+                "requests": pool.num_requests,
+                "connections_opened": pool.num_connections,
+                "connections_reused": max(pool.num_requests - pool.num_connections, 0),
+                "idle_connections": sum(1 for conn in list(pool.pool.queue) if conn) if pool.pool else 0,
+            }
+    return stats
+
+
+def iter_stream(response):
+    """
+    Function to pass a streamed upstream body through without parsing it
+    Args:
+        response: requests Response opened with stream=True
+    Returns:
+        Generator of raw body chunks
+    """
+    try:
+        # Raw bytes, a compressed body stays compressed
+        for chunk in response.raw.stream(None, decode_content=False):
+            yield chunk
+    finally:
+        # Hand the connection back to the pool, also when the client disconnects
+        response.close()
+
+
+def forward_headers(response):
+    """
+    Function to select the upstream headers forwarded to the client
+    Args:
+        response: requests Response
+    Returns:
+        Dictionary of headers
+    """
+    return {name: response.headers[name] for name in ("Content-Type", "Content-Encoding", "X-Source")
+            if name in response.headers}
+
+
+def upstream_headers():
+    """
+    Function to build the headers passed upstream: the request ID and the formats and compression
+    the client accepts.
+    Has to be called in the request thread, the result can be handed to other threads
+    Returns:
+        Dictionary of headers
+    """
+    headers = metrics.trace_headers()
+    if has_request_context():
+        if "Accept" in request.headers:
+            headers["Accept"] = request.headers["Accept"]
+        # Without the client's Accept-Encoding nothing may come back compressed, opaque bodies are not decoded
+        headers["Accept-Encoding"] = request.headers.get("Accept-Encoding", "identity")
+    return headers
+
+
+def is_opaque(response):
+    """
+    Function to check whether an upstream body is forwarded as bytes without decoding it.
+    Everything but JSON is, e.g. columnar MessagePack results
+    Args:
+        response: requests Response
+    Returns:
+        True if the body is not JSON
+    """
+    return not response.headers.get("Content-Type", "application/json").startswith("application/json")
+
+
+def read_body(response):
+    """
+    Function to read the body of a response opened with stream=True, which releases the connection.
+    Opaque bodies are kept as sent, a compressed one is not decompressed. Reading again returns the same bytes
+    Args:
+        response: requests Response
+    Returns:
+        Body bytes
+    """
+    if not is_opaque(response):
+        return response.content
+    if getattr(response, "opaque_body", None) is None:
+        try:
+            response.opaque_body = response.raw.read(decode_content=False)
+        except urllib3.exceptions.HTTPError as e:
+            # Raised like the errors of response.content
+            raise requests.exceptions.ConnectionError(e)
+        finally:
+            response.close()
+    return response.opaque_body
+
+
+def get_batch_error(queries):
+    """
+    Function to check the query list of a batch request
+    Args:
+        queries: Value of queries in the request body
+    Returns:
+        Error message naming the first bad item, None if every item is a query
+    """
+    if not isinstance(queries, list):
+        return "The queries of a batch must be a list"
+    for i, query in enumerate(queries):
+        if not isinstance(query, str) or not query:
+            return f"Query {i} of the batch is not a non-empty string"
+    return None
+
+
+def forward_batch(session, url, data, queries, results):
+    """
+    Function to forward the batch items that have no result yet and merge the upstream results back in order
+    Args:
+        session: requests Session
+        url: Upstream batch URL
+        data: Payload fields besides the queries
+        queries: All queries of the batch
+        results: Result per item, None for the items to forward
+    Returns:
+        List of results
+    """
+    indices = [i for i, result in enumerate(results) if result is None]
+    if not indices:
+        return results
+
+    try:
+        response = session.post(url, json=dict(data, queries=[queries[i] for i in indices]),
+                                headers=upstream_headers())
+        metrics.forward_timing(response)
+        response_data = response.json()
+        if response.status_code == 200 and len(response_data.get("results", [])) == len(indices):
+            for i, result in zip(indices, response_data["results"]):
+                results[i] = result
+        else:
+            # The whole upstream batch failed
+            for i in indices:
+                results[i] = {"status": response.status_code, "error": response_data.get("error", "Batch failed")}
+    except (requests.exceptions.RequestException, ValueError) as e:
+        for i in indices:
+            results[i] = {"status": 500, "error": str(e)}
+    return results
@@ -2,7 +2,11 @@ import boto3, json
 import sys, os, time
 from botocore.exceptions import ClientError
 from scp import SCPClient
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import paramiko
+import sharding
 
 def get_key_pair(ec2_client):
     """
@@ -173,21 +177,188 @@ def get_subnet(ec2_client, vpc_id):
         print(f"Error retrieving subnets: {e}")
         sys.exit(1)
 
-def launch_workers(ec2_client, image_id, instance_type, key_name, security_group_id,
-                   subnet_id, num_of_instance, manager_ip, log_file, log_pos):
+# Readiness polling configuration
+READINESS_TIMEOUT = 1800
+READINESS_INTERVAL = 5
+# Number of read replicas
+NUM_WORKERS = int(os.environ.get("NUM_WORKERS", 2))
+# Also serve gatekeeper, trusted host and proxy as one process on port 5001 of the gatekeeper instance,
+# next to the split tiers on port 5000, e.g. to compare both with benchmark.py topology
+PIPELINE_ENABLED = os.environ.get("PIPELINE_ENABLED", "0") == "1"
+# Number of manager and replica groups the tables are sharded over, each with NUM_WORKERS replicas
+NUM_SHARDS = int(os.environ.get("NUM_SHARDS", 1))
+# Placement of the tables when NUM_SHARDS > 1, see sharding.ShardMap. Other tables are copied to every group
+SHARD_TABLES = json.loads(os.environ.get("SHARD_TABLES", '{"actor": {"key": "actor_id"}}'))
+
+Instance = namedtuple("Instance", ["name", "id", "public_ip_address", "private_ip_address"])
+
+
+class PhaseTimer:
+    """
+    Collects the duration of each provisioning phase
+    """
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        print(f"--- {name} ---")
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start_time))
+
+    def report(self):
+        print("Provisioning time per phase:")
+        for name, elapsed in self.phases:
+            print(f"  {name}: {elapsed:.1f} s")
+        print(f"  total: {sum(elapsed for _, elapsed in self.phases):.1f} s")
+
+
+class RemoteShell:
+    """
+    SSH access to the instances. Provisioning only uses run, put and get,
+    so a stand-in with the same methods can replace it
+    Args:
+        key_file: Key file path
+    """
+    def __init__(self, key_file):
+        self.key_file = key_file
+
+    def _connect(self, instance):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(instance.public_ip_address, username='ubuntu', key_filename=self.key_file, timeout=10)
+        return ssh
+
+    def run(self, instance, command):
+        """
+        Run a command on the instance
+        Returns:
+            Exit status and output
+        """
+        ssh = self._connect(instance)
+        try:
+            _, stdout, _ = ssh.exec_command(command)
+            output = stdout.read().decode()
+            return stdout.channel.recv_exit_status(), output
+        finally:
+            ssh.close()
+
+    def put(self, instance, files):
+        """
+        Copy local files to the home directory of the instance
+        """
+        ssh = self._connect(instance)
+        try:
+            scp = paramiko.SFTPClient.from_transport(ssh.get_transport())
+            for file in files:
+                scp.put(f'{file}', f'/home/ubuntu/{file}')
+            scp.close()
+        finally:
+            ssh.close()
+
+
+def wait_for(shell, instance, command, description, timeout=None, interval=None):
     """
-    Launches EC2 worker instance.
+    Function to poll a command on the instance until it succeeds
+    Args:
+        shell: RemoteShell
+        instance: Instance object
+        command: Shell command signalling readiness by its exit status
+        description: Name of the readiness signal
+        timeout: Seconds before giving up, READINESS_TIMEOUT by default
+        interval: Seconds between attempts, READINESS_INTERVAL by default
+    Returns:
+        Output of the successful command
+    """
+    timeout = READINESS_TIMEOUT if timeout is None else timeout
+    interval = READINESS_INTERVAL if interval is None else interval
+    deadline = time.time() + timeout
+    while True:
+        try:
+            status, output = shell.run(instance, command)
+            if status == 0:
+                print(f"{instance.name}: {description}")
+                return output
+        except (paramiko.SSHException, OSError, EOFError):
+            # SSH is not up yet
+            pass
+        if time.time() > deadline:
+            raise TimeoutError(f"{instance.name} not ready after {timeout} s: {description}")
+        time.sleep(interval)
+
+
+def run_parallel(function, arguments):
+    """
+    Function to call a function concurrently for each argument tuple
+    Args:
+        function: Function to call
+        arguments: List of argument tuples
+    Returns:
+        List of results in the order of the arguments
+    """
+    with ThreadPoolExecutor(max_workers=max(len(arguments), 1)) as executor:
+        futures = [executor.submit(function, *args) for args in arguments]
+        return [future.result() for future in futures]
+
+
+def launch_instance(ec2_client, name, image_id, instance_type, key_name, security_group_id, subnet_id,
+                    user_data_script):
+    """
+    Launches EC2 instance and waits until it is running.
     Args:
         ec2_client: The EC2 client.
+        name: Name of the instance in the logs.
         image_id: The AMI ID for the instance.
         instance_type: The type of instance (e.g., 't2.micro').
         key_name: The key pair name to use for SSH access.
         security_group_id: The security group ID.
         subnet_id: The subnet ID.
-        num_of_instance: The number of slave instances to launch.
-        manager_ip: The IP address of the manager server.
-        log_file: The log file name.
-        log_pos: The log file position.
+        user_data_script: Script run on the first boot.
+    Returns:
+        Instance
+    """
+    response = ec2_client.run_instances(
+        ImageId=image_id,
+        MinCount=1,
+        MaxCount=1,
+        InstanceType=instance_type,
+        KeyName=key_name,
+        SecurityGroupIds=[security_group_id],
+        SubnetId=subnet_id,
+        UserData=user_data_script,
+        TagSpecifications=[
+            {
+                'ResourceType': 'instance',
+                'Tags': [
+                    {
+                        'Key': 'Name',
+                        'Value': 'LabInstance'
+                    }
+                ]
+            }
+        ]
+    )
+    instance_id = response['Instances'][0]['InstanceId']
+
+    # Wait for the instance to be in "running" state and collect instance details
+    ec2_client.get_waiter('instance_running').wait(InstanceIds=[instance_id])
+    description = ec2_client.describe_instances(InstanceIds=[instance_id])['Reservations'][0]['Instances'][0]
+    return Instance(name, instance_id, description.get('PublicIpAddress'), description.get('PrivateIpAddress'))
+
+def launch_workers(ec2_client, image_id, instance_type, key_name, security_group_id, subnet_id, worker_number):
+    """
+    Launches EC2 worker instance. Replication is configured later by configure_replication.
+    Args:
+        ec2_client: The EC2 client.
+        image_id: The AMI ID for the instance.
+        instance_type: The type of instance (e.g., 't2.micro').
+        key_name: The key pair name to use for SSH access.
+        security_group_id: The security group ID.
+        subnet_id: The subnet ID.
+        worker_number: Index of the worker, used for its unique MySQL server id.
     Returns:
         worker instance
     """
@@ -201,77 +372,43 @@ def launch_workers(ec2_client, image_id, instance_type, key_name, security_group
                             echo "source venv/bin/activate" >> /home/ubuntu/.bashrc
                             source venv/bin/activate
                             
-                            pip3 install flask requests redis
+                            pip3 install flask requests redis msgpack zstandard gunicorn
                             sudo chown -R ubuntu:ubuntu /home/ubuntu/venv
                             pip install mysql-connector-python
                             
                             sudo sed -i '/server-id/d' /etc/mysql/mysql.conf.d/mysqld.cnf
-                            echo "server-id={num_of_instance + 2}" | sudo tee -a /etc/mysql/mysql.conf.d/mysqld.cnf
+                            echo "server-id={worker_number + 2}" | sudo tee -a /etc/mysql/mysql.conf.d/mysqld.cnf
                             sudo sed -i "s/bind-address\s*=.*/bind-address = 0.0.0.0/" /etc/mysql/mysql.conf.d/mysqld.cnf
                             sudo systemctl restart mysql
                             sudo mysql -e "
                             CREATE USER 'replica'@'%' IDENTIFIED WITH mysql_native_password BY 'replica_password';
                             GRANT SELECT ON sakila.* TO 'replica'@'%';
+                            GRANT REPLICATION CLIENT ON *.* TO 'replica'@'%';
                             FLUSH PRIVILEGES;
-
-                            CHANGE MASTER TO
-                                MASTER_HOST = '{manager_ip}', 
-                                MASTER_USER = 'replica', 
-                                MASTER_PASSWORD = 'replica_password', 
-                                MASTER_LOG_FILE = '{log_file}', 
-                                MASTER_LOG_POS = {log_pos};
-                            START SLAVE;
                             "
+
+                            # Signal that MySQL is ready for the replication setup
+                            touch /home/ubuntu/mysql_ready
                             
                             # Wait for the worker_manager_app.py file to be transferred
                             while [ ! -f /home/ubuntu/worker_manager_app.py ]; do
                                 sleep 5
                             done
 
-                            python3 worker_manager_app.py
+                            nohup python3 serve.py worker > worker_manager_app.log 2>&1 &
                             '''
 
     try:
-        response = ec2_client.run_instances(
-            ImageId=image_id,
-            MinCount=1,
-            MaxCount=1,
-            InstanceType=instance_type,
-            KeyName=key_name,
-            SecurityGroupIds=[security_group_id],
-            SubnetId=subnet_id,
-            UserData=user_data_script,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': 'LabInstance'
-                        }
-                    ]
-                }
-            ]
-        )
-
-        ec2_resource = boto3.resource('ec2')
-
-        instance_objects = [ec2_resource.Instance(instance['InstanceId']) for instance in response['Instances']]
-        worker = instance_objects[0]
-
-        # Wait for all instances to be in "running" state and collect instance details
-        for instance in instance_objects:
-            instance.wait_until_running()
-            instance.reload()  # Reload instance attributes to get updated info
-            print(f"Worker instance IP: {instance.public_ip_address}   ID: {instance.id}")
-
+        worker = launch_instance(ec2_client, f"worker{worker_number}", image_id, instance_type, key_name,
+                                 security_group_id, subnet_id, user_data_script)
+        print(f"Worker instance IP: {worker.public_ip_address}   ID: {worker.id}")
         return worker
 
     except ClientError as e:
         print(f"Error launching instances: {e}")
         sys.exit(1)
 
-def launch_manager(ec2_client, image_id, instance_type, key_name, security_group_id, subnet_id):
+def launch_manager(ec2_client, image_id, instance_type, key_name, security_group_id, subnet_id, shard=0):
     """
     Launches EC2 manager instance.
     Args:
@@ -281,16 +418,20 @@ def launch_manager(ec2_client, image_id, instance_type, key_name, security_group
         key_name: The key pair name to use for SSH access.
         security_group_id: The security group ID.
         subnet_id: The subnet ID.
+        shard: Replication group of the manager, 0 for the one of manager_ip.txt.
     Returns:
         Manager instance
     """
-    user_data_script = '''#!/bin/bash 
+    user_data_script = f'''#!/bin/bash 
                                 # Update and install MySQL
                                 sudo apt update -y
                                 sudo apt install mysql-server -y
 
                                 # Configure MySQL as a replication source
-                                sudo sed -i '/\[mysqld\]/a server-id=1\nlog_bin=/var/log/mysql/mysql-bin.log' /etc/mysql/mysql.conf.d/mysqld.cnf
+                                sudo sed -i '/\[mysqld\]/a server-id=1\\nlog_bin=/var/log/mysql/mysql-bin.log' /etc/mysql/mysql.conf.d/mysqld.cnf
+                                # Interleaved AUTO_INCREMENT values, the rows of the groups never get the same id and a generated id
+                                # is one sharding.ShardMap places on this group
+                                sudo sed -i '/\[mysqld\]/a auto_increment_increment={NUM_SHARDS}\\nauto_increment_offset={shard + 1}' /etc/mysql/mysql.conf.d/mysqld.cnf
                             sudo sed -i "s/bind-address\s*=.*/bind-address = 0.0.0.0/" /etc/mysql/mysql.conf.d/mysqld.cnf
 
                                 # Restart MySQL to apply changes
@@ -303,13 +444,14 @@ def launch_manager(ec2_client, image_id, instance_type, key_name, security_group
                                 GRANT REPLICATION SLAVE ON *.* TO 'replica'@'%';
                                 GRANT ALL PRIVILEGES ON sakila.* TO 'replica'@'%';
                                 GRANT ALL PRIVILEGES ON sakila.* TO 'replica'@'localhost';
+                                GRANT REPLICATION CLIENT ON *.* TO 'replica'@'localhost';
                                 FLUSH PRIVILEGES;
                                 "
                                 
-                                # Save the replication status log file and position for workers
-                                sudo mysql -e "SHOW MASTER STATUS\G" | tee /home/ubuntu/master_status.txt
-                                
-                                sleep 180
+                                # Save the replication status log file and position for workers.
+                                # Workers replay the binary log from here, including the Sakila import below
+                                sudo mysql -e "SHOW MASTER STATUS\G" > /home/ubuntu/master_status.tmp
+                                mv /home/ubuntu/master_status.tmp /home/ubuntu/master_status.txt
 
                                 # Download and install the Sakila database
                                 wget https://downloads.mysql.com/docs/sakila-db.tar.gz
@@ -323,7 +465,7 @@ def launch_manager(ec2_client, image_id, instance_type, key_name, security_group
                                 echo "source venv/bin/activate" >> /home/ubuntu/.bashrc
                                 source venv/bin/activate
                                 
-                                pip3 install flask requests redis
+                                pip3 install flask requests redis msgpack zstandard gunicorn
                                 sudo chown -R ubuntu:ubuntu /home/ubuntu/venv
                                 pip install mysql-connector-python
                                 
@@ -331,47 +473,17 @@ def launch_manager(ec2_client, image_id, instance_type, key_name, security_group
                             while [ ! -f /home/ubuntu/worker_manager_app.py ]; do
                                 sleep 5
                             done
-                            python3 -m venv venv
-                            echo "source venv/bin/activate" >> /home/ubuntu/.bashrc
-                            source venv/bin/activate
-                            python3 worker_manager_app.py
+                            nohup python3 serve.py manager > worker_manager_app.log 2>&1 &
                                 '''
 
     try:
-        response = ec2_client.run_instances(
-            ImageId=image_id,
-            MinCount=1,
-            MaxCount=1,
-            InstanceType=instance_type,
-            KeyName=key_name,
-            SecurityGroupIds=[security_group_id],
-            SubnetId=subnet_id,
-            UserData=user_data_script,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': 'LabInstance'
-                        }
-                    ]
-                }
-            ]
-        )
-
-        ec2_resource = boto3.resource('ec2')
-
-        # Retrieve instance objects using the InstanceId
-        manager_list = [ec2_resource.Instance(instance['InstanceId']) for instance in response['Instances']]
-        manager = manager_list[0]
-
-        manager.wait_until_running()
-        manager.reload()
+        manager = launch_instance(ec2_client, "manager" if shard == 0 else f"manager{shard}", image_id, instance_type,
+                                  key_name, security_group_id, subnet_id, user_data_script)
 
         print(f"Manager launched IP: {manager.public_ip_address }   ID: {manager.id}")
-        with open('manager_ip.txt', 'w') as file:
-            file.write(manager.private_ip_address )
+        if shard == 0:
+            with open('manager_ip.txt', 'w') as file:
+                file.write(manager.private_ip_address )
 
         return manager
 
@@ -379,36 +491,114 @@ def launch_manager(ec2_client, image_id, instance_type, key_name, security_group
         print(f"Error launching instances: {e}")
         sys.exit(1)
 
-def transfer_master_status(manager, key_file):
+def transfer_master_status(shell, manager):
     """
-    Function to transport master status file for the replication process
+    Function to read the master status of the manager for the replication process, once it was written
     Args:
+        shell: RemoteShell
         manager: Manager instance
-        key_file: Key file path
     Returns:
         File and position arguments
     """
-    try:
-        time.sleep(120)
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(manager.public_ip_address, username='ubuntu', key_filename=key_file)
-        scp = paramiko.SFTPClient.from_transport(ssh.get_transport())
-        scp.get('/home/ubuntu/master_status.txt', 'master_status.txt')
-        scp.close()
-        ssh.close()
+    content = wait_for(shell, manager, "cat /home/ubuntu/master_status.txt", "master status written")
+    with open('master_status.txt', 'w') as f:
+        f.write(content)
 
-        with open('master_status.txt', 'r') as f:
-            content = f.read()
-        log_file = content.split("File: ")[1].split("\n")[0]
-        log_pos = content.split("Position: ")[1].split("\n")[0]
+    log_file = content.split("File: ")[1].split("\n")[0]
+    log_pos = content.split("Position: ")[1].split("\n")[0]
 
-        print(f"Retreived log_file: {log_file}, log_pos: {log_pos}")
-        return log_file, log_pos
+    print(f"Retreived log_file: {log_file}, log_pos: {log_pos}")
+    return log_file, log_pos
+
+def configure_replication(shell, worker, manager_ip, log_file, log_pos):
+    """
+    Function to start the replication from the manager on a worker, once its MySQL is ready
+    Args:
+        shell: RemoteShell
+        worker: Worker instance
+        manager_ip: The IP address of the manager server.
+        log_file: The log file name.
+        log_pos: The log file position.
+    """
+    wait_for(shell, worker, "test -f /home/ubuntu/mysql_ready && sudo mysqladmin ping", "MySQL up")
+    status, output = shell.run(worker, f'''sudo mysql -e "
+                            CHANGE MASTER TO
+                                MASTER_HOST = '{manager_ip}', 
+                                MASTER_USER = 'replica', 
+                                MASTER_PASSWORD = 'replica_password', 
+                                MASTER_LOG_FILE = '{log_file}', 
+                                MASTER_LOG_POS = {log_pos};
+                            START SLAVE;
+                            "''')
+    if status != 0:
+        raise RuntimeError(f"Replication setup failed on {worker.name}: {output}")
+    print(f"{worker.name}: replication started")
+
+def register_worker(shell, router, worker, shard=0, port=5000):
+    """
+    Function to add a ready worker to the routing of the proxy, waits until the proxy answers
+    Args:
+        shell: RemoteShell
+        router: Instance serving the proxy routes
+        worker: Worker instance
+        shard: Replication group of the worker
+        port: Port of the proxy routes on the router, 5001 for the pipeline of the gatekeeper
+    """
+    body = json.dumps({"ip": worker.private_ip_address, "shard": shard})
+    wait_for(shell, router, f"curl -sf -X POST -H 'Content-Type: application/json' -d '{body}' "
+                            f"http://127.0.0.1:{port}/workers/register", f"{worker.name} registered on port {port}")
+
+def prepare_worker(shell, worker, routers, manager_ip, log_file, log_pos, shard=0):
+    """
+    Function to start the replication on a worker and register it on the proxy once it serves queries
+    Args:
+        shell: RemoteShell
+        worker: Worker instance
+        routers: List of (instance, port) serving the proxy routes, the proxy and the pipeline if enabled
+        manager_ip: Private IP of the manager
+        log_file: Binary log file of the manager
+        log_pos: Binary log position of the manager
+        shard: Replication group of the worker
+    """
+    configure_replication(shell, worker, manager_ip, log_file, log_pos)
+    wait_for_service(shell, worker)
+    for router, port in routers:
+        register_worker(shell, router, worker, shard, port)
+
+
+def write_shard_map(managers, workers):
+    """
+    Function to write the shard map of the proxy
+    Args:
+        managers: Manager instance per group
+        workers: List of worker instances per group
+    """
+    with open('shard_map.json', 'w') as file:
+        json.dump({"groups": [{"manager": manager.private_ip_address,
+                               "workers": [worker.private_ip_address for worker in group_workers]}
+                              for manager, group_workers in zip(managers, workers)],
+                   "tables": SHARD_TABLES}, file, indent=2)
+
+
+def prune_group(shell, manager, group):
+    """
+    Function to delete the rows a group does not hold from the Sakila copy of its manager, once the import finished.
+    The replicas apply the deletes through the replication
+    Args:
+        shell: RemoteShell
+        manager: Manager instance of the group
+        group: Group index
+    """
+    wait_for(shell, manager, "cloud-init status --wait > /dev/null", "cloud-init finished")
+    statements = sharding.load_shard_map('shard_map.json').prune_statements(group)
+    if not statements:
+        return
+    # Rows of a sharded table may be referenced by rows kept on another group
+    status, output = shell.run(manager, f'sudo mysql -e "SET FOREIGN_KEY_CHECKS = 0; {"; ".join(statements)};"')
+    if status != 0:
+        raise RuntimeError(f"Pruning failed on {manager.name}: {output}")
+    print(f"{manager.name}: kept the rows of shard {group}")
 
-    except ClientError as e:
-        print(f"Error transfering file: {e}")
-        sys.exit(1)
 
 def launch_proxy(ec2_client, image_id, instance_type, key_name, security_group_id, subnet_id):
     """
@@ -431,7 +621,7 @@ def launch_proxy(ec2_client, image_id, instance_type, key_name, security_group_i
                             echo "source venv/bin/activate" >> /home/ubuntu/.bashrc
                             source venv/bin/activate
 
-                            pip3 install flask requests redis
+                            pip3 install flask requests redis msgpack zstandard gunicorn
                             pip3 install ping3
 
                             
@@ -441,7 +631,7 @@ def launch_proxy(ec2_client, image_id, instance_type, key_name, security_group_i
                                 sleep 1
                             done
                             
-                             Wait for the workers_ip.txt file to be transferred
+                            # Wait for the workers_ip.txt file to be transferred
                             while [ ! -f /home/ubuntu/workers_ip.txt ]; do
                                 sleep 1
                             done
@@ -451,39 +641,11 @@ def launch_proxy(ec2_client, image_id, instance_type, key_name, security_group_i
                                 sleep 5
                             done
 
-                            python3 proxy.py
+                            nohup python3 serve.py proxy > proxy.log 2>&1 &
                             '''
     try:
-        response = ec2_client.run_instances(
-            ImageId=image_id,
-            MinCount=1,
-            MaxCount=1,
-            InstanceType=instance_type,
-            KeyName=key_name,
-            SecurityGroupIds=[security_group_id],
-            SubnetId=subnet_id,
-            UserData=user_data_script,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': 'LabInstance'
-                        }
-                    ]
-                }
-            ]
-        )
-
-        ec2_resource = boto3.resource('ec2')
-
-        # Retrieve instance objects using the InstanceId
-        proxy_list = [ec2_resource.Instance(instance['InstanceId']) for instance in response['Instances']]
-        proxy = proxy_list[0]
-
-        proxy.wait_until_running()
-        proxy.reload()
+        proxy = launch_instance(ec2_client, "proxy", image_id, instance_type, key_name,
+                                security_group_id, subnet_id, user_data_script)
 
         print(f"Proxy launched IP: {proxy.public_ip_address}   ID: {proxy.id}")
         with open('proxy_ip.txt', 'w') as file:
@@ -494,27 +656,19 @@ def launch_proxy(ec2_client, image_id, instance_type, key_name, security_group_i
         print(f"Error launching instances: {e}")
         sys.exit(1)
 
-def transfer_files(instance, key_file, files_dict):
+def transfer_files(shell, instance, files_dict):
     """
-    Function to transport files to instances
+    Function to transport files to instances, once SSH accepts connections
     Args:
+        shell: RemoteShell
         instance: Instance object
-        key_file: Key file path
         files_dict: Dictionary of file paths
     """
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(instance.public_ip_address, username='ubuntu', key_filename=key_file)
-
-        scp = paramiko.SFTPClient.from_transport(ssh.get_transport())
+        wait_for(shell, instance, "true", "SSH up")
+        shell.put(instance, files_dict)
 
-        for file in files_dict:
-            scp.put(f'{file}', f'/home/ubuntu/{file}')
-        scp.close()
-        ssh.close()
-
-        print("Files transferred")
+        print(f"{instance.name}: files transferred")
 
     except Exception as e:
         print(f"Error transfering proxy file: {e}")
@@ -543,7 +697,7 @@ def launch_gatekeeper(ec2_client, image_id, instance_type, key_name, security_gr
                                     echo "source venv/bin/activate" >> /home/ubuntu/.bashrc
                                     source venv/bin/activate
 
-                                    pip3 install flask requests redis
+                                    pip3 install flask requests redis msgpack zstandard gunicorn
                                     sudo chown -R ubuntu:ubuntu /home/ubuntu/venv
 
                                 # Wait for the trusted_host_ip.txt file to be transferred
@@ -556,43 +710,21 @@ def launch_gatekeeper(ec2_client, image_id, instance_type, key_name, security_gr
                                     sleep 5
                                 done
                                 
-                                python3 -m venv venv
-                                echo "source venv/bin/activate" >> /home/ubuntu/.bashrc
-                                source venv/bin/activate
-                                python3 gatekeeper.py
+                                nohup python3 serve.py gatekeeper > gatekeeper.log 2>&1 &
                                     '''
+    if PIPELINE_ENABLED:
+        user_data_script += '''
+                                # Wait for the pipeline.py file to be transferred
+                                while [ ! -f /home/ubuntu/pipeline.py ]; do
+                                    sleep 5
+                                done
 
-    try:
-        response = ec2_client.run_instances(
-            ImageId=image_id,
-            MinCount=1,
-            MaxCount=1,
-            InstanceType=instance_type,
-            KeyName=key_name,
-            SecurityGroupIds=[security_group_id],
-            SubnetId=subnet_id,
-            UserData=user_data_script,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': 'LabInstance'
-                        }
-                    ]
-                }
-            ]
-        )
-
-        ec2_resource = boto3.resource('ec2')
-
-        # Retrieve instance objects using the InstanceId
-        gatekeeper_list = [ec2_resource.Instance(instance['InstanceId']) for instance in response['Instances']]
-        gatekeeper = gatekeeper_list[0]
+                                nohup python3 serve.py pipeline --bind 0.0.0.0:5001 > pipeline.log 2>&1 &
+                                    '''
 
-        gatekeeper.wait_until_running()
-        gatekeeper.reload()
+    try:
+        gatekeeper = launch_instance(ec2_client, "gatekeeper", image_id, instance_type, key_name,
+                                     security_group_id, subnet_id, user_data_script)
 
         print(f"Gatekeeper launched IP: {gatekeeper.public_ip_address}   ID: {gatekeeper.id}")
         with open('gatekeeper_ip.txt', 'w') as file:
@@ -626,7 +758,7 @@ def launch_trusted_host(ec2_client, image_id, instance_type, key_name, security_
                                         echo "source venv/bin/activate" >> /home/ubuntu/.bashrc
                                         source venv/bin/activate
 
-                                        pip3 install flask requests redis
+                                        pip3 install flask requests redis msgpack zstandard gunicorn
                                         sudo chown -R ubuntu:ubuntu /home/ubuntu/venv
 
                                     # Wait for the proxy_ip.txt file to be transferred
@@ -638,43 +770,12 @@ def launch_trusted_host(ec2_client, image_id, instance_type, key_name, security_
                                     while [ ! -f /home/ubuntu/trusted_host.py ]; do
                                         sleep 5
                                     done
-                                    python3 -m venv venv
-                                    echo "source venv/bin/activate" >> /home/ubuntu/.bashrc
-                                    source venv/bin/activate
-                                    python3 trusted_host.py
+                                    nohup python3 serve.py trusted_host > trusted_host.log 2>&1 &
                                         '''
 
     try:
-        response = ec2_client.run_instances(
-            ImageId=image_id,
-            MinCount=1,
-            MaxCount=1,
-            InstanceType=instance_type,
-            KeyName=key_name,
-            SecurityGroupIds=[security_group_id],
-            SubnetId=subnet_id,
-            UserData=user_data_script,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': 'LabInstance'
-                        }
-                    ]
-                }
-            ]
-        )
-
-        ec2_resource = boto3.resource('ec2')
-
-        # Retrieve instance objects using the InstanceId
-        trusted_host_list = [ec2_resource.Instance(instance['InstanceId']) for instance in response['Instances']]
-        trusted_host = trusted_host_list[0]
-
-        trusted_host.wait_until_running()
-        trusted_host.reload()
+        trusted_host = launch_instance(ec2_client, "trusted_host", image_id, instance_type, key_name,
+                                       security_group_id, subnet_id, user_data_script)
 
         print(f"Trusted Host launched IP: {trusted_host.public_ip_address}   ID: {trusted_host.id}")
         with open('trusted_host_ip.txt', 'w') as file:
@@ -685,6 +786,18 @@ def launch_trusted_host(ec2_client, image_id, instance_type, key_name, security_
         print(f"Error launching instances: {e}")
         sys.exit(1)
 
+def wait_for_service(shell, instance, ports=(5000,)):
+    """
+    Function to wait until cloud-init finished and the Flask apps answer
+    Args:
+        shell: RemoteShell
+        instance: Instance object
+        ports: Ports of the apps served by the instance
+    """
+    wait_for(shell, instance, "cloud-init status --wait > /dev/null", "cloud-init finished")
+    for port in ports:
+        wait_for(shell, instance, f"timeout 2 bash -c '</dev/tcp/127.0.0.1/{port}'", f"port {port} answering")
+
 def change_security_group(ec2, instance, security_group_id):
     """
     Function to change security group of the instance
@@ -694,13 +807,116 @@ def change_security_group(ec2, instance, security_group_id):
         security_group_id: Security group ID
     """
     ec2.modify_instance_attribute(InstanceId=instance.id, Groups=[security_group_id])
-    print("Security group changed")
+    print(f"{instance.name}: security group changed")
+
+def provision_cluster(ec2_client, shell, image_id, key_name, security_group_public, security_group_private,
+                      subnet_public, subnet_private, num_of_workers):
+    """
+    Function to bring up the cluster. Independent instances are launched and prepared concurrently,
+    each phase waits on readiness signals of the instances instead of fixed sleeps
+    Args:
+        ec2_client: The EC2 client, or a stand-in with the same methods
+        shell: RemoteShell, or a stand-in with the same methods
+        image_id: The AMI ID for the instances
+        key_name: The key pair name to use for SSH access
+        security_group_public: Security group used during the setup
+        security_group_private: Security group of the internal instances afterwards
+        subnet_public: Subnet of the gatekeeper
+        subnet_private: Subnet of the other instances
+        num_of_workers: Number of worker instances per replication group
+    Returns:
+        Dictionary of instances and the phase timer
+    """
+    timer = PhaseTimer()
+
+    with timer.phase("launch instances"):
+        launches = [
+            (launch_proxy, (ec2_client, image_id, "t2.large", key_name, security_group_public, subnet_private)),
+            (launch_trusted_host, (ec2_client, image_id, "t2.large", key_name, security_group_public, subnet_private)),
+            (launch_gatekeeper, (ec2_client, image_id, "t2.large", key_name, security_group_public, subnet_public)),
+        ]
+        for shard in range(NUM_SHARDS):
+            launches.append((launch_manager, (ec2_client, image_id, "t2.micro", key_name, security_group_public,
+                                              subnet_private, shard)))
+        for i in range(NUM_SHARDS * num_of_workers):
+            launches.append((launch_workers, (ec2_client, image_id, "t2.micro", key_name, security_group_public,
+                                              subnet_private, i)))
+        proxy, trusted_host, gatekeeper, *databases = run_parallel(lambda function, args: function(*args), launches)
+        managers, worker_instances = databases[:NUM_SHARDS], databases[NUM_SHARDS:]
+        # Workers of each replication group
+        groups = [worker_instances[shard * num_of_workers:(shard + 1) * num_of_workers] for shard in range(NUM_SHARDS)]
+
+        # The proxy starts without replicas and reads from the managers until workers register
+        with open('workers_ip.txt', 'w') as file:
+            file.write("\n")
+        proxy_files = ['manager_ip.txt', 'workers_ip.txt']
+        if NUM_SHARDS > 1:
+            write_shard_map(managers, [[] for _ in managers])
+            proxy_files.append('shard_map.json')
+
+    with timer.phase("transfer files"):
+        # Shared modules first, the services start as soon as their main file exists
+        shared = ['serve.py', 'shared_state.py', 'metrics.py']
+        proxy_files += ['codec.py', 'http_client.py', 'sharding.py', 'pagination.py']
+        gatekeeper_files = shared + ['codec.py', 'http_client.py', 'admission.py', 'trusted_host_ip.txt',
+                                     'gatekeeper.py']
+        if PIPELINE_ENABLED:
+            # The pipeline imports the three tiers and routes to the databases itself
+            gatekeeper_files += proxy_files + ['trusted_host.py', 'proxy.py', 'pipeline.py']
+        transfers = [(shell, instance, shared + ['codec.py', 'worker_manager_app.py'])
+                     for instance in managers + worker_instances]
+        transfers += [
+            (shell, gatekeeper, gatekeeper_files),
+            (shell, trusted_host, shared + ['http_client.py', 'proxy_ip.txt', 'trusted_host.py']),
+            (shell, proxy, shared + proxy_files + ['proxy.py']),
+        ]
+        run_parallel(transfer_files, transfers)
+
+    with timer.phase("replication and registration"):
+        # Each worker is registered on the proxy as soon as it replicates and serves queries. The pipeline routes
+        # on its own, it only reads the replicas of the first group from its files
+        routers = [(proxy, 5000), (gatekeeper, 5001)] if PIPELINE_ENABLED else [(proxy, 5000)]
+        statuses = run_parallel(transfer_master_status, [(shell, group_manager) for group_manager in managers])
+        run_parallel(prepare_worker, [(shell, worker, routers, managers[shard].private_ip_address, *statuses[shard],
+                                       shard)
+                                      for shard in range(NUM_SHARDS) for worker in groups[shard]])
+        if NUM_SHARDS > 1:
+            # Every group keeps its rows of the sharded tables, the replicas follow
+            run_parallel(prune_group, [(shell, group_manager, shard) for shard, group_manager in enumerate(managers)])
+
+        # Persist the membership so a restarted proxy keeps the replicas
+        with open('workers_ip.txt', 'w') as file:
+            file.write(" ".join(worker.private_ip_address for worker in groups[0]) + "\n")
+        persisted = ['workers_ip.txt']
+        if NUM_SHARDS > 1:
+            write_shard_map(managers, groups)
+            persisted.append('shard_map.json')
+        transfer_files(shell, proxy, persisted)
+        if PIPELINE_ENABLED:
+            transfer_files(shell, gatekeeper, persisted)
+
+    instances = {"proxy": proxy, "trusted_host": trusted_host, "gatekeeper": gatekeeper}
+    instances.update({group_manager.name: group_manager for group_manager in managers})
+    instances.update({worker.name: worker for worker in worker_instances})
+
+    with timer.phase("services ready"):
+        # With the pipeline the gatekeeper also serves the combined tiers on port 5001
+        gatekeeper_ports = (5000, 5001) if PIPELINE_ENABLED else (5000,)
+        run_parallel(wait_for_service, [(shell, proxy), (shell, trusted_host), (shell, gatekeeper, gatekeeper_ports)]
+                     + [(shell, group_manager) for group_manager in managers])
+
+    with timer.phase("security groups"):
+        # Change security groups
+        run_parallel(change_security_group, [(ec2_client, instance, security_group_private)
+                                             for name, instance in instances.items() if name != "gatekeeper"])
+
+    return instances, timer
 
 def main():
     try:
         # Initialize EC2 and ELB clients
         ec2_client = boto3.client('ec2')
-        num_of_workers = 2
+        num_of_workers = NUM_WORKERS
 
         # Define essential AWS configuration
         vpc_id = get_vpc_id(ec2_client)
@@ -715,56 +931,18 @@ def main():
         security_group_private = create_security_group(ec2_client, vpc_id, "private")
         subnet_public, subnet_private = get_subnet(ec2_client, vpc_id)
 
-        # Launch manager and transfer master status file
-        manager = launch_manager(ec2_client, image_id, "t2.micro", key_name, security_group_public, subnet_private)
-        log_file, log_pos = transfer_master_status(manager, key_file_path)
-
-        # Launch workers
-        worker_instances = []
-        for i in range(num_of_workers):
-            worker = launch_workers(ec2_client, image_id, "t2.micro", key_name, security_group_public,
-                           subnet_private, num_of_workers, manager.private_ip_address, log_file, log_pos)
-            worker_instances.append(worker)
-        with open('workers_ip.txt', 'w') as file:
-            file.write(f"{worker_instances[0].private_ip_address} {worker_instances[1].private_ip_address}\n")
-
-        time.sleep(60)
-
-        # Transfer Python scripts to manager and workers
-        for instance in [manager, worker_instances[0], worker_instances[1]]:
-            transfer_files(instance, key_file_path, ['worker_manager_app.py'])
-
-        # Launch gatekeeper, trusted host and proxy
-        gatekeeper = launch_gatekeeper(ec2_client, image_id, "t2.large", key_name,
-                                       security_group_public, subnet_public)
-        trusted_host = launch_trusted_host(ec2_client, image_id, "t2.large", key_name,
-                                           security_group_public, subnet_private)
-        proxy = launch_proxy(ec2_client, image_id, "t2.large", key_name,
-                             security_group_public, subnet_private)
-
-        time.sleep(60)
-
-        # Transfer files to gatekeeper, trusted host and proxy
-        transfer_files(gatekeeper, key_file_path, ['gatekeeper.py', 'trusted_host_ip.txt'])
-        transfer_files(trusted_host, key_file_path, ['trusted_host.py', 'proxy_ip.txt'])
-        transfer_files(proxy, key_file_path, ['manager_ip.txt', 'workers_ip.txt', 'proxy.py'])
-
-        time.sleep(30)
-
-        # Change security groups
-        print("Changing security groups:")
-        for instance in [manager, worker_instances[0], worker_instances[1], proxy, trusted_host]:
-            change_security_group(ec2_client, instance, security_group_private)
-        time.sleep(30)
+        instances, timer = provision_cluster(ec2_client, RemoteShell(key_file_path), image_id, key_name,
+                                             security_group_public, security_group_private,
+                                             subnet_public, subnet_private, num_of_workers)
 
         # Print the IPs of instances
-        for instance_name in ["manager", "worker_instances[0]", "worker_instances[1]", "proxy", "trusted_host", "gatekeeper"]:
-            instance = eval(instance_name)
+        for instance_name, instance in instances.items():
             print(f"IP addresses of {instance_name} are public: {instance.public_ip_address} and private: {instance.private_ip_address}")
+        timer.report()
 
 
     except Exception as e:
         print(f"Error during execution: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,448 @@
+import ipaddress
+import json
+import os
+import threading
+import time
+import uuid
+import re
+from bisect import bisect_left
+from flask import Response, g, has_request_context, request
+import shared_state
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Request ID propagated through every hop, created at the first tier unless the client sent a valid one
+REQUEST_ID_HEADER = "X-Request-ID"
+REQUEST_ID_RE = re.compile(r"^[\w.-]{1,64}$")
+
+# Seconds between the snapshots each process of a multi-process server writes for /metrics,
+# the process answering the scrape reports the sum over all of them
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    """
+    Base of the metric types, one child per combination of label values
+    Args:
+        name: Metric name
+        documentation: Help text
+        labelnames: Names of the labels
+    """
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """
+        Returns:
+            Child for the label values, created on first use
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self):
+        # Snapshot of (label values, value)
+        raise NotImplementedError
+
+    def _samples(self, collected):
+        # (suffix, label values, extra labels, value) per line
+        return [("", values, (), value) for values, value in collected]
+
+    def render(self, collected=None, labelnames=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        collected = self.collect() if collected is None else collected
+        for suffix, values, extra, value in self._samples(collected):
+            lines.append(f"{self.name}{suffix}{format_labels(labelnames or self.labelnames, values, extra)} {value}")
+        return "\n".join(lines)
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def collect(self):
+        return [(values, child.value) for values, child in list(self._children.items())]
+
+    def _samples(self, collected):
+        return [("_total", values, (), value) for values, value in collected]
+
+
+class Gauge(Metric):
+    """
+    Gauge set by the code, or read from a callback returning {label values: value} when rendered.
+    With several processes the values are summed if multiprocess_mode is sum, otherwise they are
+    reported per process with a pid label
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None, multiprocess_mode="pid"):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.multiprocess_mode = multiprocess_mode
+
+    def _new_child(self):
+        return _Value()
+
+    def collect(self):
+        if self.callback is not None:
+            return [(tuple(values), value) for values, value in self.callback().items()]
+        return [(values, child.value) for values, child in list(self._children.items())]
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def collect(self):
+        return [(values, child.snapshot()) for values, child in list(self._children.items())]
+
+    def _samples(self, collected):
+        samples = []
+        for values, (counts, total) in collected:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", values, (("le", "+Inf" if bound == float("inf") else bound),), cumulative))
+            samples.append(("_sum", values, (), total))
+            samples.append(("_count", values, (), cumulative))
+        return samples
+
+
+class Registry:
+    """
+    Collection of the metrics of a service, rendered in the Prometheus text format
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self.flushing = False
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), callback=None, multiprocess_mode="pid"):
+        return self._register(Gauge, name, documentation, labelnames, callback=callback,
+                              multiprocess_mode=multiprocess_mode)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self):
+        if shared_state.is_shared():
+            return self.render_processes()
+        return "\n".join(metric.render() for metric in self.metrics()) + "\n"
+
+    def snapshot_path(self, pid):
+        return shared_state.state_path(f"metrics-{pid}.json")
+
+    def flush(self):
+        """
+        Function to write the metrics of this process for the other processes of the server
+        """
+        snapshot = {metric.name: [[list(values), value] for values, value in metric.collect()]
+                    for metric in self.metrics()}
+        path = self.snapshot_path(os.getpid())
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(snapshot, file)
+        os.replace(f"{path}.tmp", path)
+
+    def render_processes(self):
+        """
+        Function to render the metrics of all processes of a multi-process server. Counters and histograms
+        of exited processes are kept so the totals do not drop, their gauges are left out
+        Returns:
+            Prometheus text
+        """
+        pid = os.getpid()
+        snapshots = {pid: {metric.name: metric.collect() for metric in self.metrics()}}
+        directory = os.path.dirname(self.snapshot_path(pid))
+        for file_name in os.listdir(directory):
+            if not (file_name.startswith("metrics-") and file_name.endswith(".json")):
+                continue
+            other = int(file_name[len("metrics-"):-len(".json")])
+            if other == pid:
+                continue
+            try:
+                with open(os.path.join(directory, file_name), "r") as file:
+                    snapshots[other] = {name: [(tuple(values), value) for values, value in collected]
+                                        for name, collected in json.load(file).items()}
+            except (OSError, ValueError):
+                # Replaced while it was read
+                continue
+
+        blocks = []
+        for metric in self.metrics():
+            merged = {}
+            for other, snapshot in snapshots.items():
+                if metric.kind == "gauge":
+                    if other != pid and not is_running(other):
+                        continue
+                    for values, value in snapshot.get(metric.name, []):
+                        if metric.multiprocess_mode == "sum":
+                            merged[values] = merged.get(values, 0) + value
+                        else:
+                            merged[values + (other,)] = value
+                elif metric.kind == "histogram":
+                    for values, (counts, total) in snapshot.get(metric.name, []):
+                        merged_counts, merged_total = merged.get(values, ([0] * len(counts), 0.0))
+                        merged[values] = ([a + b for a, b in zip(merged_counts, counts)], merged_total + total)
+                else:
+                    for values, value in snapshot.get(metric.name, []):
+                        merged[values] = merged.get(values, 0) + value
+            labelnames = metric.labelnames
+            if metric.kind == "gauge" and metric.multiprocess_mode != "sum":
+                labelnames += ("pid",)
+            blocks.append(metric.render(list(merged.items()), labelnames))
+        return "\n".join(blocks) + "\n"
+
+
+def is_running(pid):
+    """
+    Returns:
+        True if the process still exists
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter("http_requests", "Requests served per route and status",
+                                 ("method", "route", "status"))
+HTTP_ERRORS = REGISTRY.counter("http_errors", "Requests answered with a 5xx status or an exception",
+                               ("method", "route"))
+HTTP_IN_FLIGHT = REGISTRY.gauge("http_in_flight_requests", "Requests being served per route", ("method", "route"),
+                                multiprocess_mode="sum")
+HTTP_LATENCY = REGISTRY.histogram("http_request_duration_seconds", "Time to produce the response per route",
+                                  ("method", "route"))
+UPSTREAM_REQUESTS = REGISTRY.counter("upstream_requests", "Requests sent per upstream and status",
+                                     ("upstream", "path", "status"))
+UPSTREAM_ERRORS = REGISTRY.counter("upstream_errors", "Requests to an upstream that raised",
+                                   ("upstream", "path"))
+UPSTREAM_LATENCY = REGISTRY.histogram("upstream_request_duration_seconds",
+                                      "Time until the upstream response headers arrived", ("upstream", "path"))
+
+
+def observe_upstream(upstream, path, status, seconds):
+    """
+    Function to record a request to an upstream
+    Args:
+        upstream: host:port of the upstream
+        path: Requested path
+        status: Response status, None if the request raised
+        seconds: Time until the response headers arrived
+    """
+    if status is None:
+        UPSTREAM_ERRORS.labels(upstream, path).inc()
+    else:
+        UPSTREAM_REQUESTS.labels(upstream, path, status).inc()
+    UPSTREAM_LATENCY.labels(upstream, path).observe(seconds)
+
+
+def trace_headers():
+    """
+    Function to build the headers propagating the request ID to an upstream.
+    Has to be called in the request thread, the result can be handed to other threads
+    Returns:
+        Dictionary of headers
+    """
+    if not has_request_context() or not g.get("request_id"):
+        return {}
+    return {REQUEST_ID_HEADER: g.request_id}
+
+
+def add_timing(name, seconds):
+    """
+    Function to add a step of this tier to the Server-Timing breakdown of the response,
+    repeated steps are summed. Does nothing outside of a request
+    Args:
+        name: Step name
+        seconds: Duration of the step
+    """
+    if has_request_context():
+        timings = g.setdefault("server_timing", {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def forward_timing(response):
+    """
+    Function to keep the Server-Timing breakdown of an upstream response, it is appended to the one of this tier
+    Args:
+        response: requests Response
+    """
+    if has_request_context() and "Server-Timing" in response.headers:
+        g.upstream_timing = response.headers["Server-Timing"]
+
+
+def is_allowed(address):
+    """
+    Returns:
+        True for local and private network clients, the metrics are not exposed to the internet
+    """
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return ip.is_loopback or ip.is_private
+
+
+def start_flushing(registry):
+    """
+    Function to write the metrics of this process in the background, once per registry
+    Args:
+        registry: Registry to write
+    """
+    def flush_metrics():
+        while True:
+            try:
+                registry.flush()
+            except OSError as e:
+                print(f"Could not write the metrics: {e}")
+            time.sleep(METRICS_FLUSH_INTERVAL)
+
+    if not registry.flushing:
+        registry.flushing = True
+        threading.Thread(target=flush_metrics, daemon=True).start()
+
+
+def instrument(app, tier, registry=REGISTRY):
+    """
+    Function to record request counts, errors, in-flight requests and latency per route of a Flask app
+    and to serve them on /metrics. Every response carries the request ID and a Server-Timing breakdown
+    of this tier followed by the one of its upstream
+    Args:
+        app: Flask app
+        tier: Name of the tier in the Server-Timing breakdown
+        registry: Registry serving the metrics
+    """
+    if shared_state.is_shared():
+        start_flushing(registry)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        g.metrics_start = time.perf_counter()
+        request_id = request.headers.get(REQUEST_ID_HEADER, "")
+        g.request_id = request_id if REQUEST_ID_RE.match(request_id) else uuid.uuid4().hex
+        HTTP_IN_FLIGHT.labels(request.method, g.metrics_route).inc()
+
+    @app.after_request
+    def record_response(response):
+        route = g.pop("metrics_route", None)
+        if route is not None:
+            elapsed = time.perf_counter() - g.metrics_start
+            HTTP_IN_FLIGHT.labels(request.method, route).dec()
+            HTTP_LATENCY.labels(request.method, route).observe(elapsed)
+            HTTP_REQUESTS.labels(request.method, route, response.status_code).inc()
+            if response.status_code >= 500:
+                HTTP_ERRORS.labels(request.method, route).inc()
+
+            steps = [(tier, elapsed)] + list(g.get("server_timing", {}).items())
+            timing = ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in steps)
+            if g.get("upstream_timing"):
+                timing = f"{timing}, {g.upstream_timing}"
+            response.headers["Server-Timing"] = timing
+            response.headers[REQUEST_ID_HEADER] = g.request_id
+        return response
+
+    @app.teardown_request
+    def record_exception(exception):
+        # after_request already recorded the request unless it did not run: the exception propagated
+        # (PROPAGATE_EXCEPTIONS, e.g. testing or debug mode) or an after_request hook failed first
+        route = g.pop("metrics_route", None)
+        if route is not None:
+            HTTP_IN_FLIGHT.labels(request.method, route).dec()
+            HTTP_LATENCY.labels(request.method, route).observe(time.perf_counter() - g.metrics_start)
+            HTTP_ERRORS.labels(request.method, route).inc()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        # Prometheus text format, local and private network clients only
+        if not is_allowed(request.remote_addr):
+            return Response("Forbidden\n", status=403, mimetype="text/plain")
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,155 @@
+import base64
+import binascii
+import json
+import os
+import re
+import zlib
+import sharding
+
+# Rows per page when a paginated request sets no page_size, and the most a request may ask for.
+# Every page is a SELECT with a LIMIT, so a worker never holds more rows than this for one request
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000))
+
+
+class PaginationError(Exception):
+    pass
+
+
+def encode_cursor(state):
+    """
+    Function to build the continuation token returned to the client, it only holds values bound as parameters
+    Args:
+        state: Dictionary of the token
+    Returns:
+        Token as URL-safe text
+    """
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Function to read a continuation token
+    Args:
+        cursor: Token sent by the client
+    Returns:
+        Dictionary of the token
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError, TypeError):
+        raise PaginationError("Invalid cursor")
+    if not isinstance(state, dict) or not isinstance(state.get("values"), list):
+        raise PaginationError("Invalid cursor")
+    return state
+
+
+def get_keys(masked):
+    """
+    Function to read the sort key of a paginated SELECT from its ORDER BY
+    Args:
+        masked: Masked query without a trailing semicolon
+    Returns:
+        Match of the ORDER BY and the list of (column as written, result column, descending)
+    """
+    order = re.search(r"\border\s+by\s+(.*)$", masked, re.IGNORECASE | re.DOTALL)
+    if order is None:
+        raise PaginationError("Paginated queries need an ORDER BY ending with a unique column, e.g. the primary key")
+    keys = []
+    for start, end in sharding.split_top_level(masked, order.start(1), len(masked)):
+        item = masked[start:end].strip()
+        column = sharding.ORDER_ITEM_RE.fullmatch(item)
+        if column is None:
+            raise PaginationError("ORDER BY of a paginated query only supports column names")
+        keys.append((re.sub(r"\s+(?:asc|desc)$", "", item, flags=re.IGNORECASE), column.group(1),
+                     (column.group(2) or "asc").lower() == "desc"))
+    return order, keys
+
+
+def open_page(query, params, page_size=None, cursor=None):
+    """
+    Function to rewrite a SELECT into the query of one page. The next page starts after the sort key of the last
+    row of the previous one (keyset pagination), so no page skips rows with an OFFSET and no state is held
+    between the pages. The key columns have to be selected, NOT NULL and numbers or text
+    Args:
+        query: SELECT query as sent by the client
+        params: Parameter list, None for a plain query
+        page_size: Requested rows per page, PAGE_SIZE if None
+        cursor: Continuation token of the previous page, None for the first page
+    Returns:
+        Dictionary of the page with query, params, size, keys, the replica of the previous page and the fingerprint
+    Raises:
+        PaginationError: The query cannot be paginated or the cursor does not belong to it
+    """
+    try:
+        size = PAGE_SIZE if page_size is None else int(page_size)
+    except (TypeError, ValueError):
+        raise PaginationError("page_size has to be a number")
+    if not 0 < size <= MAX_PAGE_SIZE:
+        raise PaginationError(f"page_size has to be between 1 and {MAX_PAGE_SIZE}")
+
+    query = query.rstrip().rstrip(";")
+    masked = sharding.mask_strings(query)
+    if re.search(r"\b(?:limit|group\s+by|having|union|for\s+update)\b", masked, re.IGNORECASE):
+        raise PaginationError("Paginated queries cannot use LIMIT, GROUP BY, HAVING or UNION")
+    if len(re.findall(r"\bselect\b", masked, re.IGNORECASE)) > 1:
+        raise PaginationError("Paginated queries cannot use subqueries")
+    order, keys = get_keys(masked)
+
+    # Follow-up pages repeat the query, a cursor of another query would skip rows
+    fingerprint = zlib.crc32(f"{' '.join(query.split())}\0{json.dumps(params)}".encode())
+    page = {"size": size, "keys": keys, "fingerprint": fingerprint, "replica": None}
+    params = None if params is None else list(params)
+    if cursor:
+        state = decode_cursor(cursor)
+        if state.get("fingerprint") != fingerprint or len(state["values"]) != len(keys):
+            raise PaginationError("The cursor does not belong to this query")
+        page["replica"] = state.get("replica")
+
+        # Rows after the last one: (a > x) OR (a = x AND b > y) ..., bound as parameters
+        conditions = []
+        keyset_params = []
+        for i, (column, _, descending) in enumerate(keys):
+            comparisons = [f"{key} = %s" for key, _, _ in keys[:i]]
+            comparisons.append(f"{column} < %s" if descending else f"{column} > %s")
+            conditions.append(f"({' AND '.join(comparisons)})")
+            keyset_params += state["values"][:i + 1]
+        predicate = " OR ".join(conditions)
+        where = re.search(r"\bwhere\b", masked[:order.start()], re.IGNORECASE)
+        if where is None:
+            head = f"{query[:order.start()].rstrip()} WHERE ({predicate}) "
+        else:
+            head = f"{query[:where.end()]} ({query[where.end():order.start()].strip()}) AND ({predicate}) "
+        # The predicate comes after the parameters of the WHERE and before the ones of the ORDER BY
+        split = masked[:order.start()].count("%s")
+        params = (params or [])[:split] + keyset_params + (params or [])[split:]
+        query = f"{head}{query[order.start():]}"
+
+    # One row more than the page tells whether another page follows
+    page["query"] = f"{query} LIMIT {size + 1}"
+    page["params"] = params
+    return page
+
+
+def finish_page(page, response_data, replica):
+    """
+    Function to cut the rows of a page and add the continuation token
+    Args:
+        page: See open_page
+        response_data: Response dictionary of the database
+        replica: URL of the database that answered, follow-up pages are sent to it while it is available
+    Returns:
+        Response dictionary with the rows of the page and cursor, None on the last page
+    """
+    rows = response_data.get("result", [])
+    cursor = None
+    if len(rows) > page["size"]:
+        rows = rows[:page["size"]]
+        try:
+            values = [rows[-1][name] for _, name, _ in page["keys"]]
+        except KeyError:
+            raise PaginationError("The ORDER BY columns of a paginated query have to be selected")
+        if any(value is None for value in values):
+            raise PaginationError("The ORDER BY columns of a paginated query cannot be NULL")
+        cursor = encode_cursor({"values": values, "replica": replica, "fingerprint": page["fingerprint"]})
+    return dict(response_data, result=rows, cursor=cursor)
@@ -0,0 +1,77 @@
+from flask import Flask, request, jsonify
+import metrics
+import admission
+import gatekeeper
+import trusted_host
+import proxy
+
+# Gatekeeper, trusted host and proxy as stages of one process. The client API is the one of the gatekeeper,
+# requests go through the same checks in the same order and get the same error responses, only the hop
+# to the databases remains. The proxy stage reads manager_ip.txt and workers_ip.txt
+app = Flask(__name__)
+metrics.instrument(app, "pipeline")
+admission.install(app, ("/start", "/batch"))
+app.after_request(gatekeeper.compress_client_response)
+app.after_request(proxy.record_query)
+
+
+def fill_pending(results, stage):
+    """
+    Function to run a stage on the batch items that have no result yet
+    Args:
+        results: Result per item, None for the pending ones
+        stage: Called with the positions of the pending items, returns their results in order
+    Returns:
+        List of results
+    """
+    indices = [i for i, result in enumerate(results) if result is None]
+    if indices:
+        for i, result in zip(indices, stage(indices)):
+            results[i] = result
+    return results
+
+
+@app.route('/start', methods=['POST'])
+def execute_query():
+    modified_data, error = gatekeeper.check_query(request.get_json())
+    if modified_data is None:
+        return jsonify({"error": error}), 400
+
+    modified_data, error = trusted_host.check_query(modified_data)
+    if modified_data is None:
+        return jsonify({"error": error}), 400
+
+    # The client's Accept and Accept-Encoding go to the database, a result it cannot read is never produced
+    return proxy.route_query(modified_data)
+
+
+@app.route('/batch', methods=['POST'])
+def execute_batch():
+    data = request.get_json()
+    queries = data.get("queries")
+    results, error = gatekeeper.check_batch(queries)
+    if results is None:
+        return jsonify({"error": error}), 400
+
+    results = fill_pending(results, lambda indices: trusted_host.check_batch([queries[i] for i in indices], True))
+    results = fill_pending(results, lambda indices: proxy.route_batch([queries[i] for i in indices],
+                                                                      data.get("strategy", "round-robin")))
+    return jsonify({"results": results}), 200
+
+
+# Status and membership endpoints of the stages, the proxy stage holds the only upstream session
+app.add_url_rule('/validator', view_func=trusted_host.validator_stats, methods=['GET'])
+app.add_url_rule('/workers', view_func=proxy.worker_status, methods=['GET'])
+app.add_url_rule('/workers/register', view_func=proxy.register_worker, methods=['POST'])
+app.add_url_rule('/workers/deregister', view_func=proxy.deregister_worker, methods=['POST'])
+app.add_url_rule('/workers/drain', view_func=proxy.drain_worker, methods=['POST'])
+app.add_url_rule('/workers/reload', view_func=proxy.reload_worker_file, methods=['POST'])
+app.add_url_rule('/hedging', view_func=proxy.hedging_stats, methods=['GET'])
+app.add_url_rule('/coalescing', view_func=proxy.coalescing_stats, methods=['GET'])
+app.add_url_rule('/cache', view_func=proxy.cache_stats, methods=['GET'])
+app.add_url_rule('/shards', view_func=proxy.shard_status, methods=['GET'])
+app.add_url_rule('/connections', view_func=proxy.connection_stats, methods=['GET'])
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5001)
@@ -0,0 +1,254 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+
+# Local check of provision_cluster in main.py. EC2 and SSH are stood in by fakes recording every call in order,
+# every readiness signal fails on its first attempts, so the checks see the retries of wait_for as well
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+MASTER_STATUS = "File: mysql-bin.000001\nPosition: 157\n"
+# Commands provisioning runs once instead of polling them, they succeed at once
+ONE_SHOT = ("CHANGE MASTER", "FOREIGN_KEY_CHECKS")
+
+
+class Recorder:
+    """
+    Thread-safe log of the calls of the fakes, provisioning runs its phases concurrently
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def add(self, *call):
+        with self.lock:
+            self.calls.append(call)
+
+    def index(self, predicate):
+        """
+        Returns:
+            Position of the first call matching the predicate, None if there is none
+        """
+        return next((i for i, call in enumerate(self.calls) if predicate(call)), None)
+
+    def matching(self, predicate):
+        return [call for call in self.calls if predicate(call)]
+
+
+class FakeEC2:
+    """
+    EC2 client with the methods provisioning uses, instances get consecutive IPs
+    """
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.lock = threading.Lock()
+        self.instances = {}
+
+    def run_instances(self, **kwargs):
+        with self.lock:
+            number = len(self.instances) + 1
+            instance_id = f"i-{number:04d}"
+            self.instances[instance_id] = {"InstanceId": instance_id, "PublicIpAddress": f"203.0.113.{number}",
+                                           "PrivateIpAddress": f"10.0.0.{number}"}
+        self.recorder.add("run_instances", instance_id, kwargs["InstanceType"])
+        return {"Instances": [{"InstanceId": instance_id}]}
+
+    def get_waiter(self, name):
+        recorder = self.recorder
+
+        class Waiter:
+            def wait(self, InstanceIds):
+                recorder.add("wait", name, InstanceIds[0])
+        return Waiter()
+
+    def describe_instances(self, InstanceIds):
+        return {"Reservations": [{"Instances": [self.instances[InstanceIds[0]]]}]}
+
+    def modify_instance_attribute(self, InstanceId, Groups):
+        self.recorder.add("modify_instance_attribute", InstanceId, Groups[0])
+
+
+class FakeShell:
+    """
+    RemoteShell running nothing. Each polled command fails its first attempts, SSH first refuses the connection.
+    Commands listed in broken never succeed
+    Args:
+        recorder: Recorder
+        failures: Failed attempts per instance and command
+        broken: Substrings of the commands that always fail
+    """
+    def __init__(self, recorder, failures=1, broken=()):
+        self.recorder = recorder
+        self.failures = failures
+        self.broken = broken
+        self.lock = threading.Lock()
+        self.attempts = {}
+
+    def run(self, instance, command):
+        with self.lock:
+            attempt = self.attempts[(instance.name, command)] = self.attempts.get((instance.name, command), 0) + 1
+        self.recorder.add("run", instance.name, command, attempt)
+        if attempt <= self.failures and not any(part in command for part in ONE_SHOT):
+            if command == "true":
+                raise OSError("Connection refused")
+            return 1, ""
+        if any(part in command for part in self.broken):
+            return 1, ""
+        if "master_status.txt" in command:
+            return 0, MASTER_STATUS
+        return 0, ""
+
+    def put(self, instance, files):
+        self.recorder.add("put", instance.name, tuple(files))
+
+
+class Checks:
+    """
+    Collects the outcome of the checks
+    """
+    def __init__(self):
+        self.failed = 0
+
+    def check(self, name, condition, detail=""):
+        print(f"{'PASS' if condition else 'FAIL'} {name}{'' if condition else f': {detail}'}")
+        if not condition:
+            self.failed += 1
+
+
+def provision(num_shards, num_workers, pipeline, shell_options=None):
+    """
+    Function to run provision_cluster against the fakes
+    Args:
+        num_shards: NUM_SHARDS of main.py
+        num_workers: Workers per replication group
+        pipeline: PIPELINE_ENABLED of main.py
+        shell_options: Arguments of FakeShell
+    Returns:
+        Recorder, instances and the raised exception, None if provisioning succeeded
+    """
+    main.NUM_SHARDS = num_shards
+    main.PIPELINE_ENABLED = pipeline
+    recorder = Recorder()
+    try:
+        instances, _ = main.provision_cluster(FakeEC2(recorder), FakeShell(recorder, **(shell_options or {})),
+                                              "ami-test", "key", "sg-public", "sg-private", "subnet-public",
+                                              "subnet-private", num_workers)
+        return recorder, instances, None
+    except Exception as e:
+        return recorder, None, e
+
+
+def check_cluster(checks, name, num_shards, num_workers, pipeline):
+    """
+    Function to provision a cluster and check the order of the commands
+    """
+    recorder, instances, error = provision(num_shards, num_workers, pipeline)
+    checks.check(f"{name}: provisioned", error is None, error)
+    if error is not None:
+        return
+    managers = [f"manager{shard}" if shard else "manager" for shard in range(num_shards)]
+    workers = [instance_name for instance_name in instances if instance_name.startswith("worker")]
+    calls = recorder.calls
+
+    def first(*call):
+        return recorder.index(lambda recorded: recorded[:len(call)] == call)
+
+    def first_containing(instance_name, text, succeeded=True):
+        return recorder.index(lambda call: call[0] == "run" and call[1] == instance_name and text in call[2]
+                              and (not succeeded or call[3] > 1))
+
+    checks.check(f"{name}: every instance launched", len(recorder.matching(lambda call: call[0] == "run_instances"))
+                 == 3 + num_shards * (num_workers + 1) and set(instances) == {"proxy", "trusted_host", "gatekeeper",
+                                                                             *managers, *workers}, sorted(instances))
+    checks.check(f"{name}: instances waited for before use", all(
+        first("wait", "instance_running", instance.id) < first_containing(instance_name, "true")
+        for instance_name, instance in instances.items()))
+
+    # Every readiness signal is polled again after its first failure
+    retried = [call for call in calls if call[0] == "run" and call[3] == 2]
+    failed_once = {(call[1], call[2]) for call in calls if call[0] == "run" and call[3] == 1
+                   and not any(part in call[2] for part in ONE_SHOT)}
+    checks.check(f"{name}: every readiness signal retried", failed_once == {(call[1], call[2]) for call in retried},
+                 failed_once - {(call[1], call[2]) for call in retried})
+
+    # Modules go out once per instance, files sent later only hold the state of the cluster
+    puts = {call[1]: call[2] for call in calls if call[0] == "put" and any(file.endswith(".py") for file in call[2])}
+    missing = {instance_name: [file for file in files if file.endswith(".py")
+                               and not os.path.exists(os.path.join(REPO_DIR, file))]
+               for instance_name, files in puts.items()}
+    checks.check(f"{name}: every transferred module exists", not any(missing.values()), missing)
+    checks.check(f"{name}: files sent to every instance", set(puts) == set(instances), set(instances) - set(puts))
+    checks.check(f"{name}: proxy modules on the proxy", {"proxy.py", "sharding.py", "pagination.py"}
+                 <= set(puts["proxy"]), puts["proxy"])
+    checks.check(f"{name}: pipeline modules on the gatekeeper only with the pipeline",
+                 ("pipeline.py" in puts["gatekeeper"]) == pipeline, puts["gatekeeper"])
+
+    # Replication: master status, then per worker CHANGE MASTER, its service and its registration on the proxy
+    for worker in workers:
+        private_ip = instances[worker].private_ip_address
+        change_master = first_containing(worker, "CHANGE MASTER", succeeded=False)
+        service = first_containing(worker, "/dev/tcp/127.0.0.1/5000")
+        registered = first_containing("proxy", f'"ip": "{private_ip}"')
+        # The pipeline routes on its own, the replicas of every group register on it too
+        on_pipeline = first_containing("gatekeeper", f'"ip": "{private_ip}"')
+        checks.check(f"{name}: {worker} registered on the pipeline only with the pipeline",
+                     (on_pipeline is not None and service < on_pipeline
+                      and "127.0.0.1:5001/workers/register" in calls[on_pipeline][2]) if pipeline
+                     else on_pipeline is None, on_pipeline)
+        status_read = min(first_containing(manager, "master_status.txt") for manager in managers)
+        ordered = None not in (change_master, service, registered) and status_read < change_master < service \
+            < registered
+        checks.check(f"{name}: {worker} replicates, serves, then registers", ordered,
+                     (status_read, change_master, service, registered))
+    if num_shards > 1:
+        for manager in managers:
+            pruned = first_containing(manager, "FOREIGN_KEY_CHECKS", succeeded=False)
+            checks.check(f"{name}: {manager} pruned after the master status was read", pruned is not None and
+                         first_containing(manager, "master_status.txt") < pruned, pruned)
+        persisted = [call for call in calls if call[0] == "put" and call[1] == "proxy" and "shard_map.json" in call[2]]
+        checks.check(f"{name}: shard map with the workers sent last", len(persisted) == 2
+                     and not any(file.endswith(".py") for file in persisted[-1][2]))
+
+    gatekeeper_ports = {port for port in (5000, 5001) if first_containing("gatekeeper", f"127.0.0.1/{port}")}
+    checks.check(f"{name}: gatekeeper probed on its ports", gatekeeper_ports == ({5000, 5001} if pipeline else {5000}),
+                 gatekeeper_ports)
+
+    # Security groups change once every service answered
+    last_probe = max(i for i, call in enumerate(calls) if call[0] == "run" and "/dev/tcp" in call[2])
+    changes = [(i, call) for i, call in enumerate(calls) if call[0] == "modify_instance_attribute"]
+    checks.check(f"{name}: security groups changed after the services answered",
+                 all(i > last_probe and call[2] == "sg-private" for i, call in changes)
+                 and {call[1] for _, call in changes} == {instance.id for instance_name, instance in instances.items()
+                                                          if instance_name != "gatekeeper"}, changes)
+
+
+def main_harness():
+    parser = argparse.ArgumentParser(description="Check provision_cluster against fake EC2 and SSH")
+    parser.parse_args()
+
+    # Provisioning writes the IP files into the working directory
+    os.chdir(tempfile.mkdtemp(prefix="provision-harness-"))
+    main.READINESS_INTERVAL = 0.01
+    checks = Checks()
+
+    check_cluster(checks, "single group", num_shards=1, num_workers=2, pipeline=False)
+    check_cluster(checks, "sharded with pipeline", num_shards=2, num_workers=2, pipeline=True)
+
+    # A worker whose MySQL never comes up stops the provisioning once the readiness timeout passed
+    main.READINESS_TIMEOUT = 0.2
+    recorder, _, error = provision(1, 1, False, {"broken": ("mysqladmin ping",)})
+    attempts = recorder.matching(lambda call: call[0] == "run" and "mysqladmin ping" in call[2])
+    checks.check("readiness timeout raised", isinstance(error, TimeoutError) and len(attempts) > 2,
+                 (error, len(attempts)))
+    checks.check("no security group changed after the timeout",
+                 not recorder.matching(lambda call: call[0] == "modify_instance_attribute"))
+
+    print(f"{checks.failed} checks failed" if checks.failed else "All checks passed")
+    sys.exit(1 if checks.failed else 0)
+
+
+if __name__ == "__main__":
+    main_harness()
@@ -1,32 +1,430 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 import requests
 import random
 import time
+import threading
+import os
+import re
+import json
+import zlib
+import http_client
+import metrics
+import codec
+import shared_state
+import sharding
+import pagination
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FutureTimeout, wait
 
 app = Flask(__name__)
+metrics.instrument(app, "proxy")
+
+WORKERS_FILE = 'workers_ip.txt'
+
+
+def read_worker_urls():
+    """
+    Function to read the replica membership file, any number of whitespace separated IPs
+    Returns:
+        List of worker URLs, empty if the file does not exist
+    """
+    try:
+        with open(WORKERS_FILE, 'r') as file:
+            return [f"http://{ip}:5000" for ip in file.read().split()]
+    except FileNotFoundError:
+        print(f"No {WORKERS_FILE} found.")
+        return []
 
-try:
-    with open('workers_ip.txt', 'r') as file:
-        worker_ip1, worker_ip2 = file.read().strip().split()
 
+try:
     with open('manager_ip.txt', 'r') as file:
         manager_ip = file.read().strip()
 except FileNotFoundError:
     print("No files found.")
 
 manager_url = f"http://{manager_ip}:5000"
-worker_urls = [f"http://{worker_ip1}:5000", f"http://{worker_ip2}:5000"]
 
-worker_index = 0
+# Tables and key ranges spread over several manager and replica groups, the first group is the one of
+# manager_ip.txt and workers_ip.txt. Without a shard map there is one group
+shard_map = sharding.load_shard_map()
+if shard_map is not None:
+    manager_url = shard_map.managers[0]
+manager_urls = shard_map.managers if shard_map is not None else [manager_url]
+
+# Round-robin position, shared by the processes of a multi-process server so they take turns as one
+round_robin = shared_state.SharedCounters("round_robin", 1)
+
+# Keep-alive session to the manager and workers
+session = http_client.create_session()
+
+# Worker health tracker configuration
+PROBE_INTERVAL = float(os.environ.get("PROBE_INTERVAL", 1))
+PROBE_TIMEOUT = float(os.environ.get("PROBE_TIMEOUT", 2))
+EWMA_ALPHA = float(os.environ.get("EWMA_ALPHA", 0.3))
+ERROR_PENALTY = 10
+# Replicas further behind the manager than this are not read from
+MAX_REPLICATION_LAG = float(os.environ.get("MAX_REPLICATION_LAG", 2))
+# Static weights of the weighted strategy in the order of workers_ip.txt, e.g. "3,1"
+WORKER_WEIGHTS = [float(weight) for weight in os.environ.get("WORKER_WEIGHTS", "").split(",") if weight.strip()]
+# Seconds to wait for a database before the request fails
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", 30))
+
+# Circuit breaker configuration, a worker is ejected after BREAKER_FAILURES consecutive failures
+# and readmitted once a probe succeeds after BREAKER_COOLDOWN seconds
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 10))
+
+# Hedged read configuration, a SELECT is sent to a second replica when the first one has not
+# answered within its recent p95 service time
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "1") == "1"
+HEDGE_WINDOW = int(os.environ.get("HEDGE_WINDOW", 200))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+HEDGE_MIN_DELAY_MS = float(os.environ.get("HEDGE_MIN_DELAY_MS", 2))
+# At most this fraction of the reads is hedged, so a slow cluster is not flooded with duplicates
+HEDGE_MAX_RATIO = float(os.environ.get("HEDGE_MAX_RATIO", 0.1))
+HEDGE_THREADS = int(os.environ.get("HEDGE_THREADS", 64))
+
+# Request coalescing configuration, identical concurrent SELECTs share one execution and the requests
+# joining it wait at most SINGLE_FLIGHT_TIMEOUT seconds for its result
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") == "1"
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get("SINGLE_FLIGHT_TIMEOUT", 10))
+# Threads sending the queries that run on several shards of the shard map
+SHARD_THREADS = int(os.environ.get("SHARD_THREADS", 64))
+# Threads sending the groups of the batches to the databases
+BATCH_THREADS = int(os.environ.get("BATCH_THREADS", 64))
+
+
+class WorkerTracker:
+    """
+    Thread-safe registry of the workers with EWMA latency, error rate, load and replication state per worker.
+    Measurements are per process, the membership is applied by every process with sync
+    Args:
+        alpha: Weight of the newest sample
+    """
+    def __init__(self, alpha=EWMA_ALPHA):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._table = {}
+        self._best = {}
+        self._workers = []
+        self._fresh = {}
+
+    @staticmethod
+    def _new_entry(weight, origin, shard):
+        return {"latency_ms": None, "error_rate": 0.0, "samples": 0, "last_seen": None, "replication": None,
+                "in_flight": 0, "service_ms": None, "weight": weight, "draining": False, "origin": origin,
+                "shard": shard, "breaker": "closed", "failures": 0, "opened_at": None, "trips": 0,
+                "recent_ms": deque(maxlen=HEDGE_WINDOW)}
+
+    def sync(self, members, draining=()):
+        """
+        Apply the membership, workers that stay keep their measurements and requests in flight
+        to removed workers still finish
+        Args:
+            members: Dictionary of worker URL to (weight, origin, shard), origin is file or api
+            draining: Worker URLs no new requests are routed to
+        Returns:
+            Lists of added and removed worker URLs
+        """
+        with self._lock:
+            added = [worker for worker in members if worker not in self._table]
+            removed = [worker for worker in self._table if worker not in members]
+            for worker in removed:
+                del self._table[worker]
+            for worker, (weight, origin, shard) in members.items():
+                stats = self._table.get(worker)
+                if stats is None or stats["shard"] != shard:
+                    stats = self._table[worker] = self._new_entry(weight, origin, shard)
+                stats["weight"] = weight
+                stats["origin"] = origin
+                stats["draining"] = worker in draining
+            self._update()
+            return added, removed
+
+    def workers(self):
+        """
+        Returns:
+            List of registered worker URLs, including draining ones
+        """
+        return self._workers
+
+    def shard_of(self, worker):
+        """
+        Returns:
+            Replication group of the worker
+        """
+        with self._lock:
+            return self._table.get(worker, {}).get("shard", 0)
+
+    def record(self, worker, latency_ms, success):
+        """
+        Feed a probe or request timing into the table
+        Args:
+            worker: Worker URL
+            latency_ms: Measured round trip time in milliseconds
+            success: Whether the request succeeded
+        """
+        with self._lock:
+            stats = self._table.get(worker)
+            if stats is None:
+                return
+            if success:
+                if stats["latency_ms"] is None:
+                    stats["latency_ms"] = latency_ms
+                else:
+                    stats["latency_ms"] += self.alpha * (latency_ms - stats["latency_ms"])
+                stats["last_seen"] = time.time()
+            stats["error_rate"] += self.alpha * ((0.0 if success else 1.0) - stats["error_rate"])
+            stats["samples"] += 1
+            self._trip_breaker(stats, success)
+            self._update()
+
+    def _trip_breaker(self, stats, success):
+        # Called with the lock held. An open breaker ignores samples until the cooldown passed,
+        # then the next sample, normally the background probe, is the half-open trial
+        if stats["breaker"] == "open":
+            if time.time() - stats["opened_at"] < BREAKER_COOLDOWN:
+                return
+            stats["breaker"] = "half-open"
+        if success:
+            stats["breaker"] = "closed"
+            stats["failures"] = 0
+            return
+        stats["failures"] += 1
+        if stats["breaker"] == "half-open" or stats["failures"] >= BREAKER_FAILURES:
+            if stats["breaker"] == "closed":
+                stats["trips"] += 1
+            stats["breaker"] = "open"
+            stats["opened_at"] = time.time()
+
+    def begin(self, worker):
+        """
+        Count a request sent to a worker as in flight
+        Args:
+            worker: Worker URL, the manager is not tracked
+        """
+        with self._lock:
+            stats = self._table.get(worker)
+            if stats is not None:
+                stats["in_flight"] += 1
+
+    def end(self, worker, service_ms, success):
+        """
+        Count a request as finished and feed its service time into the table
+        Args:
+            worker: Worker URL, the manager is not tracked
+            service_ms: Time the worker took to answer in milliseconds
+            success: Whether the request succeeded
+        """
+        with self._lock:
+            stats = self._table.get(worker)
+            if stats is None:
+                return
+            stats["in_flight"] = max(stats["in_flight"] - 1, 0)
+            if success:
+                if stats["service_ms"] is None:
+                    stats["service_ms"] = service_ms
+                else:
+                    stats["service_ms"] += self.alpha * (service_ms - stats["service_ms"])
+                stats["recent_ms"].append(service_ms)
+
+    def hedge_delay(self, worker):
+        """
+        Returns:
+            Recent p95 service time of the worker in seconds, None if there are too few samples
+        """
+        with self._lock:
+            stats = self._table.get(worker)
+            if stats is None or len(stats["recent_ms"]) < HEDGE_MIN_SAMPLES:
+                return None
+            return max(self._p95(stats), HEDGE_MIN_DELAY_MS) / 1000
+
+    @staticmethod
+    def _p95(stats):
+        recent = sorted(stats["recent_ms"])
+        return recent[min(int(len(recent) * 0.95), len(recent) - 1)] if recent else None
+
+    def least_outstanding(self, exclude=None, shard=0):
+        """
+        Args:
+            exclude: Worker URL not to choose, e.g. the one a hedged read was already sent to
+            shard: Replication group to choose from
+        Returns:
+            Fresh worker URL with the fewest requests in flight, ties broken by service time, None if all lag
+        """
+        with self._lock:
+            candidates = [worker for worker in self._fresh.get(shard, []) if worker in self._table
+                          and worker != exclude]
+            if not candidates:
+                return None
+            fewest = min(self._table[worker]["in_flight"] for worker in candidates)
+            candidates = [worker for worker in candidates if self._table[worker]["in_flight"] == fewest]
+            return min(candidates, key=lambda w: (self._table[w]["service_ms"] or 0.0, random.random()))
+
+    def weighted(self, shard=0):
+        """
+        Args:
+            shard: Replication group to choose from
+        Returns:
+            Fresh worker URL drawn by static weight divided by the observed service time, None if all lag
+        """
+        with self._lock:
+            candidates = [worker for worker in self._fresh.get(shard, []) if worker in self._table]
+            if not candidates:
+                return None
+            known = [self._table[worker]["service_ms"] for worker in candidates
+                     if self._table[worker]["service_ms"]]
+            # Workers without samples yet get the average service time
+            default_ms = sum(known) / len(known) if known else 1.0
+            weights = [self._table[worker]["weight"] / (self._table[worker]["service_ms"] or default_ms)
+                       for worker in candidates]
+            if not any(weights):
+                return random.choice(candidates)
+            return random.choices(candidates, weights=weights)[0]
+
+    def record_replication(self, worker, replication):
+        """
+        Feed a replication status poll into the table
+        Args:
+            worker: Worker URL
+            replication: Status returned by the worker's /replication, None if it could not be read
+        """
+        with self._lock:
+            stats = self._table.get(worker)
+            if stats is None:
+                return
+            stats["replication"] = replication if replication is not None else {"error": "unavailable"}
+            self._update()
+
+    def _is_fresh(self, stats):
+        if stats["draining"] or stats["breaker"] != "closed":
+            return False
+        replication = stats["replication"]
+        if replication is None:
+            # Not polled yet
+            return True
+        lag = replication.get("lag_seconds")
+        return (replication.get("io_running") is not False and replication.get("sql_running") is not False
+                and lag is not None and lag <= MAX_REPLICATION_LAG)
+
+    def _update(self):
+        # Called with the lock held, precomputes the routing choices per replication group
+        self._workers = list(self._table)
+        fresh = {}
+        for worker, stats in self._table.items():
+            if self._is_fresh(stats):
+                fresh.setdefault(stats["shard"], []).append(worker)
+        self._fresh = fresh
+        self._best = {shard: min(workers, key=lambda w: self._score(self._table[w]))
+                      for shard, workers in fresh.items()}
+
+    def _score(self, stats):
+        if stats["latency_ms"] is None:
+            return float("inf")
+        return stats["latency_ms"] * (1 + ERROR_PENALTY * stats["error_rate"])
+
+    def best(self, shard=0):
+        """
+        Args:
+            shard: Replication group to choose from
+        Returns:
+            Worker URL with the lowest error weighted latency among the fresh replicas, None if all lag
+        """
+        return self._best.get(shard)
+
+    def fresh(self, shard=0):
+        """
+        Args:
+            shard: Replication group
+        Returns:
+            List of worker URLs within the replication lag threshold
+        """
+        return self._fresh.get(shard, [])
+
+    def snapshot(self):
+        with self._lock:
+            return {worker: dict({key: value for key, value in stats.items() if key != "recent_ms"},
+                                 score=stats["latency_ms"] and self._score(stats), fresh=self._is_fresh(stats),
+                                 p95_ms=self._p95(stats))
+                    for worker, stats in self._table.items()}
+
+
+tracker = WorkerTracker()
+
+# Membership changes made through the API: registered worker URL -> weight (None keeps the weight of the
+# membership file), deregistered and draining URLs.
+# Shared by the processes of a multi-process server, so a change reaches all of them
+membership_changes = shared_state.SharedDocument("worker_membership",
+                                                 {"registered": {}, "shards": {}, "removed": [], "draining": []})
+membership_version = None
+
+
+def get_membership_version():
+    """
+    Returns:
+        Value that changes when the membership file or the API changes are modified
+    """
+    mtime = os.path.getmtime(WORKERS_FILE) if os.path.exists(WORKERS_FILE) else None
+    return mtime, membership_changes.version()
+
+
+def get_members():
+    """
+    Function to combine the membership file and the workers of the shard map with the changes made through
+    the API. Deregistered workers stay out until they are registered again
+    Returns:
+        Dictionary of worker URL to (weight, origin, shard) and list of draining worker URLs
+    """
+    changes = membership_changes.read()
+    members = {}
+    for i, worker in enumerate(read_worker_urls()):
+        if worker not in changes["removed"]:
+            members[worker] = (WORKER_WEIGHTS[i] if i < len(WORKER_WEIGHTS) else 1.0, "file", 0)
+    for shard, workers in enumerate(shard_map.workers if shard_map is not None else []):
+        for worker in workers:
+            if worker not in changes["removed"]:
+                members[worker] = (1.0, "file", shard)
+    for worker, weight in changes["registered"].items():
+        if weight is None:
+            weight = members.get(worker, (1.0,))[0]
+        members[worker] = (weight, "api", changes["shards"].get(worker, 0))
+    return members, changes["draining"]
+
+
+def reload_workers():
+    """
+    Function to apply the membership file and the API changes to the worker registry
+    Returns:
+        Lists of added and removed worker URLs
+    """
+    global membership_version
+    membership_version = get_membership_version()
+    members, draining = get_members()
+    added, removed = tracker.sync(members, draining)
+    if added or removed:
+        print(f"Workers reloaded, added: {added} removed: {removed}")
+    return added, removed
+
+
+def refresh_workers():
+    """
+    Function to apply the membership again if another process or an edit of the file changed it
+    """
+    if get_membership_version() != membership_version:
+        reload_workers()
+
+
+reload_workers()
+
 
 # Function to calculate ping time to each worker
 def get_ping_times():
     ping_times = []
-    for worker in worker_urls:
+    for worker in tracker.workers():
         start_time = time.time()
         try:
             # Send a request to measure response time
-            response = requests.get(f"{worker}/ping", timeout=2)
+            response = session.get(f"{worker}/ping", timeout=PROBE_TIMEOUT)
             if response.status_code == 200:
                 round_trip_time = (time.time() - start_time) * 1000
                 ping_times.append((worker, round_trip_time))
@@ -38,65 +436,1003 @@ def get_ping_times():
     return ping_times
 
 
+def get_replication_status(worker):
+    """
+    Function to read the replication lag and thread state of a worker
+    Args:
+        worker: Worker URL
+    Returns:
+        Replication status, None if it could not be read
+    """
+    try:
+        response = session.get(f"{worker}/replication", timeout=PROBE_TIMEOUT)
+        if response.status_code == 200:
+            return response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        pass
+    return None
+
+
+def probe_workers():
+    """
+    Function to periodically ping the workers and poll their replication state in the background
+    and feed the tracker, picks up membership changes
+    """
+    while True:
+        refresh_workers()
+        for worker, round_trip_time in get_ping_times():
+            tracker.record(worker, round_trip_time, round_trip_time != float("inf"))
+            tracker.record_replication(worker, get_replication_status(worker))
+        time.sleep(PROBE_INTERVAL)
+
+
+threading.Thread(target=probe_workers, daemon=True).start()
+
+
+# Result cache configuration, disabled unless RESULT_CACHE_ENABLED=1
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "0") == "1"
+RESULT_CACHE_ENTRIES = int(os.environ.get("RESULT_CACHE_ENTRIES", 1000))
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", 64 * 1024 * 1024))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 30))
+# Invalidation counters shared by the processes of the server, tables are hashed into the slots
+RESULT_CACHE_GENERATION_SLOTS = int(os.environ.get("RESULT_CACHE_GENERATION_SLOTS", 4096))
+# Writes bump the table generations both the result cache and the coalescing of reads depend on
+TRACK_WRITES = RESULT_CACHE_ENABLED or SINGLE_FLIGHT_ENABLED
+
+# Table name with optional schema and alias, possibly a comma separated list. A JOIN directly after
+# a table is not its alias
+TABLE_ITEM = r"`?\w+`?(?:\.`?\w+`?)?(?:\s+(?:as\s+)?(?!join\b)\w+)?"
+TABLE_RE = re.compile(rf"\b(?:from|join|into|update)\s+((?:{TABLE_ITEM}\s*,\s*)*{TABLE_ITEM})", re.IGNORECASE)
+
+
+def get_tables(query):
+    """
+    Function to find the tables a query reads or writes
+    Args:
+        query: SQL query
+    Returns:
+        Set of lowercase table names without schema
+    """
+    tables = set()
+    for match in TABLE_RE.finditer(query):
+        for name in match.group(1).split(","):
+            tables.add(name.split()[0].replace("`", "").split(".")[-1].lower())
+    return tables
+
+
+def normalize_query(query):
+    """
+    Function to normalize a query into a cache key
+    Args:
+        query: SQL query
+    Returns:
+        Query with collapsed whitespace and no trailing semicolon
+    """
+    return " ".join(query.split()).rstrip(";").rstrip()
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of SELECT results bounded by entries and bytes, invalidated per table.
+    Every process caches its own results, the invalidations are counted in shared generations so
+    a write through one process invalidates the results of all of them
+    Args:
+        max_entries: Maximum number of cached results
+        max_bytes: Maximum total size of the cached response bodies
+        ttl: Seconds a result stays valid
+        generation_slots: Number of shared invalidation counters
+    """
+    def __init__(self, max_entries, max_bytes, ttl, generation_slots=RESULT_CACHE_GENERATION_SLOTS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (response data, source, tables, size, expires_at, generation)
+        self._bytes = 0
+        # Slot 0 counts the invalidations of all tables, a hash collision only invalidates too much
+        self._generations = shared_state.SharedCounters("result_cache_generations", generation_slots + 1)
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def _slots(self, tables):
+        return [0] + sorted({1 + zlib.crc32(table.encode()) % (self._generations.size - 1) for table in tables})
+
+    def generation(self, tables):
+        """
+        Returns:
+            Snapshot of the table generations, taken before a read is sent
+        """
+        return tuple(self._generations.get(slot) for slot in self._slots(tables))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry[4] < time.monotonic():
+                self._remove(key)
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            if entry[5] != self.generation(entry[2]):
+                # A table was written through another process
+                self._remove(key)
+                self.stats["invalidations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0], entry[1]
+
+    def put(self, key, response_data, source, tables, size, generation):
+        """
+        Store a result unless one of its tables was written while the read was in flight
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation(tables):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (response_data, source, tables, size, time.monotonic() + self.ttl, generation)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def invalidate(self, tables):
+        """
+        Drop every result read from one of the tables, all results if the tables are unknown
+        Args:
+            tables: Set of written tables
+        """
+        for slot in self._slots(tables)[1:] if tables else [0]:
+            self._generations.increment(slot)
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if not tables or entry[2] & tables:
+                    self._remove(key)
+                    self.stats["invalidations"] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[3]
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes, enabled=RESULT_CACHE_ENABLED)
+
+
+result_cache = ResultCache(RESULT_CACHE_ENTRIES, RESULT_CACHE_BYTES, RESULT_CACHE_TTL)
+
+
+def get_query_type(query):
+    """
+    Function to determine the query type based on the query content
+    Args:
+        query: SQL query
+    Returns:
+        select, insert, delete or other
+    """
+    query = query.strip().lower()
+    if query.startswith("select"):
+        return "select"
+    elif query.startswith("insert"):
+        return "insert"
+    elif query.startswith("delete"):
+        return "delete"
+    return "other"
+
+
+def choose_read_target(routing_strategy, shard=0):
+    """
+    Function to pick the database for a read, replicas lagging behind the manager are skipped
+    Args:
+        routing_strategy: Requested routing strategy
+        shard: Replication group holding the rows
+    Returns:
+        Target URL and the applied routing strategy
+    """
+    fresh_workers = tracker.fresh(shard)
+    if routing_strategy == "direct":
+        # Forward to the manager
+        return manager_urls[shard], routing_strategy
+    elif not fresh_workers:
+        # All replicas lag, read from the manager
+        return manager_urls[shard], routing_strategy
+    elif routing_strategy == "random":
+        # Randomly choose a worker
+        return random.choice(fresh_workers), routing_strategy
+    elif routing_strategy == "customized":
+        # Choose the worker with the lowest latency measured in the background
+        return tracker.best(shard) or manager_urls[shard], routing_strategy
+    elif routing_strategy == "least-outstanding":
+        # Choose the worker with the fewest requests in flight
+        return tracker.least_outstanding(shard=shard) or manager_urls[shard], routing_strategy
+    elif routing_strategy == "weighted":
+        # Choose a worker by its static weight adapted to the observed service time
+        return tracker.weighted(shard) or manager_urls[shard], routing_strategy
+
+    # Default to round-robin
+    position = round_robin.increment(0) - 1
+    return fresh_workers[position % len(fresh_workers)], "round-robin"
+
+
+def describe_source(query_type, routing_strategy, target_url):
+    """
+    Function to describe which database answered, returned to the client as source
+    Args:
+        query_type: Query type
+        routing_strategy: Applied routing strategy
+        target_url: URL of the database
+    Returns:
+        Source description
+    """
+    if query_type != "select" and query_type != "other":
+        return "manager" if shard_map is None else f"manager of shard {manager_urls.index(target_url)}"
+    if target_url in manager_urls and routing_strategy not in ("direct", "pinned"):
+        return f"{routing_strategy} fallback to manager, replicas lagging"
+    source = f"{routing_strategy} worker IP: {target_url.split('//')[1].split(':')[0]}"
+    if routing_strategy == "customized":
+        source = f"{source}, latency: {tracker.snapshot().get(target_url, {}).get('latency_ms')} ms"
+    return source
+
+
+def track_stream(response, target_url, start_time):
+    """
+    Function to pass a streamed body through and keep the request in flight until the last row
+    Args:
+        response: requests Response opened with stream=True
+        target_url: URL of the database
+        start_time: Time the request was sent
+    Returns:
+        Generator of raw body chunks
+    """
+    success = False
+    try:
+        yield from http_client.iter_stream(response)
+        success = response.status_code < 500
+    finally:
+        tracker.end(target_url, (time.time() - start_time) * 1000, success)
+
+
+def send_execute(target_url, modified_data, stream=False, headers=None):
+    """
+    Function to send a query to a database and feed the timing into the tracker
+    Args:
+        target_url: URL of the database
+        modified_data: Payload of /execute
+        stream: Whether the body is streamed, the request then stays in flight until track_stream ends
+        headers: Headers passed upstream, see http_client.upstream_headers
+    Returns:
+        requests Response and the time the request was sent
+    """
+    start_time = time.time()
+    tracker.begin(target_url)
+    try:
+        # Opened as a stream so compact bodies can be read without decoding their Content-Encoding
+        response = session.post(f"{target_url}/execute", json=modified_data, stream=True, timeout=UPSTREAM_TIMEOUT,
+                                headers=headers)
+        if not stream:
+            http_client.read_body(response)
+    except requests.exceptions.RequestException:
+        elapsed_ms = (time.time() - start_time) * 1000
+        tracker.end(target_url, elapsed_ms, False)
+        tracker.record(target_url, elapsed_ms, False)
+        raise
+    elapsed_ms = (time.time() - start_time) * 1000
+    tracker.record(target_url, elapsed_ms, response.status_code < 500)
+    if not stream:
+        tracker.end(target_url, elapsed_ms, response.status_code < 500)
+    return response, start_time
+
+
+class HedgeStats:
+    """
+    Thread-safe counters of the hedged reads
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {"reads": 0, "hedges": 0, "wins": 0, "skipped": 0}
+
+    def increment(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def allow_hedge(self):
+        """
+        Returns:
+            True and counts the hedge if the hedge budget is not used up
+        """
+        with self._lock:
+            if self.stats["hedges"] >= HEDGE_MAX_RATIO * self.stats["reads"]:
+                self.stats["skipped"] += 1
+                return False
+            self.stats["hedges"] += 1
+            return True
+
+    def get_stats(self):
+        with self._lock:
+            reads = self.stats["reads"]
+            return dict(self.stats, enabled=HEDGE_ENABLED, hedge_rate=self.stats["hedges"] / reads if reads else 0.0,
+                        win_rate=self.stats["wins"] / self.stats["hedges"] if self.stats["hedges"] else 0.0)
+
+
+hedge_stats = HedgeStats()
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_THREADS)
+
+
+def hedged_read(target_url, modified_data, headers=None):
+    """
+    Function to send a read to a worker and to a second worker as well if the first one is slower than its
+    recent p95 or cannot be reached, the first successful answer wins. An error the worker answered with, e.g.
+    a SQL error, is returned as it is, the query would fail on the other worker too
+    Args:
+        target_url: URL of the chosen worker
+        modified_data: Payload of /execute
+        headers: Headers passed upstream, see http_client.upstream_headers
+    Returns:
+        requests Response and the URL of the database that answered
+    """
+    hedge_stats.increment("reads")
+    primary = hedge_executor.submit(send_execute, target_url, modified_data, False, headers)
+    try:
+        response, _ = primary.result(timeout=tracker.hedge_delay(target_url) or UPSTREAM_TIMEOUT)
+        return response, target_url
+    except (FutureTimeout, requests.exceptions.RequestException):
+        pass
+
+    backup_url = tracker.least_outstanding(exclude=target_url, shard=tracker.shard_of(target_url))
+    if backup_url is None or not hedge_stats.allow_hedge():
+        response, _ = primary.result()
+        return response, target_url
+
+    backup = hedge_executor.submit(send_execute, backup_url, modified_data, False, headers)
+    urls = {primary: target_url, backup: backup_url}
+    pending = set(urls)
+    fallback = None
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response, _ = future.result()
+            except requests.exceptions.RequestException as e:
+                error = e
+                continue
+            if response.status_code < 500:
+                if future is backup:
+                    hedge_stats.increment("wins")
+                # The slower request finishes in the background and is discarded
+                return response, urls[future]
+            fallback = (response, urls[future])
+    if fallback is not None:
+        return fallback
+    raise error
+
+
+def send_read(target_url, modified_data, headers=None):
+    """
+    Function to send a SELECT, hedged if enabled and it goes to a replica
+    Args:
+        target_url: URL of the chosen database
+        modified_data: Payload of /execute
+        headers: Headers passed upstream, see http_client.upstream_headers
+    Returns:
+        requests Response and the URL of the database that answered
+    """
+    if HEDGE_ENABLED and target_url not in manager_urls:
+        return hedged_read(target_url, modified_data, headers)
+    response, _ = send_execute(target_url, modified_data, False, headers)
+    return response, target_url
+
+
+class CoalescingTimeout(Exception):
+    pass
+
+
+class SingleFlight:
+    """
+    Thread-safe coalescing of identical concurrent reads. The first request of a key executes the read,
+    the ones arriving while it is in flight wait for its result instead of sending their own.
+    Requests only join a read that started after the last write to its tables
+    Args:
+        timeout: Seconds a joining request waits for the result
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._flights = {}  # key -> flight
+        self.stats = {"leaders": 0, "followers": 0, "timeouts": 0}
+
+    def run(self, key, generation, function):
+        """
+        Function to execute a read or join the identical one in flight
+        Args:
+            key: Read key, equal for requests that can share a response
+            generation: Table generations taken before the read, see ResultCache.generation
+            function: Executes the read
+        Returns:
+            Result of the function and True if it came from another request
+        Raises:
+            CoalescingTimeout: The read in flight did not finish within the timeout
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None or flight["generation"] != generation
+            if leader:
+                flight = self._flights[key] = {"generation": generation, "done": threading.Event(),
+                                               "result": None, "error": None}
+            self.stats["leaders" if leader else "followers"] += 1
+
+        if leader:
+            try:
+                flight["result"] = function()
+                return flight["result"], False
+            except Exception as e:
+                flight["error"] = e
+                raise
+            finally:
+                with self._lock:
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+                flight["done"].set()
+
+        if not flight["done"].wait(self.timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise CoalescingTimeout(f"No result of the identical query in flight within {self.timeout} s")
+        if flight["error"] is not None:
+            raise flight["error"]
+        return flight["result"], True
+
+    def get_stats(self):
+        with self._lock:
+            reads = self.stats["leaders"] + self.stats["followers"]
+            return dict(self.stats, enabled=SINGLE_FLIGHT_ENABLED, in_flight=len(self._flights),
+                        dedup_ratio=self.stats["followers"] / reads if reads else 0.0)
+
+
+single_flight = SingleFlight(SINGLE_FLIGHT_TIMEOUT)
+# Queries running on several shards are sent to the groups in parallel
+shard_executor = ThreadPoolExecutor(max_workers=SHARD_THREADS)
+# The groups of a batch run in parallel
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_THREADS)
+
+
+QUERY_LATENCY = metrics.REGISTRY.histogram("proxy_query_duration_seconds",
+                                           "Time to route and answer a query per strategy and query type",
+                                           ("strategy", "query_type"))
+QUERY_RESULTS = metrics.REGISTRY.counter("proxy_queries", "Queries per strategy, query type and status",
+                                         ("strategy", "query_type", "status"))
+SHARD_QUERIES = metrics.REGISTRY.counter("proxy_shard_queries", "Queries per replication group and query type",
+                                         ("shard", "query_type"))
+PAGE_QUERIES = metrics.REGISTRY.counter("proxy_pages", "Pages of paginated SELECTs, follow-up pages by whether "
+                                        "they stayed on the database of the previous page", ("page",))
+STRATEGIES = ("direct", "random", "customized", "least-outstanding", "weighted", "round-robin", "pinned")
+WORKER_FIELDS = ("in_flight", "latency_ms", "service_ms", "p95_ms", "error_rate", "fresh", "trips")
+metrics.REGISTRY.gauge("proxy_worker", "Routing state per worker", ("worker", "field"),
+                       callback=lambda: {(worker, field): float(stats[field] or 0)
+                                         for worker, stats in tracker.snapshot().items() for field in WORKER_FIELDS})
+metrics.REGISTRY.gauge("proxy_worker_breaker_open", "1 while the circuit breaker of a worker is not closed",
+                       ("worker",), callback=lambda: {(worker,): float(stats["breaker"] != "closed")
+                                                      for worker, stats in tracker.snapshot().items()})
+metrics.REGISTRY.gauge("proxy_hedging", "Hedged read counters", ("counter",),
+                       callback=lambda: {(name,): float(value) for name, value in hedge_stats.get_stats().items()})
+metrics.REGISTRY.gauge("proxy_result_cache", "Result cache counters", ("counter",),
+                       callback=lambda: {(name,): float(value) for name, value in result_cache.get_stats().items()})
+metrics.REGISTRY.gauge("proxy_single_flight", "Coalesced read counters and the fraction of reads that joined another",
+                       ("counter",),
+                       callback=lambda: {(name,): float(value) for name, value in single_flight.get_stats().items()})
+
+
+@app.after_request
+def record_query(response):
+    # Labels are set by route_query once the strategy is known
+    labels = g.pop("query_labels", None)
+    if labels is not None:
+        QUERY_LATENCY.labels(*labels).observe(time.perf_counter() - g.query_start)
+        QUERY_RESULTS.labels(*labels, response.status_code).inc()
+    return response
+
+
 @app.route("/query", methods=["POST"])
 def proxy_query():
-    global worker_index
-    data = request.get_json()
+    return route_query(request.get_json())
+
+
+def route_query(data):
+    """
+    Function to send a query to the database chosen by its type and routing strategy,
+    repeated reads are served from the result cache
+    Args:
+        data: Query payload with query, params, strategy and stream, paginated SELECTs with page_size and cursor
+    Returns:
+        Flask response
+    """
+    g.query_start = time.perf_counter()
     query = data.get("query")
     routing_strategy = data.get("strategy", "round-robin")  # Default to round-robin if not specified
+    params = data.get("params")
 
     if not query:
         return jsonify({"error": "Missing 'query' in request"}), 400
 
     # Determine query type based on the query content
-    query_type = "select" if query.strip().lower().startswith("select") else "insert"
-    if query.strip().lower().startswith("select"):
-        query_type = "select"
-    elif query.strip().lower().startswith("insert"):
-        query_type = "insert"
-    elif query.strip().lower().startswith("delete"):
-        query_type = "delete"
-    else:
-        query_type = "other"
-
-    if query_type == "select" or query_type == "other":
-        # Implement routing strategies
-        if routing_strategy == "direct":
-            # Forward to the manager
-            target_url = manager_url
-        elif routing_strategy == "random":
-            # Randomly choose a worker
-            target_url = random.choice(worker_urls)
-        elif routing_strategy == "customized":
-            # Choose the worker with the lowest ping time
-            ping_times = get_ping_times()
-            target_url = min(ping_times, key=lambda x: x[1])[0]
-        else:
-            # Default to round-robin
-            routing_strategy = "round-robin"
-            target_url = worker_urls[worker_index]
-            worker_index = (worker_index + 1) % len(worker_urls)
+    query_type = get_query_type(query)
+
+    # Only SELECT results are streamed
+    stream = bool(data.get("stream", False)) and query_type == "select"
+
+    # A paginated SELECT runs as the query of one page, the next page starts after the key of its last row
+    page = None
+    if data.get("page_size") is not None or data.get("cursor"):
+        if query_type != "select":
+            return jsonify({"error": "Only SELECT queries can be paginated"}), 400
+        try:
+            page = pagination.open_page(query, params, data.get("page_size"), data.get("cursor"))
+        except pagination.PaginationError as e:
+            return jsonify({"error": str(e)}), 400
+        query, params, stream = page["query"], page["params"], False
+
+    # With a shard map the query runs on the group holding its rows, or on several groups
+    shard = 0
+    if shard_map is not None:
+        try:
+            groups = shard_map.route(query_type, query, params, get_tables(query))
+        except sharding.ShardingError as e:
+            return jsonify({"error": str(e)}), 400
+        if len(groups) > 1:
+            response_data, status, routing_strategy = run_on_shards(query_type, query, groups, routing_strategy)
+            # Pages merged from several groups are not pinned
+            response_data, status = finish_page(page, response_data, status, None)
+            g.query_labels = (routing_strategy if query_type in ("select", "other") else "manager", query_type)
+            if stream and status == 200:
+                # The merged rows of several shards are sent at once
+                return codec.compress_response(Response("".join(json.dumps(row) + "\n"
+                                                                for row in response_data["result"]),
+                                                        status=200, mimetype="application/x-ndjson",
+                                                        headers={"X-Source": response_data["source"]}),
+                                               request.headers.get("Accept-Encoding"))
+            return jsonify(response_data), status
+        shard = groups[0][0]
+
+    # Serve repeated reads from the result cache, identical reads in flight are coalesced
+    cacheable = coalesce = False
+    if query_type == "select" and not stream and TRACK_WRITES:
+        cache_key = normalize_query(query) if params is None else f"{normalize_query(query)}\0{json.dumps(params)}"
+        if page is None and codec.MSGPACK_MIMETYPE in request.headers.get("Accept", ""):
+            # Compact and JSON results are kept separately, per compression as well
+            cache_key = f"{cache_key}\0{codec.MSGPACK_MIMETYPE}\0{request.headers.get('Accept-Encoding', '')}"
+        # Reads of unknown tables cannot be invalidated by writes
+        tables = get_tables(query)
+        cacheable = RESULT_CACHE_ENABLED and bool(tables)
+        coalesce = SINGLE_FLIGHT_ENABLED and bool(tables)
+    if cacheable:
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            response_data, source = cached
+            g.query_labels = ("cache", query_type)
+            metrics.add_timing("route", time.perf_counter() - g.query_start)
+            if isinstance(response_data, tuple):
+                # Compact result, stored as headers and bytes
+                return Response(response_data[1], status=200,
+                                headers=dict(response_data[0], **{"X-Source": f"cache ({source})"}))
+            response_data, status = finish_page(page, dict(response_data, source=f"cache ({source})"), 200,
+                                                page and page["replica"])
+            return jsonify(response_data), status
+    if cacheable or coalesce:
+        generation = result_cache.generation(tables)
+
+    if page is not None and page["replica"] is not None and (page["replica"] in tracker.fresh(shard)
+                                                             or page["replica"] == manager_urls[shard]):
+        # Follow-up pages stay on the database of the previous page while it is registered and not lagging
+        target_url, routing_strategy = page["replica"], "pinned"
+    elif query_type == "select" or query_type == "other":
+        target_url, routing_strategy = choose_read_target(routing_strategy, shard)
     else:
         # Non-select queries go to the manager
-        target_url = manager_url
+        target_url = manager_urls[shard]
+    SHARD_QUERIES.labels(shard, query_type).inc()
+    if page is not None:
+        PAGE_QUERIES.labels("first" if page["replica"] is None else
+                            "pinned" if routing_strategy == "pinned" else "moved").inc()
+    if query_type in ("select", "other"):
+        # Unknown strategies fall back to round-robin, keep the label values bounded
+        g.query_labels = (routing_strategy if routing_strategy in STRATEGIES else "round-robin", query_type)
+    else:
+        g.query_labels = ("manager", query_type)
 
-    modified_data = {"type": query_type, "query": query}
+    modified_data = {"type": query_type, "query": query, "params": params, "stream": stream}
+    metrics.add_timing("route", time.perf_counter() - g.query_start)
+    # Pages are cut here, so their rows come back as JSON
+    upstream_headers = http_client.upstream_headers() if page is None else metrics.trace_headers()
 
     try:
         # Forward the query to the selected target database
-        response = requests.post(f"{target_url}/execute", json=modified_data)
-        response_data = response.json()
-        if query_type == "select" or query_type == "other":
-            worker_type = f"{routing_strategy} worker IP: {target_url.split("//")[1].split(":")[0]}"
-            if routing_strategy == "customized":
-                worker_type = f"{worker_type}, ping times: {ping_times}"
-        else:
-            worker_type = "manager"
+        shared = False
+        try:
+            if coalesce:
+                # Reads from the manager only join reads from the manager
+                (response, answered_url), shared = single_flight.run(
+                    f"{cache_key}\0{target_url in manager_urls}", generation,
+                    lambda: send_read(target_url, modified_data, upstream_headers))
+            elif query_type == "select" and not stream:
+                response, answered_url = send_read(target_url, modified_data, upstream_headers)
+            else:
+                response, start_time = send_execute(target_url, modified_data, stream, upstream_headers)
+                answered_url = target_url
+        except requests.exceptions.RequestException:
+            if TRACK_WRITES and query_type in ("insert", "delete"):
+                # The write may have been applied before the connection failed
+                result_cache.invalidate(get_tables(query))
+            raise
+        if TRACK_WRITES and query_type in ("insert", "delete"):
+            # Written tables may have changed, unknown tables invalidate everything
+            result_cache.invalidate(get_tables(query))
+        metrics.forward_timing(response)
+        worker_type = describe_source(query_type, routing_strategy, answered_url)
+        if shared:
+            worker_type = f"{worker_type} (coalesced)"
+        elif answered_url != target_url:
+            worker_type = f"{worker_type} (hedged)"
+
+        if stream:
+            # Pass the NDJSON rows through without decoding them, the source travels as a header
+            headers = http_client.forward_headers(response)
+            headers["X-Source"] = worker_type
+            return Response(track_stream(response, target_url, start_time), status=response.status_code,
+                            headers=headers)
 
-        response_data["source"] = worker_type
-        return jsonify(response_data), response.status_code
+        if http_client.is_opaque(response):
+            # Compact results are forwarded as bytes, compressed ones stay compressed, the source travels as a header
+            body = http_client.read_body(response)
+            headers = http_client.forward_headers(response)
+            headers.pop("X-Source", None)
+            if cacheable and not shared and response.status_code == 200:
+                result_cache.put(cache_key, (headers, body), worker_type, tables, len(body), generation)
+            return Response(body, status=response.status_code, headers=dict(headers, **{"X-Source": worker_type}))
+
+        response_data = response.json()
+        if cacheable and not shared and response.status_code == 200:
+            result_cache.put(cache_key, response_data, worker_type, tables, len(response.content), generation)
+        response_data, status = finish_page(page, dict(response_data, source=worker_type), response.status_code,
+                                            answered_url)
+        return jsonify(response_data), status
     except requests.exceptions.RequestException as e:
         return jsonify({"error": str(e)}), 500
+    except CoalescingTimeout as e:
+        return jsonify({"error": str(e)}), 504
+
+
+def finish_page(page, response_data, status, replica):
+    """
+    Function to cut the rows of a successful page and add its continuation token
+    Args:
+        page: See pagination.open_page, None if the query is not paginated
+        response_data: Response dictionary
+        status: Status code
+        replica: URL of the database that answered, None if follow-up pages are not pinned
+    Returns:
+        Response dictionary and status code
+    """
+    if page is None or status != 200:
+        return response_data, status
+    try:
+        return pagination.finish_page(page, response_data, replica), status
+    except pagination.PaginationError as e:
+        return {"error": str(e)}, 400
+
+
+def run_on_shards(query_type, query, groups, routing_strategy):
+    """
+    Function to run a query on several shards in parallel. Reads go to a database of every group and their rows
+    are merged, writes go to the managers. A write failing on some groups stays applied on the others
+    Args:
+        query_type: Query type
+        query: SQL query as sent by the client
+        groups: List of (group, query, params), see sharding.ShardMap.route
+        routing_strategy: Requested routing strategy of the reads
+    Returns:
+        Response dictionary with the source, status code and the applied routing strategy
+    """
+    reading = query_type in ("select", "other")
+    if reading:
+        try:
+            merge = sharding.get_merge(query)
+        except sharding.ShardingError as e:
+            return {"error": str(e)}, 400, routing_strategy
+
+    targets = []
+    for shard, _, _ in groups:
+        if reading:
+            target_url, routing_strategy = choose_read_target(routing_strategy, shard)
+        else:
+            target_url = manager_urls[shard]
+        targets.append(target_url)
+        SHARD_QUERIES.labels(shard, query_type).inc()
+
+    def send(target_url, modified_data):
+        if reading:
+            return send_read(target_url, modified_data, headers)
+        return send_execute(target_url, modified_data, False, headers)[0], target_url
+
+    # The rows are merged here, so they come back as JSON
+    headers = metrics.trace_headers()
+    futures = [shard_executor.submit(send, target_url, {"type": query_type, "query": shard_query,
+                                                        "params": params, "stream": False})
+               for target_url, (_, shard_query, params) in zip(targets, groups)]
+    results = []
+    sources = []
+    errors = {}
+    for (shard, _, _), future in zip(groups, futures):
+        try:
+            response, answered_url = future.result()
+            response_data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            errors[shard] = (500, str(e))
+            continue
+        if response.status_code != 200:
+            errors[shard] = (response.status_code, response_data.get("error", "Query failed"))
+            continue
+        results.append(response_data.get("result", []))
+        sources.append(f"shard {shard}: {describe_source(query_type, routing_strategy, answered_url)}")
+    if TRACK_WRITES and not reading:
+        # Written tables may have changed, also when some groups failed
+        result_cache.invalidate(get_tables(query))
+
+    if errors:
+        response_data = {"error": "; ".join(f"shard {shard}: {error}" for shard, (_, error) in sorted(errors.items()))}
+        if not reading:
+            # Nothing is rolled back on the groups where the write succeeded
+            response_data["applied_shards"] = [shard for shard, _, _ in groups if shard not in errors]
+        return response_data, max(status for status, _ in errors.values()), routing_strategy
+    if reading:
+        return {"result": sharding.merge_rows(merge, results), "source": "; ".join(sources)}, 200, routing_strategy
+    return ({"message": "Query executed successfully",
+             "source": f"managers of shards {', '.join(str(shard) for shard, _, _ in groups)}"}, 200, routing_strategy)
+
+
+def execute_group(target_url, query_type, indices, queries, headers=None):
+    """
+    Function to execute a group of batch queries on one database
+    Args:
+        target_url: URL of the database
+        query_type: write for an ordered group of writes, read otherwise
+        indices: Positions of the queries in the batch
+        queries: All queries of the batch
+        headers: Headers passed upstream, see http_client.upstream_headers
+    Returns:
+        List of (position, result)
+    """
+    start_time = time.time()
+    success = False
+    tracker.begin(target_url)
+    try:
+        response = session.post(f"{target_url}/execute/batch",
+                                json={"type": query_type, "queries": [queries[i] for i in indices]},
+                                timeout=UPSTREAM_TIMEOUT, headers=headers)
+        success = response.status_code < 500
+        response_data = response.json()
+        if response.status_code == 200:
+            return list(zip(indices, response_data["results"]))
+        error = {"status": response.status_code, "error": response_data.get("error", "Batch failed")}
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        error = {"status": 500, "error": str(e)}
+    finally:
+        tracker.end(target_url, (time.time() - start_time) * 1000, success)
+        tracker.record(target_url, (time.time() - start_time) * 1000, success)
+    return [(i, error) for i in indices]
+
+
+@app.route("/query/batch", methods=["POST"])
+def proxy_batch():
+    data = request.get_json()
+    queries = data.get("queries") or []
+    error = http_client.get_batch_error(queries)
+    if error is not None:
+        return jsonify({"error": error}), 400
+    return jsonify({"results": route_batch(queries, data.get("strategy", "round-robin"))}), 200
+
+
+def route_batch(queries, routing_strategy):
+    """
+    Function to execute a batch. Writes keep their order on the manager, reads are spread over the databases
+    by the routing strategy. Both groups run in parallel, so a read does not see a write of the same batch.
+    With a shard map the writes keep their order per manager, queries running on several shards follow
+    once the groups are done
+    Args:
+        queries: List of queries
+        routing_strategy: Requested routing strategy of the reads
+    Returns:
+        List of results
+    """
+    groups = {}
+    sources = {}
+    scattered = {}
+    written_tables = set()
+    results = [None] * len(queries)
+    for i, query in enumerate(queries):
+        query_type = get_query_type(query)
+        shard = 0
+        if shard_map is not None:
+            try:
+                shard_groups = shard_map.route(query_type, query, None, get_tables(query))
+            except sharding.ShardingError as e:
+                results[i] = {"status": 400, "error": str(e)}
+                continue
+            if len(shard_groups) > 1:
+                scattered[i] = (query_type, shard_groups)
+                continue
+            shard = shard_groups[0][0]
+        SHARD_QUERIES.labels(shard, query_type).inc()
+        if query_type in ("insert", "delete"):
+            target_url, group_type = manager_urls[shard], "write"
+            sources[i] = describe_source(query_type, "manager", target_url)
+            written_tables |= get_tables(query) or {None}
+        else:
+            target_url, applied_strategy = choose_read_target(routing_strategy, shard)
+            group_type = "read"
+            sources[i] = describe_source(query_type, applied_strategy, target_url)
+        groups.setdefault((target_url, group_type), []).append(i)
+    upstream_headers = http_client.upstream_headers()
+    futures = [batch_executor.submit(execute_group, target_url, group_type, indices, queries, upstream_headers)
+               for (target_url, group_type), indices in groups.items()]
+    for future in futures:
+        for i, result in future.result():
+            results[i] = dict(result, source=sources[i])
+
+    for i, (query_type, shard_groups) in scattered.items():
+        response_data, status, _ = run_on_shards(query_type, queries[i], shard_groups, routing_strategy)
+        results[i] = dict(response_data, status=status)
+
+    if TRACK_WRITES and written_tables:
+        # Written tables may have changed, unknown tables invalidate everything
+        result_cache.invalidate(set() if None in written_tables else written_tables)
+    return results
+
+
+@app.route('/workers', methods=['GET'])
+def worker_status():
+    # Latency, error rate and load table used by the customized, least-outstanding and weighted strategies
+    refresh_workers()
+    return jsonify(tracker.snapshot()), 200
+
+
+def get_worker_url(data):
+    """
+    Function to build the worker URL of a membership request
+    Args:
+        data: Request body with ip and optional port
+    Returns:
+        Worker URL, None if the ip is missing
+    """
+    ip = (data or {}).get("ip")
+    if not ip:
+        return None
+    return f"http://{ip}:{int(data.get('port', 5000))}"
+
+
+@app.route('/workers/register', methods=['POST'])
+def register_worker():
+    # Membership changes are only accepted from local clients
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return jsonify({"error": "Forbidden"}), 403
+    data = request.get_json(silent=True)
+    worker = get_worker_url(data)
+    if worker is None:
+        return jsonify({"error": "Missing 'ip' in request"}), 400
+    # Without a weight a worker of the membership file keeps the one of WORKER_WEIGHTS
+    weight = None if data.get("weight") is None else float(data["weight"])
+    # Replication group the worker replicates, see the shard map
+    shard = int(data.get("shard", 0))
+    if not 0 <= shard < len(manager_urls):
+        return jsonify({"error": f"Unknown shard {shard}"}), 400
+
+    def register(changes):
+        # A registered worker gets the new weight and stops draining
+        changes["registered"][worker] = weight
+        changes["shards"][worker] = shard
+        changes["removed"] = [other for other in changes["removed"] if other != worker]
+        changes["draining"] = [other for other in changes["draining"] if other != worker]
+
+    refresh_workers()
+    added = worker not in tracker.workers()
+    membership_changes.update(register)
+    reload_workers()
+    return jsonify({"worker": worker, "added": added}), 200
+
+
+@app.route('/workers/deregister', methods=['POST'])
+def deregister_worker():
+    # Membership changes are only accepted from local clients
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return jsonify({"error": "Forbidden"}), 403
+    worker = get_worker_url(request.get_json(silent=True))
+    if worker is None:
+        return jsonify({"error": "Missing 'ip' in request"}), 400
+    refresh_workers()
+    if worker not in tracker.workers():
+        return jsonify({"error": f"Unknown worker {worker}"}), 404
+
+    def deregister(changes):
+        changes["registered"].pop(worker, None)
+        changes["shards"].pop(worker, None)
+        changes["removed"] = [other for other in changes["removed"] if other != worker] + [worker]
+        changes["draining"] = [other for other in changes["draining"] if other != worker]
+
+    membership_changes.update(deregister)
+    reload_workers()
+    return jsonify({"worker": worker, "removed": True}), 200
+
+
+@app.route('/workers/drain', methods=['POST'])
+def drain_worker():
+    # Stops new requests to the worker, poll in_flight until it reaches 0 before deregistering.
+    # With several processes in_flight counts the requests of the process that answered
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return jsonify({"error": "Forbidden"}), 403
+    worker = get_worker_url(request.get_json(silent=True))
+    if worker is None:
+        return jsonify({"error": "Missing 'ip' in request"}), 400
+    refresh_workers()
+    if worker not in tracker.workers():
+        return jsonify({"error": f"Unknown worker {worker}"}), 404
+
+    def drain(changes):
+        changes["draining"] = [other for other in changes["draining"] if other != worker] + [worker]
+
+    membership_changes.update(drain)
+    reload_workers()
+    return jsonify({"worker": worker, "in_flight": tracker.snapshot().get(worker, {}).get("in_flight", 0)}), 200
+
+
+@app.route('/workers/reload', methods=['POST'])
+def reload_worker_file():
+    # Re-read workers_ip.txt without a restart
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return jsonify({"error": "Forbidden"}), 403
+    added, removed = reload_workers()
+    return jsonify({"added": added, "removed": removed, "workers": tracker.workers()}), 200
+
+
+@app.route('/hedging', methods=['GET'])
+def hedging_stats():
+    # Hedge rate and wins, plus the circuit breaker state per worker
+    breakers = {worker: {"state": stats["breaker"], "trips": stats["trips"], "failures": stats["failures"]}
+                for worker, stats in tracker.snapshot().items()}
+    return jsonify({"hedging": hedge_stats.get_stats(), "breakers": breakers}), 200
+
+
+@app.route('/coalescing', methods=['GET'])
+def coalescing_stats():
+    # Coalesced reads and dedup ratio
+    return jsonify(single_flight.get_stats()), 200
+
+
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    # Result cache counters
+    return jsonify(result_cache.get_stats()), 200
+
+
+@app.route('/shards', methods=['GET'])
+def shard_status():
+    # Replication groups with their manager and registered workers, and the placement of the tables
+    workers = {}
+    for worker, stats in tracker.snapshot().items():
+        workers.setdefault(stats["shard"], []).append(worker)
+    return jsonify({"enabled": shard_map is not None,
+                    "groups": [{"manager": manager, "workers": workers.get(shard, [])}
+                               for shard, manager in enumerate(manager_urls)],
+                    "tables": shard_map.tables if shard_map is not None else {}}), 200
+
+
+@app.route('/connections', methods=['GET'])
+def connection_stats():
+    # Connection reuse statistics of the upstream session
+    return jsonify(http_client.get_stats(session)), 200
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
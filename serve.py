@@ -0,0 +1,121 @@
+import argparse
+import importlib
+import os
+import shutil
+import signal
+import tempfile
+from gunicorn.app.base import BaseApplication
+
+# Pre-fork server configuration shared by the four services
+SERVE_BIND = os.environ.get("SERVE_BIND", "0.0.0.0:5000")
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", os.cpu_count() or 1))
+SERVE_THREADS = int(os.environ.get("SERVE_THREADS", 16))
+# Seconds requests in flight get to finish on reload and shutdown
+SERVE_GRACEFUL_TIMEOUT = int(os.environ.get("SERVE_GRACEFUL_TIMEOUT", 30))
+# Seconds a process may stop responding before it is restarted
+SERVE_TIMEOUT = int(os.environ.get("SERVE_TIMEOUT", 60))
+# Idle keep-alive connections of the upstream tiers' sessions stay open this long
+SERVE_KEEPALIVE = int(os.environ.get("SERVE_KEEPALIVE", 75))
+
+SERVICES = {
+    "gatekeeper": "gatekeeper",
+    "trusted_host": "trusted_host",
+    "proxy": "proxy",
+    "worker": "worker_manager_app",
+    "manager": "worker_manager_app",
+    # Gatekeeper, trusted host and proxy in one process
+    "pipeline": "pipeline",
+}
+
+
+class ServiceApplication(BaseApplication):
+    """
+    Gunicorn application serving the Flask app of a service with several processes of several threads.
+    The app is imported in every process after the fork, so each process opens its own connections and
+    starts its own background threads, state the processes must agree on lives in shared_state
+    Args:
+        module: Module of the service defining app
+        options: Gunicorn settings
+    """
+    def __init__(self, module, options):
+        self.module = module
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        # Settings the installed gunicorn version does not know are skipped
+        for key, value in self.options.items():
+            if key in self.cfg.settings:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return importlib.import_module(self.module).app
+
+
+def on_starting(server):
+    # Created once by the master, the processes forked later and after a reload inherit it
+    if not os.environ.get("SHARED_STATE_DIR"):
+        os.environ["SHARED_STATE_DIR"] = tempfile.mkdtemp(prefix=f"cloud-db-{server.proc_name}-")
+
+
+def on_exit(server):
+    shutil.rmtree(os.environ.get("SHARED_STATE_DIR", ""), ignore_errors=True)
+
+
+def get_options(service, workers, threads, bind=SERVE_BIND):
+    """
+    Function to build the gunicorn settings of a service
+    Args:
+        service: Service name
+        workers: Number of processes
+        threads: Number of threads per process
+        bind: Address to listen on
+    Returns:
+        Dictionary of settings
+    """
+    return {
+        "bind": bind,
+        "workers": workers,
+        "worker_class": "gthread",
+        "threads": threads,
+        "graceful_timeout": SERVE_GRACEFUL_TIMEOUT,
+        "timeout": SERVE_TIMEOUT,
+        "keepalive": SERVE_KEEPALIVE,
+        "preload_app": False,
+        "proc_name": service,
+        "pidfile": f"{service}.pid",
+        # One per service, several services can run on one instance
+        "control_socket": f"{service}.ctl",
+        "on_starting": on_starting,
+        "on_exit": on_exit,
+    }
+
+
+def send_signal(service, signal_number):
+    """
+    Function to signal the master process of a running service
+    Args:
+        service: Service name
+        signal_number: SIGHUP reloads the code and replaces the processes gracefully, SIGTERM stops gracefully
+    """
+    with open(f"{service}.pid", "r") as file:
+        os.kill(int(file.read().strip()), signal_number)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a service with several processes")
+    parser.add_argument("service", choices=sorted(SERVICES))
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS, help="Number of processes")
+    parser.add_argument("--threads", type=int, default=SERVE_THREADS, help="Number of threads per process")
+    parser.add_argument("--bind", default=SERVE_BIND, help="Address to listen on")
+    parser.add_argument("--reload", action="store_true", help="Gracefully reload the running service")
+    parser.add_argument("--stop", action="store_true", help="Gracefully stop the running service")
+    args = parser.parse_args()
+
+    if args.reload:
+        send_signal(args.service, signal.SIGHUP)
+    elif args.stop:
+        send_signal(args.service, signal.SIGTERM)
+    else:
+        ServiceApplication(SERVICES[args.service],
+                           get_options(args.service, args.workers, args.threads, args.bind)).run()
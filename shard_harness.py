@@ -0,0 +1,361 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+# Local check of the proxy's shard routing. Every replication group is stood in by a manager and a worker
+# serving /execute on one SQLite database, the worker sees the writes of the manager at once.
+# The proxy is imported with a shard map pointing to them and the rows are looked up in the databases directly
+NUM_GROUPS = 3
+FIRST_PORT = 5700
+SCHEMA = [
+    "CREATE TABLE actor (actor_id INTEGER, first_name TEXT, last_name TEXT)",
+    "CREATE TABLE payment (payment_id INTEGER, amount NUMERIC)",
+    "CREATE TABLE staff (staff_id INTEGER, name TEXT)",
+    "CREATE TABLE category (category_id INTEGER, name TEXT)",
+    # Case-insensitive like the Sakila collation
+    "CREATE TABLE customer (customer_id INTEGER, last_name TEXT COLLATE NOCASE)",
+]
+TABLES = {
+    "actor": {"key": "actor_id"},
+    "payment": {"key": "payment_id", "ranges": [100, 200]},
+    "staff": {"shard": 2},
+    "customer": {"key": "last_name"},
+}
+
+
+class StandInDatabase:
+    """
+    SQLite database answering /execute like worker_manager_app.py, counting the queries per server
+    """
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.lock = threading.Lock()
+        self.queries = {"manager": [], "worker": []}
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+
+    def execute(self, role, query, params):
+        with self.lock:
+            self.queries[role].append(query)
+            # MySQL placeholders
+            cursor = self.conn.execute(query.replace("%s", "?"), params or [])
+            if query.strip().lower().startswith("select"):
+                columns = [column[0] for column in cursor.description]
+                return {"result": [dict(zip(columns, row)) for row in cursor.fetchall()]}
+            self.conn.commit()
+            return {"message": "Query executed successfully"}
+
+    def rows(self, query):
+        with self.lock:
+            return self.conn.execute(query).fetchall()
+
+
+def create_app(database, role):
+    """
+    Function to create the stand-in service of a manager or worker
+    Args:
+        database: StandInDatabase of the group
+        role: manager or worker
+    Returns:
+        Flask app
+    """
+    app = Flask(f"{role}")
+
+    @app.route('/execute', methods=['POST'])
+    def execute_query():
+        data = request.get_json()
+        try:
+            return jsonify(database.execute(role, data["query"], data.get("params"))), 200
+        except sqlite3.Error as e:
+            # Errors of the query itself, answered like the SQL errors of the worker
+            return jsonify({"error": str(e)}), 400
+
+    @app.route('/execute/batch', methods=['POST'])
+    def execute_batch():
+        data = request.get_json()
+        results = []
+        for query in data["queries"]:
+            try:
+                results.append(dict(database.execute(role, query, None), status=200))
+            except sqlite3.Error as e:
+                results.append({"status": 400, "error": str(e)})
+        return jsonify({"results": results}), 200
+
+    @app.route('/ping', methods=['GET'])
+    def ping():
+        return jsonify({"status": "ok"}), 200
+
+    @app.route('/replication', methods=['GET'])
+    def replication_status():
+        return jsonify({"io_running": True, "sql_running": True, "lag_seconds": 0}), 200
+
+    return app
+
+
+def start_groups(first_port):
+    """
+    Function to serve a manager and a worker per group in background threads
+    Args:
+        first_port: Port of the first server, the others follow
+    Returns:
+        List of StandInDatabase and the shard map document
+    """
+    databases = []
+    groups = []
+    for group in range(NUM_GROUPS):
+        database = StandInDatabase()
+        addresses = {}
+        for offset, role in enumerate(("manager", "worker")):
+            port = first_port + 2 * group + offset
+            server = make_server("127.0.0.1", port, create_app(database, role), threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            addresses[role] = f"127.0.0.1:{port}"
+        databases.append(database)
+        groups.append({"manager": addresses["manager"], "workers": [addresses["worker"]]})
+    return databases, {"groups": groups, "tables": TABLES}
+
+
+class Checks:
+    """
+    Collects the outcome of the checks
+    """
+    def __init__(self):
+        self.failed = 0
+
+    def check(self, name, condition, detail=""):
+        print(f"{'PASS' if condition else 'FAIL'} {name}{'' if condition else f': {detail}'}")
+        if not condition:
+            self.failed += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the shard routing of the proxy against stand-in databases")
+    parser.add_argument("--port", type=int, default=FIRST_PORT, help="Port of the first stand-in server")
+    args = parser.parse_args()
+
+    databases, document = start_groups(args.port)
+    # The proxy reads its files from the working directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="shard-harness-"))
+    with open("manager_ip.txt", "w") as file:
+        file.write("127.0.0.1")
+    with open("workers_ip.txt", "w") as file:
+        file.write("\n")
+    with open("shard_map.json", "w") as file:
+        json.dump(document, file)
+    os.environ["SHARD_MAP_FILE"] = "shard_map.json"
+    os.environ["RESULT_CACHE_ENABLED"] = "0"
+    import proxy
+    client = proxy.app.test_client()
+    checks = Checks()
+
+    def query(text, params=None, **fields):
+        response = client.post("/query", json=dict(fields, query=text, params=params))
+        return response.status_code, response.get_json()
+
+    def reset_counts():
+        for database in databases:
+            database.queries = {"manager": [], "worker": []}
+
+    def contacted(role):
+        return [group for group, database in enumerate(databases) if database.queries[role]]
+
+    def hash_group(value):
+        # Integer keys are placed like the interleaved AUTO_INCREMENT values of the groups
+        return (int(value) - 1) % NUM_GROUPS
+
+    # Hash sharded single and multi-row INSERTs, with literals and parameters
+    for actor_id in range(1, 11):
+        query(f"INSERT INTO actor (actor_id, first_name, last_name) VALUES ({actor_id}, 'First{actor_id}', 'Last')")
+    status, _ = query("INSERT INTO actor (actor_id, first_name, last_name) VALUES "
+                      + ", ".join(f"({actor_id}, 'First{actor_id}', 'Last')" for actor_id in range(11, 21)))
+    checks.check("multi-row INSERT split over the groups", status == 200, status)
+    status, _ = query("INSERT INTO actor (first_name, actor_id, last_name) VALUES (%s, %s, %s), (%s, %s, %s)",
+                      ["First21", 21, "Last", "First22", 22, "Last"])
+    checks.check("parameterized INSERT", status == 200, status)
+    placement = {actor_id: [group for group, database in enumerate(databases)
+                            if database.rows(f"SELECT 1 FROM actor WHERE actor_id = {actor_id}")]
+                 for actor_id in range(1, 23)}
+    wrong = {actor_id: groups for actor_id, groups in placement.items() if groups != [hash_group(actor_id)]}
+    checks.check("every actor in exactly the group of its hash", not wrong, wrong)
+    checks.check("actors spread over all groups", {groups[0] for groups in placement.values() if groups}
+                 == set(range(NUM_GROUPS)))
+
+    # Reads naming the shard key go to one replica, the others scatter and merge
+    reset_counts()
+    status, data = query("SELECT * FROM actor WHERE actor_id = 7")
+    checks.check("SELECT by shard key answered", status == 200 and [row["actor_id"] for row in data["result"]] == [7],
+                 data)
+    checks.check("SELECT by shard key read one replica", contacted("worker") == [hash_group(7)]
+                 and not contacted("manager"), contacted("worker"))
+    reset_counts()
+    status, data = query("SELECT * FROM actor WHERE actor_id = 07.0")
+    checks.check("numeric shard key normalized", status == 200 and [row["actor_id"] for row in data["result"]] == [7]
+                 and contacted("worker") == [hash_group(7)], (data, contacted("worker")))
+    reset_counts()
+    status, data = query("SELECT * FROM actor WHERE actor_id = %s AND last_name = 'Last'", [13])
+    checks.check("SELECT by parameterized shard key", status == 200 and contacted("worker") == [hash_group(13)]
+                 and len(data["result"]) == 1, data)
+    reset_counts()
+    status, data = query("SELECT * FROM actor WHERE last_name = 'Last'")
+    checks.check("scattered SELECT merges all rows", status == 200 and sorted(row["actor_id"] for row in data["result"])
+                 == list(range(1, 23)), data)
+    checks.check("scattered SELECT read every group", contacted("worker") == list(range(NUM_GROUPS)))
+    status, data = query("SELECT actor_id FROM actor WHERE last_name = 'Last' ORDER BY actor_id DESC LIMIT 5")
+    checks.check("scattered ORDER BY and LIMIT", status == 200 and [row["actor_id"] for row in data["result"]]
+                 == [22, 21, 20, 19, 18], data)
+    status, data = query("SELECT COUNT(*), MAX(actor_id) AS highest, MIN(first_name) FROM actor WHERE actor_id > 0")
+    checks.check("scattered aggregates", status == 200 and data["result"] == [
+        {"COUNT(*)": 22, "highest": 22, "MIN(first_name)": "First1"}], data)
+    status, data = query("SELECT last_name, COUNT(*) FROM actor WHERE actor_id > 0 GROUP BY last_name")
+    checks.check("scattered GROUP BY rejected", status == 400, (status, data))
+    response = client.post("/query", json={"query": "SELECT actor_id FROM actor WHERE last_name = 'Last' "
+                                                    "ORDER BY actor_id LIMIT 3", "stream": True})
+    checks.check("scattered stream as NDJSON", response.status_code == 200 and [
+        json.loads(line)["actor_id"] for line in response.get_data(as_text=True).splitlines()] == [1, 2, 3])
+
+    # SQL errors are the fault of the query, they leave the breaker of the replica closed
+    for _ in range(proxy.BREAKER_FAILURES + 1):
+        status, data = query("SELECT missing_column FROM actor WHERE actor_id = 7")
+    replica = f"http://{document['groups'][hash_group(7)]['workers'][0]}"
+    checks.check("SQL error answered as a client error", status == 400, (status, data))
+    checks.check("SQL errors not counted as failures", proxy.tracker.snapshot()[replica]["breaker"] == "closed",
+                 proxy.tracker.snapshot().get(replica))
+
+    # DELETE by shard key goes to one manager, otherwise to all of them
+    reset_counts()
+    status, _ = query("DELETE FROM actor WHERE actor_id = 7")
+    checks.check("DELETE by shard key on one manager", status == 200 and contacted("manager") == [hash_group(7)],
+                 contacted("manager"))
+    checks.check("deleted row gone", not databases[hash_group(7)].rows("SELECT 1 FROM actor WHERE actor_id = 7"))
+    reset_counts()
+    status, data = query("DELETE FROM actor WHERE first_name = 'First8'")
+    checks.check("DELETE without shard key on every manager", status == 200
+                 and contacted("manager") == list(range(NUM_GROUPS)), data)
+    checks.check("broadcast DELETE applied", not any(database.rows("SELECT 1 FROM actor WHERE actor_id = 8")
+                                                     for database in databases))
+    # Without the key the AUTO_INCREMENT of one group generates it, the stand-ins leave it NULL
+    for _ in range(NUM_GROUPS):
+        status, data = query("INSERT INTO actor (first_name, last_name) VALUES ('No', 'Key')")
+    placement = [len(database.rows("SELECT 1 FROM actor WHERE first_name = 'No'")) for database in databases]
+    checks.check("INSERTs without shard key spread over the groups", status == 200
+                 and placement == [1] * NUM_GROUPS, (status, data, placement))
+    query("DELETE FROM actor WHERE first_name = 'No'")
+    status, data = query("INSERT INTO payment (amount) VALUES (1)")
+    checks.check("INSERT without range shard key rejected", status == 400, (status, data))
+
+    # Text keys are placed without case, lookups on them read every group
+    for customer_id, last_name in enumerate(("SMITH", "Smith", "JOHNSON", "WILLIAMS"), 1):
+        query("INSERT INTO customer (customer_id, last_name) VALUES (%s, %s)", [customer_id, last_name])
+    placement = [[row[0] for row in database.rows("SELECT customer_id FROM customer WHERE last_name = 'smith'")]
+                 for database in databases]
+    checks.check("text keys differing in case in one group", sorted(map(len, placement)) == [0, 0, 2], placement)
+    reset_counts()
+    status, data = query("SELECT * FROM customer WHERE last_name = 'smith'")
+    checks.check("SELECT by lowercase text key finds the rows", status == 200 and sorted(
+        row["customer_id"] for row in data["result"]) == [1, 2] and contacted("worker") == list(range(NUM_GROUPS)),
+                 data)
+
+    # Range sharded, pinned and global tables
+    for payment_id in (50, 150, 250):
+        query("INSERT INTO payment (payment_id, amount) VALUES (%s, %s)", [payment_id, 1.5])
+    placement = [[row[0] for row in database.rows("SELECT payment_id FROM payment")] for database in databases]
+    checks.check("range sharded INSERT", placement == [[50], [150], [250]], placement)
+    status, data = query("SELECT SUM(amount) AS total FROM payment WHERE payment_id > 0")
+    checks.check("scattered SUM", status == 200 and float(data["result"][0]["total"]) == 4.5, data)
+    reset_counts()
+    query("INSERT INTO staff (staff_id, name) VALUES (1, 'Mike')")
+    checks.check("pinned table written on its group", contacted("manager") == [2], contacted("manager"))
+    status, data = query("SELECT * FROM staff WHERE staff_id = 1")
+    checks.check("pinned table read from its group", status == 200 and len(data["result"]) == 1, data)
+    status, data = query("SELECT * FROM staff JOIN actor WHERE actor.actor_id = staff.staff_id")
+    checks.check("join over different shards rejected", status == 400, (status, data))
+    reset_counts()
+    query("INSERT INTO category (category_id, name) VALUES (1, 'Action')")
+    checks.check("global table written on every group", all(database.rows("SELECT 1 FROM category")
+                                                            for database in databases))
+    reset_counts()
+    status, data = query("SELECT * FROM category WHERE category_id = 1")
+    checks.check("global table read from the first group", status == 200 and contacted("worker") == [0], data)
+
+    # Paginated reads continue after the key of the last row, on the replica of the previous page
+    def read_pages(text, params=None, page_size=4):
+        pages = []
+        cursor = None
+        while len(pages) < 20:
+            status, data = query(text, params, page_size=page_size, cursor=cursor)
+            if status != 200:
+                return pages, data
+            pages.append([row["actor_id"] for row in data["result"]])
+            cursor = data["cursor"]
+            if cursor is None:
+                return pages, data
+        return pages, "no last page"
+
+    expected = sorted(row[0] for database in databases for row in database.rows("SELECT actor_id FROM actor"))
+    pages, data = read_pages("SELECT actor_id, first_name FROM actor WHERE last_name = 'Last' ORDER BY actor_id")
+    checks.check("scattered pages read every row once", [actor_id for page in pages for actor_id in page] == expected
+                 and all(len(page) == 4 for page in pages[:-1]), (pages, data))
+    pages, data = read_pages("SELECT actor_id, last_name FROM actor WHERE last_name = %s ORDER BY last_name, actor_id DESC",
+                             ["Last"], page_size=5)
+    checks.check("pages over a descending compound key", [actor_id for page in pages for actor_id in page]
+                 == expected[::-1], (pages, data))
+    for staff_id in range(2, 12):
+        query("INSERT INTO staff (staff_id, name) VALUES (%s, %s)", [staff_id, f"Staff{staff_id}"])
+    reset_counts()
+    status, first = query("SELECT * FROM staff WHERE name LIKE 'Staff%' ORDER BY staff_id", page_size=3)
+    status, second = query("SELECT * FROM staff WHERE name LIKE 'Staff%' ORDER BY staff_id", page_size=3,
+                           cursor=first["cursor"])
+    checks.check("follow-up page pinned to the replica", status == 200 and [row["staff_id"] for row in
+                                                                             second["result"]] == [5, 6, 7]
+                 and second["source"].startswith("pinned") and contacted("worker") == [2], second)
+    status, data = query("SELECT * FROM staff WHERE staff_id > 1 ORDER BY staff_id", page_size=3,
+                         cursor=first["cursor"])
+    checks.check("cursor of another query rejected", status == 400, (status, data))
+    status, data = query("SELECT * FROM staff WHERE staff_id > 1 ORDER BY staff_id", page_size=100000)
+    checks.check("page size limited", status == 400, (status, data))
+    status, data = query("SELECT * FROM staff WHERE staff_id > 1", page_size=3)
+    checks.check("pages without ORDER BY rejected", status == 400, (status, data))
+
+    # Batches route every item like a single query
+    reset_counts()
+    response = client.post("/query/batch", json={"queries": [
+        "INSERT INTO actor (actor_id, first_name, last_name) VALUES (30, 'First30', 'Batch')",
+        "SELECT * FROM actor WHERE actor_id = 30",
+        "SELECT actor_id FROM actor WHERE last_name = 'Last' ORDER BY actor_id LIMIT 2",
+        "INSERT INTO payment (amount) VALUES (2)",
+    ]})
+    results = response.get_json()["results"]
+    checks.check("batch INSERT on the group of its key", results[0]["status"] == 200
+                 and databases[hash_group(30)].rows("SELECT 1 FROM actor WHERE actor_id = 30"), results[0])
+    checks.check("batch scattered SELECT", results[2]["status"] == 200
+                 and [row["actor_id"] for row in results[2]["result"]] == [1, 2], results[2])
+    checks.check("batch INSERT without range shard key rejected", results[3]["status"] == 400, results[3])
+    response = client.post("/query/batch", json={"queries": ["SELECT * FROM actor WHERE actor_id = 1", 7]})
+    checks.check("batch with a non-string item rejected", response.status_code == 400
+                 and "Query 1" in response.get_json()["error"], response.get_json())
+
+    # A registration without a weight keeps the weight of the membership file
+    proxy.WORKER_WEIGHTS = [3.0]
+    with open("workers_ip.txt", "w") as file:
+        file.write("127.0.0.1\n")
+    client.post("/workers/register", json={"ip": "127.0.0.1"})
+    checks.check("registered file worker keeps its weight",
+                 proxy.tracker.snapshot()["http://127.0.0.1:5000"]["weight"] == 3.0,
+                 proxy.tracker.snapshot()["http://127.0.0.1:5000"])
+
+    status, data = client.get("/shards").status_code, client.get("/shards").get_json()
+    checks.check("shard status lists the groups", status == 200 and len(data["groups"]) == NUM_GROUPS, data)
+
+    print(f"{checks.failed} checks failed" if checks.failed else "All checks passed")
+    sys.exit(1 if checks.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
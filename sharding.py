@@ -0,0 +1,427 @@
+import itertools
+import json
+import os
+import re
+import zlib
+from decimal import Decimal, InvalidOperation
+
+# Placement of the tables on several manager and replica groups, written by main.py when NUM_SHARDS > 1.
+# Without the file all writes go to the manager of manager_ip.txt
+SHARD_MAP_FILE = os.environ.get("SHARD_MAP_FILE", "shard_map.json")
+
+# Quoted strings, their content is masked before a query is searched for keywords and shard keys
+STRING_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"", re.DOTALL)
+# Literal or parameter a shard key is compared with, in the masked query
+VALUE = r"'_*'|\"_*\"|-?\d+(?:\.\d+)?|%s"
+# What may follow the value of a shard key condition, so the value is not part of a longer expression
+VALUE_END = r"(?=\s*(?:$|;|\)|\b(?:and|order|limit|group|having)\b))"
+INSERT_RE = re.compile(r"\s*insert\s+(?:ignore\s+)?into\s+(`?\w+`?(?:\.`?\w+`?)?)\s*(?:\(([^()]*)\)\s*)?values?\s*",
+                       re.IGNORECASE)
+AGGREGATE_RE = re.compile(r"(count|sum|min|max|avg)\s*\(", re.IGNORECASE)
+# Integer shard key as text, placed by its value instead of its hash
+INTEGER_RE = re.compile(r"-?\d+")
+ORDER_ITEM_RE = re.compile(r"(?:`?\w+`?\.)?`?(\w+)`?(?:\s+(asc|desc))?", re.IGNORECASE)
+
+
+class ShardingError(Exception):
+    pass
+
+
+def get_url(address):
+    """
+    Function to build the URL of a database service
+    Args:
+        address: IP, with an optional port
+    Returns:
+        URL, port 5000 by default
+    """
+    return f"http://{address}" if ":" in address else f"http://{address}:5000"
+
+
+def mask_strings(query):
+    """
+    Function to replace the content of the quoted strings of a query by underscores.
+    Positions stay the same, so a match in the masked query can be read from the original one
+    Args:
+        query: SQL query
+    Returns:
+        Masked query
+    """
+    return STRING_RE.sub(lambda match: match.group(0)[0] + "_" * (len(match.group(0)) - 2) + match.group(0)[-1],
+                         query)
+
+
+def split_top_level(masked, start, end):
+    """
+    Function to split a part of a masked query at the commas outside of parentheses
+    Args:
+        masked: Masked query
+        start: Start of the part
+        end: End of the part
+    Returns:
+        List of (start, end) of the items
+    """
+    items = []
+    depth = 0
+    item_start = start
+    for position in range(start, end):
+        if masked[position] == "(":
+            depth += 1
+        elif masked[position] == ")":
+            depth -= 1
+        elif masked[position] == "," and depth == 0:
+            items.append((item_start, position))
+            item_start = position + 1
+    items.append((item_start, end))
+    return items
+
+
+def parse_value(token, params, index):
+    """
+    Function to read the value of a shard key
+    Args:
+        token: Literal or %s, as written in the query
+        params: Parameter list of the query, None for a plain query
+        index: Position of the parameter if the token is %s
+    Returns:
+        Value as text, numbers without leading zeros and integral numbers without decimals, e.g. 7 for 007 or 7.0
+    """
+    if token == "%s":
+        if params is None or index >= len(params):
+            raise ShardingError("Missing parameter for the shard key")
+        value = params[index]
+        if isinstance(value, bool):
+            value = int(value)
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if value is None:
+            raise ShardingError("The shard key cannot be NULL")
+        return str(value)
+    if token[0] in "'\"":
+        return token[1:-1].replace(token[0] * 2, token[0]).replace("\\" + token[0], token[0])
+    if re.fullmatch(r"-?\d+(?:\.\d+)?", token):
+        number = Decimal(token)
+        return str(int(number)) if number == number.to_integral_value() else token
+    raise ShardingError(f"The shard key has to be a literal or a parameter, got {token}")
+
+
+def to_number(value):
+    """
+    Returns:
+        Sort key of a result value, numbers sent as text like DECIMAL columns compare as numbers
+    """
+    try:
+        return 0, Decimal(value)
+    except (InvalidOperation, TypeError, ValueError):
+        return 1, str(value)
+
+
+def combine(function, values):
+    """
+    Function to combine the aggregates of several shards
+    Args:
+        function: count, sum, min or max
+        values: Value per shard
+    Returns:
+        Aggregate over all shards
+    """
+    values = [value for value in values if value is not None]
+    if not values:
+        return 0 if function == "count" else None
+    if function == "min":
+        return min(values, key=to_number)
+    if function == "max":
+        return max(values, key=to_number)
+    total = sum(to_number(value)[1] for value in values)
+    if any(isinstance(value, str) for value in values):
+        # DECIMAL sums are sent as text
+        return str(total)
+    return int(total) if all(isinstance(value, int) for value in values) else float(total)
+
+
+def get_merge(query):
+    """
+    Function to find how the rows of several shards are combined into the result of a SELECT.
+    Each shard applies ORDER BY and LIMIT itself, the merge sorts the union and cuts it again
+    Args:
+        query: SELECT query
+    Returns:
+        Dictionary of the aggregates per column, the order as (column, descending) and the limit
+    Raises:
+        ShardingError: The query cannot be answered by combining the results of the shards
+    """
+    masked = mask_strings(query).rstrip().rstrip(";")
+    select = re.match(r"\s*select\s+", masked, re.IGNORECASE)
+    if select is None:
+        raise ShardingError("Only SELECT queries can run on several shards")
+    if re.search(r"\b(?:group\s+by|having|distinct|union)\b", masked, re.IGNORECASE):
+        raise ShardingError("GROUP BY, HAVING, DISTINCT and UNION cannot run on several shards, "
+                            "filter on the shard key")
+
+    merge = {"aggregates": {}, "order": [], "limit": None}
+    select_end = re.search(r"\bfrom\b", masked, re.IGNORECASE)
+    items = split_top_level(masked, select.end(), select_end.start() if select_end else len(masked))
+    for start, end in items:
+        aggregate = AGGREGATE_RE.match(masked[start:end].strip())
+        if aggregate is None:
+            continue
+        function = aggregate.group(1).lower()
+        if function == "avg":
+            raise ShardingError("AVG cannot run on several shards, select SUM and COUNT")
+        alias = re.search(r"\)\s*(?:as\s+)?`?(\w+)`?\s*$", masked[start:end], re.IGNORECASE)
+        # MySQL labels a column without alias with its expression as written
+        merge["aggregates"][alias.group(1) if alias else query[start:end].strip()] = function
+    if merge["aggregates"] and len(merge["aggregates"]) != len(items):
+        raise ShardingError("Columns next to aggregates need GROUP BY, which cannot run on several shards")
+
+    limit = re.search(r"\blimit\s+(.*)$", masked, re.IGNORECASE | re.DOTALL)
+    if limit is not None:
+        if not re.fullmatch(r"\d+\s*", limit.group(1)):
+            raise ShardingError("LIMIT with an offset or a parameter cannot run on several shards")
+        merge["limit"] = int(limit.group(1))
+    order = re.search(r"\border\s+by\s+(.*?)\s*(?:\blimit\b.*)?$", masked, re.IGNORECASE | re.DOTALL)
+    if order is not None:
+        for item in order.group(1).split(","):
+            column = ORDER_ITEM_RE.fullmatch(item.strip())
+            if column is None:
+                raise ShardingError("ORDER BY on several shards only supports column names")
+            merge["order"].append((column.group(1), (column.group(2) or "asc").lower() == "desc"))
+    return merge
+
+
+def merge_rows(merge, results):
+    """
+    Function to combine the rows of several shards
+    Args:
+        merge: See get_merge
+        results: List of rows per shard
+    Returns:
+        List of rows
+    """
+    rows = [row for result in results for row in result]
+    if merge["aggregates"]:
+        # Every shard answers with one row
+        return [{label: combine(function, [row.get(label) for row in rows])
+                 for label, function in merge["aggregates"].items()}] if rows else []
+    for column, descending in reversed(merge["order"]):
+        # NULL sorts first, like in MySQL
+        rows.sort(key=lambda row: (row.get(column) is not None, to_number(row.get(column))), reverse=descending)
+    return rows if merge["limit"] is None else rows[:merge["limit"]]
+
+
+class ShardMap:
+    """
+    Placement of the tables on the replication groups. A table is sharded by the hash or the ranges of a key
+    column, pinned to one group, or global: every group holds all of its rows, writes go to every group and
+    reads to the first one. Tables not in the map are global.
+    An INSERT into a hash sharded table without its key goes to the groups in turn, the key has to be an
+    AUTO_INCREMENT column then: each group generates the keys placed on it, see shard_of
+    Args:
+        document: Groups of manager and worker IPs and the rule per table, e.g.
+            {"groups": [{"manager": ip, "workers": [ip]}],
+             "tables": {"actor": {"key": "actor_id"}, "payment": {"key": "payment_id", "ranges": [8000]},
+                        "staff": {"shard": 0}}}
+    """
+    def __init__(self, document):
+        self.groups = document["groups"]
+        if not self.groups:
+            raise ValueError("The shard map has no groups")
+        self.managers = [get_url(group["manager"]) for group in self.groups]
+        self.workers = [[get_url(ip) for ip in group.get("workers", [])] for group in self.groups]
+        self.tables = {}
+        for table, rule in document.get("tables", {}).items():
+            if "shard" in rule:
+                if not 0 <= rule["shard"] < len(self.groups):
+                    raise ValueError(f"Table {table} is pinned to an unknown group")
+            elif "key" not in rule:
+                raise ValueError(f"Table {table} needs a key or a shard")
+            elif "ranges" in rule and len(rule["ranges"]) != len(self.groups) - 1:
+                # Upper bounds of the groups but the last
+                raise ValueError(f"Table {table} needs {len(self.groups) - 1} range bounds")
+            self.tables[table.lower()] = rule
+        self._next_group = itertools.count()
+
+    def shard_of(self, table, value):
+        """
+        Args:
+            table: Sharded table
+            value: Shard key value as text
+        Returns:
+            Group holding the row. By hash, integers go to (key - 1) % groups, the group whose interleaved
+            AUTO_INCREMENT (offset group + 1, see main.py) generates them. Other values go to
+            CRC32(LOWER(TRIM(TRAILING ' ' FROM key))) % groups like in MySQL, without case and trailing spaces,
+            so equal values of the collation share a group
+        """
+        rule = self.tables[table]
+        if "ranges" in rule:
+            try:
+                number = float(value)
+            except ValueError:
+                raise ShardingError(f"The shard key of {table} has to be a number, got {value}")
+            return sum(1 for bound in rule["ranges"] if number >= bound)
+        if INTEGER_RE.fullmatch(value):
+            return (int(value) - 1) % len(self.groups)
+        return zlib.crc32(value.rstrip(" ").lower().encode()) % len(self.groups)
+
+    def _get_key(self, query, masked, params, table):
+        # Value of an equality condition on the shard key, only trusted in a WHERE without OR, NOT and subqueries.
+        # Conditions on text are not trusted either
+        where = re.search(r"\bwhere\b", masked, re.IGNORECASE)
+        if where is None or re.search(r"\b(?:or|not|select)\b", masked[where.end():], re.IGNORECASE):
+            return None
+        key = re.escape(self.tables[table]["key"])
+        match = re.compile(rf"(?<![\w.`])(?:`?\w+`?\.)?`?{key}`?\s*=\s*({VALUE}){VALUE_END}",
+                           re.IGNORECASE).search(masked, where.end())
+        if match is None:
+            return None
+        token = query[match.start(1):match.end(1)]
+        index = masked[:match.start(1)].count("%s")
+        if token[0] in "'\"" or (token == "%s" and params is not None and index < len(params)
+                                 and isinstance(params[index], str)):
+            # The collation also matches text differing in accents, which may hash to another group
+            return None
+        value = parse_value(token, params, index)
+        if "ranges" not in self.tables[table] and not INTEGER_RE.fullmatch(value):
+            # A DECIMAL column holds 1.5 as 1.50, which hashes to another group
+            return None
+        return value
+
+    def _route_insert(self, query, masked, params, tables):
+        match = INSERT_RE.match(masked)
+        table = match.group(1).replace("`", "").split(".")[-1].lower() if match else next(iter(tables), None)
+        rule = self.tables.get(table, {})
+        if "shard" in rule:
+            return [(rule["shard"], query, params)]
+        if "key" not in rule:
+            return [(group, query, params) for group in range(len(self.groups))]
+        if match is None or match.group(2) is None:
+            raise ShardingError(f"INSERT into the sharded table {table} needs a column list and VALUES")
+
+        columns = [column.strip().replace("`", "").lower() for column in match.group(2).split(",")]
+        if rule["key"].lower() not in columns:
+            if "ranges" in rule:
+                raise ShardingError(f"INSERT into the sharded table {table} needs its shard key {rule['key']}")
+            # The AUTO_INCREMENT of the group generates a key placed on it
+            return [(next(self._next_group) % len(self.groups), query, params)]
+        key_index = columns.index(rule["key"].lower())
+
+        # Rows per group as their text and parameters
+        rows = {}
+        position = match.end()
+        while True:
+            if position >= len(masked) or masked[position] != "(":
+                raise ShardingError("Unsupported VALUES list")
+            end = position
+            depth = 0
+            while end < len(masked):
+                depth += {"(": 1, ")": -1}.get(masked[end], 0)
+                if depth == 0:
+                    break
+                end += 1
+            values = split_top_level(masked, position + 1, end)
+            if len(values) != len(columns):
+                raise ShardingError("Every row of the INSERT needs a value per column")
+            start, stop = values[key_index]
+            key = parse_value(query[start:stop].strip(), params, masked[:start].count("%s"))
+            first_param = masked[:position].count("%s")
+            row_params = None
+            if params is not None:
+                row_params = params[first_param:first_param + masked[position:end].count("%s")]
+            rows.setdefault(self.shard_of(table, key), []).append((query[position + 1:end], row_params))
+
+            position = end + 1
+            rest = re.match(r"\s*(,)?\s*", masked[position:])
+            position += rest.end()
+            if rest.group(1) is None:
+                break
+        if masked[position:].strip(" \t\r\n;"):
+            raise ShardingError("Unsupported clause after the VALUES list")
+
+        if len(rows) == 1:
+            return [(next(iter(rows)), query, params)]
+        prefix = query[:match.end()]
+        return [(group, prefix + ", ".join(f"({text})" for text, _ in group_rows),
+                 None if params is None else [value for _, row_params in group_rows for value in row_params])
+                for group, group_rows in sorted(rows.items())]
+
+    def route(self, query_type, query, params, tables):
+        """
+        Function to find the groups a query runs on
+        Args:
+            query_type: select, insert, delete or other
+            query: SQL query
+            params: Parameter list, None for a plain query
+            tables: Tables the query reads or writes
+        Returns:
+            List of (group, query, params), several entries if the query runs on several groups.
+            A multi-row INSERT is split into one INSERT per group
+        Raises:
+            ShardingError: The query cannot be routed
+        """
+        masked = mask_strings(query)
+        if query_type == "insert":
+            return self._route_insert(query, masked, params, tables)
+
+        everywhere = [(group, query, params) for group in range(len(self.groups))]
+        sharded = [table for table in tables if "key" in self.tables.get(table, {})]
+        pinned = {self.tables[table]["shard"] for table in tables if "shard" in self.tables.get(table, {})}
+        if pinned:
+            if len(pinned) > 1 or sharded:
+                raise ShardingError(f"The tables {', '.join(sorted(tables))} are on different shards")
+            return [(pinned.pop(), query, params)]
+        if sharded:
+            if len(tables) == 1:
+                key = self._get_key(query, masked, params, sharded[0])
+                if key is not None:
+                    return [(self.shard_of(sharded[0], key), query, params)]
+            # Joins with global tables run on every group against its copy of them
+            return everywhere
+        if query_type == "delete":
+            return everywhere
+        return [(0, query, params)]
+
+    def prune_statements(self, group, schema="sakila"):
+        """
+        Function to build the statements deleting the rows a group does not hold from a full copy of the database
+        Args:
+            group: Group index
+            schema: Database name
+        Returns:
+            List of SQL statements
+        """
+        statements = []
+        for table, rule in self.tables.items():
+            if "shard" in rule:
+                if rule["shard"] != group:
+                    statements.append(f"DELETE FROM {schema}.{table}")
+            elif "ranges" in rule:
+                conditions = []
+                if group > 0:
+                    conditions.append(f"{rule['key']} >= {rule['ranges'][group - 1]}")
+                if group < len(rule["ranges"]):
+                    conditions.append(f"{rule['key']} < {rule['ranges'][group]}")
+                if conditions:
+                    statements.append(f"DELETE FROM {schema}.{table} WHERE NOT ({' AND '.join(conditions)})")
+            else:
+                # See shard_of, MOD(key, groups) is negative for negative keys
+                key = rule["key"]
+                groups = len(self.groups)
+                statements.append(f"DELETE FROM {schema}.{table} WHERE CASE WHEN {key} REGEXP '^-?[0-9]+$' "
+                                  f"THEN MOD(MOD({key}, {groups}) + {groups - 1}, {groups}) "
+                                  f"ELSE CRC32(LOWER(TRIM(TRAILING ' ' FROM {key}))) % {groups} END != {group}")
+        return statements
+
+
+def load_shard_map(path=SHARD_MAP_FILE):
+    """
+    Function to read the shard map
+    Args:
+        path: Shard map file
+    Returns:
+        ShardMap, None if the file does not exist
+    """
+    try:
+        with open(path, "r") as file:
+            return ShardMap(json.load(file))
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,172 @@
+import atexit
+import fcntl
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+# Directory of the state shared by the processes of one server, created by serve.py before it forks them.
+# Without it every process keeps its state in a private directory, as with the development server
+SHARED_STATE_DIR = os.environ.get("SHARED_STATE_DIR")
+
+_private_dir = None
+_private_dir_lock = threading.Lock()
+
+
+def is_shared():
+    """
+    Returns:
+        True if this process is one of several processes serving the same app
+    """
+    return bool(SHARED_STATE_DIR)
+
+
+def state_path(name):
+    """
+    Function to place a state file in the shared directory, or in a private one if there is none
+    Args:
+        name: File name
+    Returns:
+        Path of the file
+    """
+    global _private_dir
+    if SHARED_STATE_DIR:
+        return os.path.join(SHARED_STATE_DIR, name)
+    with _private_dir_lock:
+        if _private_dir is None:
+            _private_dir = tempfile.mkdtemp(prefix="cloud-db-")
+            atexit.register(shutil.rmtree, _private_dir, True)
+    return os.path.join(_private_dir, name)
+
+
+class FileLock:
+    """
+    Lock held by one thread of one process at a time, flock alone does not exclude the threads of a process
+    Args:
+        path: Lock file, created if missing
+    """
+    def __init__(self, path):
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+
+class SharedCounters:
+    """
+    Fixed number of 64-bit counters in a memory mapped file, shared by the processes of a server.
+    Reads take no lock, increments are serialized
+    Args:
+        name: Name of the counter file
+        size: Number of counters
+    """
+    def __init__(self, name, size):
+        self.size = size
+        path = state_path(name)
+        self._lock = FileLock(f"{path}.lock")
+        with self._lock:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < size * 8:
+                    # New bytes read as zero
+                    os.ftruncate(fd, size * 8)
+                self._map = mmap.mmap(fd, size * 8)
+            finally:
+                os.close(fd)
+
+    def get(self, index):
+        return struct.unpack_from("q", self._map, index * 8)[0]
+
+    def increment(self, index, amount=1):
+        """
+        Returns:
+            Value of the counter after the increment
+        """
+        with self._lock:
+            value = self.get(index) + amount
+            struct.pack_into("q", self._map, index * 8, value)
+        return value
+
+    def update(self, index, count, function):
+        """
+        Function to replace consecutive counters at once, serialized with the other updates and increments
+        Args:
+            index: First counter
+            count: Number of counters
+            function: Called with the current values, returns the new ones
+        Returns:
+            New values
+        """
+        with self._lock:
+            values = function(struct.unpack_from(f"{count}q", self._map, index * 8))
+            struct.pack_into(f"{count}q", self._map, index * 8, *values)
+        return values
+
+
+class SharedDocument:
+    """
+    JSON document in a file, shared by the processes of a server. Updates replace the file atomically
+    under a lock, readers only parse it again after it was replaced
+    Args:
+        name: Name of the document file
+        default: Document used while the file does not exist
+    """
+    def __init__(self, name, default):
+        self.path = state_path(f"{name}.json")
+        self.default = default
+        self._lock = FileLock(f"{self.path}.lock")
+        self._cached = (None, default)  # (version, document)
+
+    def version(self):
+        """
+        Returns:
+            Value that changes whenever the document is replaced, None if it does not exist yet
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return json.loads(json.dumps(self.default))
+
+    def read(self):
+        """
+        Returns:
+            Current document, must not be modified
+        """
+        version = self.version()
+        cached_version, document = self._cached
+        if version != cached_version:
+            document = self._load()
+            self._cached = (version, document)
+        return document
+
+    def update(self, function):
+        """
+        Function to modify the document, concurrent updates of all processes are serialized
+        Args:
+            function: Called with a copy of the document to modify in place
+        """
+        with self._lock:
+            document = self._load()
+            function(document)
+            temporary_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temporary_path, "w") as file:
+                json.dump(document, file)
+            os.replace(temporary_path, self.path)
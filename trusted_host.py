@@ -1,8 +1,14 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import requests
 import re
+import os
+import time
+import http_client
+import metrics
+from functools import lru_cache
 
 app = Flask(__name__)
+metrics.instrument(app, "trusted_host")
 
 # Get proxy IP
 try:
@@ -11,69 +17,291 @@ try:
 except FileNotFoundError:
     print("No files found.")
 
+# Keep-alive session to the proxy
+session = http_client.create_session()
 
-def validate(query, authorization):
-    # Basic SQL injection prevention patterns
-    forbidden_patterns = [
-        r"(--|\b(ALTER|DROP|TRUNCATE|UPDATE|EXEC|OR|TRUE)\b)",
-    ]
-    for pattern in forbidden_patterns:
-        if re.search(pattern, query, re.IGNORECASE):
-            print("Possible SQL injection detected")
-            return False, "Possible SQL injection detected"
 
-    if query.strip().lower().startswith("select") or query.strip().lower().startswith("delete"):
-        # Reject query if WHERE clause is missing or empty
-        if (re.search(r"(?i)\bSELECT\b.*\bFROM\b.*\bWHERE\b.*[^\s]", query, re.IGNORECASE) is None
-                and re.search(r"(?i)\bDELETE\b.*\bFROM\b.*\bWHERE\b.*[^\s]", query, re.IGNORECASE) is None):
-            return False, "Missing where in query"
-
-    # Check for tautological conditions in WHERE clause (1=1, 2=2, ...)
-    if query.strip().lower().startswith("select"):
-        where_clause = re.search(r"(?i)\bWHERE\b\s*(.+)", query)
-        if where_clause:
-            condition = where_clause.group(1)
-            if re.search(r"\b(\d+)\s*=\s*\1\b", condition):
-                print("Tautological condition detected")
-                return False, "Tautological condition (e.g., 'WHERE 1=1') is prohibited."
+# Validator configuration
+MAX_QUERY_LENGTH = 1000
+MAX_PARAMS = 100
+VERDICT_CACHE_SIZE = int(os.environ.get("VERDICT_CACHE_SIZE", 4096))
+
+# Basic SQL injection prevention keywords
+FORBIDDEN_KEYWORDS = frozenset(["alter", "drop", "truncate", "update", "exec", "or", "true"])
+# Keywords the rules look at, a string literal containing one of them is kept in the fingerprint
+RULE_KEYWORDS = FORBIDDEN_KEYWORDS | {"select", "delete", "from", "where"}
+
+TOKEN_RE = re.compile(r"--|\w+|\S|\n")
+WORD_RE = re.compile(r"\w+")
+# String literal in single or double quotes. A quote preceded by a backslash does not close it,
+# an unterminated literal runs to the end of the query (no closing quote in group 2)
+LITERAL_RE = re.compile(r"""(['"])(?:(?!\1)[^\\]|\\+(?!\1)[^\\]|\\+\1)*(?:(\1)|\\*\Z)""")
+
+
+def is_inert_literal(content):
+    """
+    Function to check whether a string literal cannot influence any validation rule
+    Args:
+        content: Text between the quotes
+    Returns:
+        True if the literal can be replaced by a placeholder
+    """
+    if "-" in content or "=" in content or "\\" in content or "\n" in content:
+        return False
+    for word in WORD_RE.findall(content.lower()):
+        if word.isdecimal() or word in RULE_KEYWORDS:
+            return False
+    return True
+
+
+def get_fingerprint(query):
+    """
+    Function to normalize a query into the cache key of its verdict.
+    The query is lowercased, whitespace is collapsed within lines and string literals that cannot change the verdict
+    become '?'. Line breaks are kept, the WHERE rule and the tautology check look at single lines
+    Args:
+        query: SQL query
+    Returns:
+        Normalized query
+    """
+    parts = []
+    pos = 0
+    for literal in LITERAL_RE.finditer(query):
+        parts.append(query[pos:literal.start()].lower())
+        if literal.group(2) is None:
+            # Unterminated literal, keep the rest as it is
+            parts.append(literal.group().lower())
         else:
-            # Reject query if WHERE clause is missing or empty
+            parts.append("?" if is_inert_literal(literal.group()[1:-1]) else literal.group().lower())
+        pos = literal.end()
+    parts.append(query[pos:].lower())
+    return "\n".join(" ".join(line.split()) for line in "".join(parts).split("\n")).strip("\n")
+
+
+def check_fingerprint(fingerprint):
+    """
+    Function to apply the security rules to a normalized query in a single pass over its tokens
+    Args:
+        fingerprint: Normalized query
+    Returns:
+        Validation result and message
+    """
+    starts_with_select = fingerprint.startswith("select")
+    starts_with_delete = fingerprint.startswith("delete")
+
+    # Progress of SELECT ... FROM ... WHERE <condition> and DELETE ... FROM ... WHERE <condition> within one line
+    # 0: keyword, 1: FROM, 2: WHERE, 3: condition, 4: complete
+    stages = {"select": 0, "delete": 0}
+    complete = False
+    where_seen = False
+    # The tautology check covers the first WHERE up to the end of the line its condition starts on
+    condition_started = condition_ended = False
+    tautology = False
+    previous = [None, None]
+
+    for token in TOKEN_RE.findall(fingerprint):
+        if token == "--" or token in FORBIDDEN_KEYWORDS:
+            return False, "Possible SQL injection detected"
+        if token == "\n":
+            complete = complete or 4 in stages.values()
+            stages = {"select": 0, "delete": 0}
+            condition_ended = condition_started
+            continue
+
+        for keyword, stage in stages.items():
+            if stage == 0 and token == keyword:
+                stages[keyword] = 1
+            elif stage == 1 and token == "from":
+                stages[keyword] = 2
+            elif stage == 2 and token == "where":
+                stages[keyword] = 3
+            elif stage == 3:
+                stages[keyword] = 4
+
+        # Check for tautological conditions after the first WHERE (1=1, 2=2, ...)
+        if where_seen and not condition_ended:
+            condition_started = True
+            if previous[0] is not None and previous[0].isdecimal() and previous[1] == "=" and token == previous[0]:
+                tautology = True
+            previous = [previous[1], token]
+        elif token == "where":
+            where_seen = True
+
+    # Reject query if WHERE clause is missing or empty
+    complete = complete or 4 in stages.values()
+    if (starts_with_select or starts_with_delete) and not complete:
+        return False, "Missing where in query"
+
+    if starts_with_select:
+        if tautology:
+            return False, "Tautological condition (e.g., 'WHERE 1=1') is prohibited."
+        if not where_seen:
             return False, "Missing or empty WHERE clause in query."
 
+    return True, "Good"
+
+
+# Bounded LRU of verdicts keyed by the query fingerprint
+cached_check_fingerprint = lru_cache(maxsize=VERDICT_CACHE_SIZE)(check_fingerprint)
+
+
+def validate(query, authorization):
+    if not query:
+        return False, "No query provided"
+
+    # Check for query length first, so the rules only ever scan bounded input
+    if len(query) > MAX_QUERY_LENGTH:
+        print("Query too large")
+        return False, "Query too large"
+
+    result, message = cached_check_fingerprint(get_fingerprint(query))
+    if not result:
+        print(message)
+        return result, message
+
     # Check authorization
     if not authorization:
         return False, "Authorization required"
 
-    # Check for query length
-    if len(query) > 1000:
-        print("Query too large")
-        return False, "Query too large"
+    return True, "Good"
 
+def validate_params(params):
+    """
+    Function to check the parameters of a parameterized query. They are sent to MySQL as data,
+    so only the statement template goes through the security rules
+    Args:
+        params: Parameter list, None for a plain query
+    Returns:
+        Validation result and message
+    """
+    if params is None:
+        return True, "Good"
+    if not isinstance(params, list):
+        return False, "Parameters must be a list"
+    if len(params) > MAX_PARAMS:
+        return False, "Too many parameters"
+    for param in params:
+        if param is not None and not isinstance(param, (str, int, float, bool)):
+            return False, "Parameters must be strings, numbers, booleans or null"
+        if isinstance(param, str) and len(param) > MAX_QUERY_LENGTH:
+            return False, "Parameter too large"
     return True, "Good"
 
-@app.route('/validate', methods=['POST'])
-def execute_query():
-    # Get the query
-    data = request.get_json()
-    query = data.get("query")
-    authorization = data.get("Authorization")
-    routing_strategy = data.get("strategy", "round-robin")
+VALIDATION_LATENCY = metrics.REGISTRY.histogram("validation_duration_seconds", "Time to validate a query",
+                                                 buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01))
+VALIDATION_RESULTS = metrics.REGISTRY.counter("validation_results", "Validated queries per verdict", ("verdict",))
+metrics.REGISTRY.gauge("validation_cache", "Verdict cache counters", ("counter",),
+                       callback=lambda: {(name,): value for name, value in
+                                         cached_check_fingerprint.cache_info()._asdict().items()
+                                         if value is not None})
 
-    # Check the security patterns, return if not correct
-    result_validate, str_res = validate(query, authorization)
+
+def timed_validate(query, authorization, params=None):
+    """
+    Function to validate a query and its parameters and record the verdict and time in the metrics
+    Returns:
+        Validation result and message
+    """
+    start_time = time.perf_counter()
+    result, message = validate(query, authorization)
+    if result:
+        result, message = validate_params(params)
+    elapsed = time.perf_counter() - start_time
+    VALIDATION_LATENCY.observe(elapsed)
+    metrics.add_timing("validate", elapsed)
+    VALIDATION_RESULTS.labels("accepted" if result else "rejected").inc()
+    return result, message
+
+
+def check_query(data):
+    """
+    Function to validate a query request and build the request for the proxy.
+    With parameters only the template is checked, so the verdict cache holds one entry per distinct template
+    Args:
+        data: Request body with query, Authorization, params, strategy, stream, page_size and cursor
+    Returns:
+        Payload for the proxy and None, or None and the error message
+    """
+    params = data.get("params")
+    result_validate, str_res = timed_validate(data.get("query"), data.get("Authorization"), params)
     if not result_validate:
-        return jsonify({"error": f"{str_res}"}), 400
+        return None, f"{str_res}"
+    return {"query": data.get("query"), "params": params, "strategy": data.get("strategy", "round-robin"),
+            "stream": bool(data.get("stream", False)), "page_size": data.get("page_size"),
+            "cursor": data.get("cursor")}, None
+
+
+def check_batch(queries, authorization):
+    """
+    Function to validate the queries of a batch, the ones failing the security patterns are rejected on their own
+    Args:
+        queries: List of queries
+        authorization: Authorization flag set by the gatekeeper
+    Returns:
+        List with the error result of every rejected query and None for the ones to forward
+    """
+    results = []
+    for query in queries:
+        result_validate, str_res = timed_validate(query, authorization)
+        results.append(None if result_validate else {"status": 400, "error": f"{str_res}"})
+    return results
 
-    modified_data = {"query": query, "strategy": routing_strategy}
+
+@app.route('/validate', methods=['POST'])
+def execute_query():
+    # Check the security patterns, return if not correct
+    modified_data, error = check_query(request.get_json())
+    if modified_data is None:
+        return jsonify({"error": error}), 400
+    stream = modified_data["stream"]
 
     try:
         # Forward the request
-        response = requests.post(f"http://{proxy_ip}:5000/query", json=modified_data)
+        response = session.post(f"http://{proxy_ip}:5000/query", json=modified_data, stream=True,
+                                headers=http_client.upstream_headers())
+        metrics.forward_timing(response)
+        if stream:
+            # Pass the NDJSON rows through without decoding them
+            return Response(http_client.iter_stream(response), status=response.status_code,
+                            headers=http_client.forward_headers(response))
+        if http_client.is_opaque(response):
+            # Compact results are forwarded as bytes, compressed ones stay compressed
+            return Response(http_client.read_body(response), status=response.status_code,
+                            headers=http_client.forward_headers(response))
         return jsonify(response.json()), response.status_code
 
     except requests.exceptions.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/validate/batch', methods=['POST'])
+def execute_batch():
+    # Get the queries
+    data = request.get_json()
+    queries = data.get("queries") or []
+    routing_strategy = data.get("strategy", "round-robin")
+    error = http_client.get_batch_error(queries)
+    if error is not None:
+        return jsonify({"error": error}), 400
+
+    # The queries passing the security patterns are forwarded
+    results = check_batch(queries, data.get("Authorization"))
+    results = http_client.forward_batch(session, f"http://{proxy_ip}:5000/query/batch",
+                                        {"strategy": routing_strategy}, queries, results)
+    return jsonify({"results": results}), 200
+
+
+@app.route('/validator', methods=['GET'])
+def validator_stats():
+    # Verdict cache statistics
+    return jsonify(cached_check_fingerprint.cache_info()._asdict()), 200
+
+
+@app.route('/connections', methods=['GET'])
+def connection_stats():
+    # Connection reuse statistics of the upstream session
+    return jsonify(http_client.get_stats(session)), 200
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -1,7 +1,17 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from contextlib import contextmanager
+from collections import OrderedDict
 import mysql.connector
+import threading
+import random
+import queue
+import time
+import os
+import codec
+import metrics
 
 app = Flask(__name__)
+metrics.instrument(app, "worker")
 
 # Database configuration
 DB_HOST = "localhost"
@@ -9,46 +19,534 @@ DB_USER = "replica"
 DB_PASSWORD = "replica_password"
 DB_NAME = "sakila"
 
+# Connection pool configuration, each serving process has its own pool
+POOL_SIZE = int(os.environ.get("POOL_SIZE", 10))
+POOL_TIMEOUT = float(os.environ.get("POOL_TIMEOUT", 5))
+POOL_MAX_LIFETIME = float(os.environ.get("POOL_MAX_LIFETIME", 300))
+POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get("POOL_HEALTH_CHECK_INTERVAL", 30))
+
+# Prepared statements kept per connection for parameterized queries
+PREPARED_CACHE_SIZE = int(os.environ.get("PREPARED_CACHE_SIZE", 64))
+# Rows fetched per batch when streaming a SELECT
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 500))
+# Fraction of responses written to response.txt, 0 disables it
+RESPONSE_LOG_SAMPLE_RATE = float(os.environ.get("RESPONSE_LOG_SAMPLE_RATE", 0.01))
+
+# Group commit of writes, disabled unless WRITE_BATCH_ENABLED=1
+WRITE_BATCH_ENABLED = os.environ.get("WRITE_BATCH_ENABLED", "0") == "1"
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", 50))
+WRITE_BATCH_WINDOW = float(os.environ.get("WRITE_BATCH_WINDOW", 0.005))
+WRITE_BATCH_TIMEOUT = float(os.environ.get("WRITE_BATCH_TIMEOUT", 30))
+
+# MySQL client errors meaning the connection itself is broken
+CONNECTION_LOST_ERRORS = (2006, 2013, 2055)
+# SQLSTATE classes of errors caused by the query itself, e.g. a syntax error or unknown column (42),
+# a bad value (22) or a duplicate key (23). They are answered with 400 instead of 500,
+# so the proxy does not count them as failures of the database
+QUERY_ERROR_CLASSES = ("21", "22", "23", "42")
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def get_error_status(error):
+    """
+    Function to choose the status code of a failed query
+    Args:
+        error: Exception raised by the query
+    Returns:
+        400 if the query itself is at fault, 503 if no connection was free, 500 otherwise
+    """
+    if isinstance(error, PoolTimeout):
+        return 503
+    if (getattr(error, "sqlstate", None) or "")[:2] in QUERY_ERROR_CLASSES:
+        return 400
+    return 500
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of MySQL connections
+    Args:
+        size: Maximum number of open connections
+        timeout: Seconds to wait for a free connection
+        max_lifetime: Seconds after which a connection is recycled
+        health_check_interval: Idle seconds after which a connection is pinged before reuse
+        db_config: Arguments for mysql.connector.connect
+    """
+    def __init__(self, size, timeout, max_lifetime, health_check_interval, **db_config):
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.db_config = db_config
+
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, created_at, last_used_at)
+        self._open = 0
+        self.stats = {"in_use": 0, "waiting": 0, "created": 0, "recycled": 0, "reconnected": 0,
+                      "prepared_hits": 0, "prepared_misses": 0}
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self.db_config)
+        with self._cond:
+            self.stats["created"] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    # Reserve a slot, the connection is opened outside the lock
+                    self._open += 1
+                    entry = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"No free database connection after {self.timeout}s")
+                self.stats["waiting"] += 1
+                self._cond.wait(remaining)
+                self.stats["waiting"] -= 1
+            self.stats["in_use"] += 1
+
+        try:
+            if entry is not None:
+                conn, created_at, last_used_at = entry
+                now = time.monotonic()
+                if now - created_at > self.max_lifetime:
+                    # Connection is too old, replace it
+                    self._close(conn)
+                    with self._cond:
+                        self.stats["recycled"] += 1
+                    entry = None
+                elif now - last_used_at > self.health_check_interval and not self._is_healthy(conn):
+                    self._close(conn)
+                    entry = None
+            if entry is None:
+                entry = (self._connect(), time.monotonic(), time.monotonic())
+        except mysql.connector.Error:
+            self._discard()
+            raise
+        return entry
+
+    def _is_healthy(self, conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except mysql.connector.Error:
+            return False
+
+    def _release(self, entry):
+        conn, created_at, _ = entry
+        try:
+            # Drop rows a streaming client did not read
+            if conn.unread_result:
+                conn.consume_results()
+            # End the read snapshot so the next user sees fresh data
+            if conn.in_transaction:
+                conn.rollback()
+        except mysql.connector.Error:
+            self._close(conn)
+            self._discard()
+            return
+        with self._cond:
+            self._idle.append((conn, created_at, time.monotonic()))
+            self.stats["in_use"] -= 1
+            self._cond.notify()
+
+    def _discard(self):
+        with self._cond:
+            self._open -= 1
+            self.stats["in_use"] -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool
+        Returns:
+            Context manager yielding a pooled connection
+        """
+        entry = self._acquire()
+        try:
+            yield entry[0]
+        except mysql.connector.Error as e:
+            if getattr(e, "errno", None) in CONNECTION_LOST_ERRORS:
+                self._close(entry[0])
+                self._discard()
+            else:
+                self._release(entry)
+            raise
+        except BaseException:
+            # Includes GeneratorExit when a streaming client goes away
+            self._release(entry)
+            raise
+        else:
+            self._release(entry)
+
+    def increment(self, name):
+        with self._cond:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self._cond:
+            return dict(self.stats, open=self._open, idle=len(self._idle), size=self.size)
+
+
+pool = ConnectionPool(POOL_SIZE, POOL_TIMEOUT, POOL_MAX_LIFETIME, POOL_HEALTH_CHECK_INTERVAL,
+                      host=DB_HOST, user=DB_USER, password=DB_PASSWORD, database=DB_NAME)
+
+DB_EXECUTE_LATENCY = metrics.REGISTRY.histogram("db_execute_duration_seconds",
+                                                "Time MySQL took to execute a statement or commit",
+                                                ("operation",))
+metrics.REGISTRY.gauge("db_pool", "Connection pool counters and gauges", ("counter",),
+                       callback=lambda: {(name,): value for name, value in pool.get_stats().items()})
+
+
+def get_cursor(conn, query, params):
+    """
+    Function to get a cursor for the query. Parameterized queries run as server-side prepared statements,
+    cached per connection by statement text so each distinct statement is parsed once per connection
+    Args:
+        conn: Pooled connection
+        query: SQL query or statement template
+        params: Parameter list, None for a plain query
+    Returns:
+        Cursor and whether the caller has to close it
+    """
+    if params is None:
+        return conn.cursor(), True
+
+    # A connection is used by one thread at a time, the cache needs no lock
+    cache = getattr(conn, "prepared_statements", None)
+    if cache is None:
+        cache = conn.prepared_statements = OrderedDict()
+    cursor = cache.get(query)
+    if cursor is not None:
+        cache.move_to_end(query)
+        pool.increment("prepared_hits")
+        return cursor, False
+
+    pool.increment("prepared_misses")
+    cursor = cache[query] = conn.cursor(prepared=True)
+    if len(cache) > PREPARED_CACHE_SIZE:
+        # Closing the cursor deallocates the statement on the server
+        _, evicted = cache.popitem(last=False)
+        evicted.close()
+    return cursor, False
+
+
+def run_query(query, params=None, columnar=False):
+    """
+    Function to execute query on a pooled connection, reconnecting once if the connection is lost
+    Args:
+        query: SQL query or statement template
+        params: Parameter list, None for a plain query
+        columnar: Return a SELECT result as column names and row tuples instead of one dictionary per row
+    Returns:
+        Response dictionary
+    """
+    is_select = query.strip().lower().startswith("select")
+    for attempt in range(2):
+        executed = False
+        try:
+            with pool.connection() as conn:
+                cursor, owned = get_cursor(conn, query, params)
+                try:
+                    # Execute the query
+                    start_time = time.perf_counter()
+                    cursor.execute(query, params)
+                    executed = True
+
+                    # Commit only for non-select queries
+                    if is_select:
+                        result = cursor.fetchall()
+                        DB_EXECUTE_LATENCY.labels("select").observe(time.perf_counter() - start_time)
+                        columns = cursor.column_names
+                        if columnar:
+                            return {"columns": list(columns), "rows": result}
+                        return {"result": [dict(zip(columns, row)) for row in result]}
+                    else:
+                        conn.commit()
+                        DB_EXECUTE_LATENCY.labels("write").observe(time.perf_counter() - start_time)
+                        return {"message": "Query executed successfully"}
+                finally:
+                    if owned:
+                        cursor.close()
+        except mysql.connector.Error as e:
+            # A write may already be applied once it was executed, only reads are safe to repeat
+            if attempt or (executed and not is_select) or getattr(e, "errno", None) not in CONNECTION_LOST_ERRORS:
+                raise
+            pool.increment("reconnected")
+
+
+def run_in_transaction(queries):
+    """
+    Function to execute writes in order in one transaction with a single commit.
+    Each statement runs behind a savepoint so a failing one is rolled back alone
+    Args:
+        queries: List of (SQL query, parameter list or None)
+    Returns:
+        List of (response dictionary, exception) per query and the commit time in milliseconds
+    """
+    outcomes = [[None, None] for _ in queries]
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            pending = []
+            for i, (query, params) in enumerate(queries):
+                try:
+                    cursor.execute("SAVEPOINT batch_item")
+                    if params is None:
+                        cursor.execute(query)
+                    else:
+                        get_cursor(conn, query, params)[0].execute(query, params)
+                    pending.append(i)
+                except mysql.connector.Error as e:
+                    outcomes[i][1] = e
+                    try:
+                        cursor.execute("ROLLBACK TO SAVEPOINT batch_item")
+                    except mysql.connector.Error:
+                        # The server rolled back the whole transaction, e.g. on a deadlock
+                        for done in pending:
+                            outcomes[done][1] = mysql.connector.Error(msg=f"Batch rolled back: {e}")
+                        pending = []
+
+            start_time = time.perf_counter()
+            conn.commit()
+            commit_ms = (time.perf_counter() - start_time) * 1000
+            DB_EXECUTE_LATENCY.labels("commit").observe(commit_ms / 1000)
+            for i in pending:
+                outcomes[i][0] = {"message": "Query executed successfully"}
+        finally:
+            cursor.close()
+    return [tuple(outcome) for outcome in outcomes], commit_ms
+
+
+class WriteBatcher:
+    """
+    Coalesces concurrent writes into one transaction per batch, every caller gets its own result
+    Args:
+        max_batch_size: Maximum number of statements per commit
+        window: Seconds to wait for more statements after the first one arrived
+        timeout: Seconds a caller waits for its result
+    """
+    def __init__(self, max_batch_size, window, timeout):
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.stats = {"batches": 0, "statements": 0, "failed_statements": 0, "failed_commits": 0,
+                      "batch_sizes": {}, "commit_ms_total": 0.0, "commit_ms_max": 0.0}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, query, params=None):
+        """
+        Queue a write and wait until its batch was committed
+        Args:
+            query: SQL query or statement template
+            params: Parameter list, None for a plain query
+        Returns:
+            Response dictionary
+        """
+        item = {"query": query, "params": params, "done": threading.Event(), "result": None, "error": None}
+        self._queue.put(item)
+        if not item["done"].wait(self.timeout):
+            raise PoolTimeout(f"Write not committed after {self.timeout}s, its outcome is unknown")
+        error = item["error"]
+        if isinstance(error, PoolTimeout):
+            raise PoolTimeout(str(error))
+        if error is not None:
+            raise mysql.connector.Error(msg=str(error), sqlstate=getattr(error, "sqlstate", None))
+        return item["result"]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            outcomes, commit_ms = run_in_transaction([(item["query"], item["params"]) for item in batch])
+            for item, (result, error) in zip(batch, outcomes):
+                item["result"], item["error"] = result, error
+        except (mysql.connector.Error, PoolTimeout) as e:
+            commit_ms = None
+            for item in batch:
+                item["error"] = e
+        finally:
+            self._record(batch, commit_ms)
+            for item in batch:
+                item["done"].set()
+
+    def _record(self, batch, commit_ms):
+        with self._lock:
+            self.stats["batches"] += 1
+            self.stats["statements"] += len(batch)
+            self.stats["failed_statements"] += sum(1 for item in batch if item["error"] is not None)
+            self.stats["batch_sizes"][len(batch)] = self.stats["batch_sizes"].get(len(batch), 0) + 1
+            if commit_ms is None:
+                self.stats["failed_commits"] += 1
+            else:
+                self.stats["commit_ms_total"] += commit_ms
+                self.stats["commit_ms_max"] = max(self.stats["commit_ms_max"], commit_ms)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, batch_sizes=dict(self.stats["batch_sizes"]))
+        commits = stats["batches"] - stats["failed_commits"]
+        stats["avg_batch_size"] = stats["statements"] / stats["batches"] if stats["batches"] else None
+        stats["avg_commit_ms"] = stats["commit_ms_total"] / commits if commits else None
+        return stats
+
+
+write_batcher = WriteBatcher(WRITE_BATCH_SIZE, WRITE_BATCH_WINDOW, WRITE_BATCH_TIMEOUT) if WRITE_BATCH_ENABLED else None
+if write_batcher is not None:
+    metrics.REGISTRY.gauge("write_batch", "Group commit counters", ("counter",),
+                           callback=lambda: {(name,): value for name, value in write_batcher.get_stats().items()
+                                             if isinstance(value, (int, float))})
+
+
+def stream_query(query, params=None):
+    """
+    Function to stream a SELECT as NDJSON, fetching the rows in batches.
+    The first yield happens once the query was executed so errors can still be returned as JSON
+    Args:
+        query: SQL query or statement template
+        params: Parameter list, None for a plain query
+    Returns:
+        Generator of NDJSON chunks
+    """
+    with pool.connection() as conn:
+        cursor, owned = get_cursor(conn, query, params)
+        try:
+            start_time = time.perf_counter()
+            cursor.execute(query, params)
+            DB_EXECUTE_LATENCY.labels("stream").observe(time.perf_counter() - start_time)
+            columns = cursor.column_names
+            yield ""
+
+            while True:
+                try:
+                    rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                except mysql.connector.Error as e:
+                    yield app.json.dumps({"error": str(e)}) + "\n"
+                    break
+                if not rows:
+                    break
+                yield "".join(app.json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+        finally:
+            if conn.unread_result:
+                conn.consume_results()
+            if owned:
+                cursor.close()
+
+
+def log_response(response):
+    """
+    Function to write a sample of the responses to response.txt
+    Args:
+        response: Response dictionary
+    """
+    if RESPONSE_LOG_SAMPLE_RATE > 0 and random.random() < RESPONSE_LOG_SAMPLE_RATE:
+        with open('response.txt', 'w') as file:
+            file.write(f"{response}")
+
 
 @app.route('/execute', methods=['POST'])
 def execute_query():
     data = request.get_json()
     query = data.get("query")
+    params = data.get("params")
 
     if not query:
         return jsonify({"error": "No query provided"}), 400
 
     try:
-        # Connect to MySQL database
-        conn = mysql.connector.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME
-        )
-        cursor = conn.cursor()
+        if data.get("stream") and query.strip().lower().startswith("select"):
+            start_time = time.perf_counter()
+            rows = stream_query(query, params)
+            next(rows)
+            metrics.add_timing("db", time.perf_counter() - start_time)
+            # Compressed here batch by batch, the proxy and the trusted host forward the bytes as they are
+            encoding = codec.choose_encoding(request.headers.get("Accept-Encoding"))
+            body = Response(rows if encoding is None else codec.compress_stream(rows, encoding),
+                            mimetype="application/x-ndjson")
+            body.vary.add("Accept-Encoding")
+            if encoding is not None:
+                body.headers["Content-Encoding"] = encoding
+            return body, 200
 
-        # Execute the query
-        cursor.execute(query)
+        # SELECT results go out columnar as MessagePack when the caller negotiated it
+        columnar = query.strip().lower().startswith("select") and codec.accepts_msgpack(request.headers.get("Accept"))
 
-        # Commit only for non-select queries
-        if query.strip().lower().startswith("select"):
-            result = cursor.fetchall()
-            columns = cursor.column_names
-            response = {"result": [dict(zip(columns, row)) for row in result]}
+        start_time = time.perf_counter()
+        if write_batcher is not None and query.strip().lower().startswith(("insert", "delete")):
+            response = write_batcher.submit(query, params)
         else:
-            conn.commit()
-            response = {"message": "Query executed successfully"}
+            response = run_query(query, params, columnar)
+        metrics.add_timing("db", time.perf_counter() - start_time)
+        log_response(response)
 
-        with open('response.txt', 'w') as file:
-            file.write(f"{response}")
-        cursor.close()
-        conn.close()
+        start_time = time.perf_counter()
+        if columnar:
+            # Compressed here once, the proxy and the trusted host forward the bytes as they are
+            body = Response(codec.encode_columnar(response["columns"], response["rows"], app.json.default),
+                            mimetype=codec.MSGPACK_MIMETYPE)
+            codec.compress_response(body, request.headers.get("Accept-Encoding"))
+        else:
+            body = jsonify(response)
+        metrics.add_timing("serialize", time.perf_counter() - start_time)
+        return body, 200
 
-        return jsonify(response), 200
+    except (mysql.connector.Error, PoolTimeout) as e:
+        return jsonify({"error": str(e)}), get_error_status(e)
 
-    except mysql.connector.Error as e:
-        return jsonify({"error": str(e)}), 500
+
+@app.route('/execute/batch', methods=['POST'])
+def execute_batch():
+    # Writes run in order in one transaction, reads one after another
+    data = request.get_json()
+    queries = data.get("queries") or []
+
+    if data.get("type") == "write":
+        try:
+            outcomes, _ = run_in_transaction([(query, None) for query in queries])
+        except (mysql.connector.Error, PoolTimeout) as e:
+            return jsonify({"error": str(e)}), get_error_status(e)
+        results = [dict(result, status=200) if error is None else {"status": get_error_status(error),
+                                                                    "error": str(error)}
+                   for result, error in outcomes]
+        return jsonify({"results": results}), 200
+
+    results = []
+    for query in queries:
+        try:
+            results.append(dict(run_query(query), status=200))
+        except (mysql.connector.Error, PoolTimeout) as e:
+            results.append({"status": get_error_status(e), "error": str(e)})
+    return jsonify({"results": results}), 200
 
 
 @app.route('/ping', methods=['GET'])
@@ -57,5 +555,50 @@ def ping():
     return jsonify("pong"), 200
 
 
+@app.route('/replication', methods=['GET'])
+def replication_status():
+    # Replication lag and thread state, the manager reports itself as source
+    try:
+        with pool.connection() as conn:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                cursor.execute("SHOW SLAVE STATUS")
+                status = cursor.fetchone()
+            finally:
+                cursor.close()
+    except PoolTimeout as e:
+        return jsonify({"error": str(e)}), 503
+    except mysql.connector.Error as e:
+        return jsonify({"error": str(e)}), 500
+
+    if status is None:
+        return jsonify({"role": "source", "lag_seconds": 0, "io_running": None, "sql_running": None}), 200
+    return jsonify({
+        "role": "replica",
+        "lag_seconds": status["Seconds_Behind_Master"],
+        "io_running": status["Slave_IO_Running"] == "Yes",
+        "sql_running": status["Slave_SQL_Running"] == "Yes",
+        "last_error": status["Last_Error"] or None,
+    }), 200
+
+
+@app.route('/pool', methods=['GET'])
+def pool_stats():
+    # Pool statistics are only exposed to local clients
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(pool.get_stats()), 200
+
+
+@app.route('/write-batch', methods=['GET'])
+def write_batch_stats():
+    # Batch size and commit latency of the group commit, local clients only
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return jsonify({"error": "Forbidden"}), 403
+    if write_batcher is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(dict(write_batcher.get_stats(), enabled=True)), 200
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)